@@ -117,6 +117,8 @@ DATA_UPLOAD_MAX_MEMORY_SIZE = None
 DATA_UPLOAD_MAX_NUMBER_FIELDS = 2000
 
 REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+# how long to keep a journey's locations in Redis after the vehicle has moved on to another journey (None = forever)
+JOURNEY_HISTORY_TTL = int(os.environ['JOURNEY_HISTORY_TTL']) if os.environ.get('JOURNEY_HISTORY_TTL') else None
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', REDIS_URL)
 CELERY_RESULT_BACKEND = CELERY_BROKER_URL
 
@@ -232,6 +234,11 @@ TFWM = {
 
 DATA_DIR = os.path.join(BASE_DIR, 'data')
 TNDS_DIR = os.path.join(DATA_DIR, 'TNDS')
+# where archive_journey_locations puts journeys' location histories (see vehicles/archive.py)
+JOURNEY_ARCHIVE_DIR = os.environ.get('JOURNEY_ARCHIVE_DIR', os.path.join(DATA_DIR, 'journeys'))
+
+# store imported TransXChange stop times as shared bustimes.models.JourneyPatterns, instead of StopTimes
+COMPACT_STOP_TIMES = bool(os.environ.get('COMPACT_STOP_TIMES'))
 
 AKISMET_API_KEY = os.environ.get('AKISMET_API_KEY')
 AKISMET_SITE_URL = 'https://bustimes.org'
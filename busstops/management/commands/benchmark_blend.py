@@ -0,0 +1,88 @@
+"""Compare the speed of departures.live.blend with the old nested loop way of blending live and scheduled departures,
+using made-up departure boards.
+
+    ./manage.py benchmark_blend --rows 50 500 5000
+"""
+
+import datetime
+import random
+from copy import deepcopy
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from departures.live import blend, can_sort, get_departure_order, services_match
+
+
+def legacy_blend(departures, live_rows, stop=None):
+    """The way blend used to work"""
+    added = False
+    for live_row in live_rows:
+        replaced = False
+        for row in departures:
+            if services_match(row['service'], live_row['service']) and row['time'] and live_row['time']:
+                if abs(row['time'] - live_row['time']) <= datetime.timedelta(minutes=2):
+                    if live_row.get('live'):
+                        row['live'] = live_row['live']
+                    if 'data' in live_row:
+                        row['data'] = live_row['data']
+                    replaced = True
+                    break
+        if not replaced and (live_row.get('live') or live_row['time']):
+            departures.append(live_row)
+            added = True
+    if added and all(can_sort(departure) for departure in departures):
+        departures.sort(key=get_departure_order)
+
+
+def get_boards(rows):
+    """A scheduled board with rows departures of 20 services over a day,
+    and live rows for most of them (and a few extra ones)
+    """
+    random.seed(rows)
+    start = timezone.now().replace(microsecond=0)
+    departures = [{
+        'service': str(random.randrange(20)),
+        'time': start + datetime.timedelta(seconds=random.randrange(86400)),
+    } for _ in range(rows)]
+    departures.sort(key=lambda row: row['time'])
+
+    live_rows = []
+    for row in departures:
+        if random.random() < 0.8:
+            live_rows.append({
+                'service': row['service'].upper(),
+                'time': row['time'] + datetime.timedelta(seconds=random.choice((0, 0, 60, -60))),
+                'live': row['time'] + datetime.timedelta(seconds=random.randrange(-120, 600)),
+            })
+        if random.random() < 0.1:
+            live_rows.append({
+                'service': str(random.randrange(20)),
+                'time': start + datetime.timedelta(seconds=random.randrange(86400)),
+                'live': start + datetime.timedelta(seconds=random.randrange(86400)),
+            })
+    return departures, live_rows
+
+
+class Command(BaseCommand):
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--rows', nargs='+', type=int, default=[50, 500, 2000])
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, rows, repeat, **options):
+        for count in rows:
+            departures, live_rows = get_boards(count)
+
+            results = {}
+            for name, function in (('Nested loop', legacy_blend), ('Indexed', blend)):
+                elapsed = 0
+                for _ in range(repeat):
+                    board = deepcopy(departures)
+                    start = perf_counter()
+                    function(board, live_rows)
+                    elapsed += perf_counter() - start
+                results[name] = board
+                self.stdout.write(f'{count} rows, {len(live_rows)} live rows, '
+                                  f'{name}: {elapsed / repeat * 1000:.2f} ms')
+
+            assert results['Nested loop'] == results['Indexed']
@@ -27,7 +27,7 @@ class Command(BaseCommand):
                         'lat': stoptime.stop.latlong.y,
                         'lon': stoptime.stop.latlong.x,
                         'time': stoptime.arrival.total_seconds()
-                    } for stoptime in trip.stoptime_set.all()
+                    } for stoptime in trip.get_stop_times()
                 ]
                 r = session.post('https://api.stadiamaps.com/trace_route', params=params, json={
                     'costing': 'bus',
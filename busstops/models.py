@@ -18,8 +18,8 @@ from django.urls import reverse
 from django.utils.text import slugify
 from django.utils.html import format_html, escape
 from django.utils.safestring import mark_safe
-from bustimes.models import Route, Trip
-from bustimes.timetables import Timetable
+from bustimes.models import prefetch_stop_times, Route, Trip
+from bustimes.timetables import get_timetable
 from buses.utils import varnish_ban
 
 
@@ -843,14 +843,14 @@ class Service(models.Model):
         """Given a Service, return a Timetable"""
 
         if self.region_id == 'NI' or self.source and self.source.name.endswith(' GTFS'):
-            return Timetable(self.route_set.all(), day)
+            return get_timetable(self.route_set.all(), day)
 
         if related:
             routes = Route.objects.filter(service__in=[self] + related).order_by('start_date')
         else:
             routes = self.route_set.order_by('start_date')
         try:
-            timetable = Timetable(routes, day)
+            timetable = get_timetable(routes, day)
         except (IndexError, UnboundLocalError) as e:
             logger.error(e, exc_info=True)
             return
@@ -876,16 +876,22 @@ class Service(models.Model):
     def varnish_ban(self):
         varnish_ban(self.get_absolute_url())
 
-    def update_geometry(self):
+    def update_geometry(self, stop_patterns=None):
+        """stop_patterns - lists of the StopPoints of the service's trips - saves reading the trips from the database,
+        if the caller already knows them
+        """
         for route in self.route_set.all():
             if route.geometry:
                 self.geometry = route.geometry
                 self.save(update_fields=['geometry'])
                 return
+        if stop_patterns is None:
+            trips = Trip.objects.filter(route__service=self).prefetch_related(*prefetch_stop_times(('stop',)))
+            stop_patterns = ([stoptime.stop for stoptime in trip.get_stop_times()] for trip in trips)
         patterns = []
         linestrings = []
-        for trip in Trip.objects.filter(route__service=self).prefetch_related('stoptime_set__stop'):
-            stops = [stoptime.stop for stoptime in trip.stoptime_set.all() if stoptime.stop and stoptime.stop.latlong]
+        for stops in stop_patterns:
+            stops = [stop for stop in stops if stop and stop.latlong]
             pattern = [stop.pk for stop in stops]
             if pattern in patterns:
                 continue
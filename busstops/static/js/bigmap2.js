@@ -155,9 +155,41 @@
         });
     }
 
-    var lastVehiclesReq, loadVehiclesTimeout, vehiclesHighWater;
+    var lastVehiclesReq, loadVehiclesTimeout, vehiclesHighWater, vehiclesSince, socket, socketInterval;
+
+    function openSocket() {
+        socket = new WebSocket((window.location.protocol === 'https:' ? 'wss://' : 'ws://') + window.location.host + '/ws/vehicle_positions');
+        socket.onopen = function() {
+            loadVehicles();
+            // resend the bounds every minute, so the server knows the map is still there
+            socketInterval = setInterval(loadVehicles, 60000);
+        };
+        socket.onmessage = function(event) {
+            var data = JSON.parse(event.data);
+            if (data.full) {
+                processVehiclesData(data.vehicles);
+            } else {
+                processVehiclesChanges(data);
+            }
+        };
+        socket.onclose = function() {
+            // fall back to polling
+            socket = null;
+            clearInterval(socketInterval);
+            loadVehicles();
+        };
+    }
 
     function loadVehicles(onMoveEnd) {
+        if (socket) {
+            if (socket.readyState === WebSocket.OPEN) {
+                var socketBounds = map.getBounds();
+                socket.send(JSON.stringify([
+                    socketBounds.getWest(), socketBounds.getSouth(), socketBounds.getEast(), socketBounds.getNorth()
+                ]));
+            }
+            return;
+        }
         if (lastVehiclesReq) {
             lastVehiclesReq.abort();
         }
@@ -169,18 +201,43 @@
             clearTimeout(loadVehiclesTimeout);
         }
         var params = '?ymax=' + bounds.getNorth() + '&xmax=' + bounds.getEast() + '&ymin=' + bounds.getSouth() + '&xmin=' + bounds.getWest();
+        // only ask for what's changed if the map hasn't moved
+        if (vehiclesSince && vehiclesHighWater && vehiclesHighWater.equals(bounds)) {
+            params += '&since=' + vehiclesSince;
+        } else {
+            params += '&since=0';
+        }
         lastVehiclesReq = reqwest(
             '/vehicles.json' + params,
             function(data) {
                 if (data) {
                     vehiclesHighWater = bounds;
-                    processVehiclesData(data);
+                    vehiclesSince = data.since;
+                    if (data.full) {
+                        processVehiclesData(data.vehicles);
+                    } else {
+                        processVehiclesChanges(data);
+                    }
                 }
                 loadVehiclesTimeout = setTimeout(loadVehicles, 15000);
             }
         );
     }
 
+    function processVehiclesChanges(data) {
+        for (var i = data.vehicles.length - 1; i >= 0; i--) {
+            var item = data.vehicles[i];
+            bustimes.vehicleMarkers[item.id] = processVehicle(item);
+        }
+        for (i = data.expired.length - 1; i >= 0; i--) {
+            var id = data.expired[i];
+            if (id in bustimes.vehicleMarkers) {
+                vehiclesGroup.removeLayer(bustimes.vehicleMarkers[id]);
+                delete bustimes.vehicleMarkers[id];
+            }
+        }
+    }
+
     function processVehiclesData(data) {
         var newMarkers = {};
         var wasZoomedIn = bigVehicleMarkers;
@@ -340,7 +397,11 @@
         map.setView([51.9, 0.9], 9);
     }
 
-    loadVehicles();
+    if (window.WebSocket) {
+        openSocket();
+    } else {
+        loadVehicles();
+    }
 
     function handleVisibilityChange(event) {
         if (event.target.hidden) {
@@ -93,6 +93,14 @@
             content += item.occupancy + '<br>';
         }
 
+        if (item.early === 0) {
+            content += 'On time<br>';
+        } else if (item.early) {
+            var early = Math.abs(item.early);
+            content += 'About ' + early + ' minute' + (early === 1 ? '' : 's');
+            content += (item.early > 0 ? ' early' : ' late') + '<br>';
+        }
+
         if (ago >= 1800) {
             content += 'Updated at ' + then.toTimeString().slice(0, 8);
         } else {
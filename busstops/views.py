@@ -189,6 +189,9 @@ def status(request):
 
     return render(request, 'status.html', {
         'bod_avl_status': cache.get('bod_avl_status', []),
+        'departures_cache': live.get_cache_stats(),
+        'vehicle_locations_status': cache.get('vehicle_locations_status'),
+        'trip_index_status': cache.get('trip_index_status'),
         'tnds': tnds
     })
 
@@ -414,13 +417,7 @@ class StopPointDetailView(UppercasePrimaryKeyMixin, DetailView):
         if not (self.object.active or context['services']):
             raise Http404(f'Sorry, it looks like no services currently stop at {self.object}')
 
-        departures = cache.get(self.object.atco_code)
-        if not departures:
-            departures, max_age = live.get_departures(self.object, context['services'])
-            if hasattr(departures['departures'], 'get_departures'):
-                departures['departures'] = departures['departures'].get_departures()
-            if max_age:
-                cache.set(self.object.atco_code, departures, max_age)
+        departures = live.get_cached_departures(self.object, context['services'])
 
         context.update(departures)
         if context['departures']:
@@ -41,6 +41,11 @@ class CalendarAdmin(admin.ModelAdmin):
     inlines = [CalendarDateInline]
     readonly_fields = ['routes']
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # recompile operating_days now that the CalendarDateInline's changes have been saved
+        form.instance.save(update_fields=['operating_days', 'operating_weekdays'])
+
     def routes(self, obj):
         return mark_safe('<br>'.join(
             f'<a href="{route.get_absolute_url()}">{route}</a>' for route in Route.objects.filter(
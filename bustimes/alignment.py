@@ -0,0 +1,148 @@
+"""Merging stop sequences into the rows of a timetable.
+
+This used to be done by running difflib.Differ over lists of stop codes, which was slow for services with lots of
+trips and stops. Aligner produces exactly the same row order (that's what the tests check), but:
+
+- stop keys are interned as integers before they're compared
+- Differ's "fancy replace" step, which compared every pair of stop codes character by character, is replaced by a
+  direct calculation of the same similarity ratio
+- alignments are memoised per distinct stop sequence, so each journey pattern is only aligned once (unless an
+  alignment adds new rows, which might change the answer for later trips)
+"""
+
+from difflib import SequenceMatcher
+
+
+def _similarity(a, b):
+    """The ratio that difflib.Differ(charjunk=lambda _: True) uses to decide whether two lines are "pretty close".
+
+    Because every character is junk, a SequenceMatcher can only match the longest common prefix of the two strings.
+    """
+    size = min(len(a), len(b))
+    prefix = 0
+    while prefix < size and a[prefix] == b[prefix]:
+        prefix += 1
+    return 2.0 * prefix / (len(a) + len(b))
+
+
+def _replace(a, alo, ahi, b, blo, bhi):
+    """Like difflib.Differ._fancy_replace, but yielding ('-', i), ('+', j) and (' ', i, j) instructions"""
+    best_ratio, cutoff = 0.74, 0.75
+    eqi = eqj = None
+
+    for j in range(blo, bhi):
+        bj = b[j]
+        for i in range(alo, ahi):
+            ai = a[i]
+            if ai == bj:
+                if eqi is None:
+                    eqi, eqj = i, j
+                continue
+            # cheap upper bound first (equivalent to SequenceMatcher.real_quick_ratio)
+            if 2.0 * min(len(ai), len(bj)) / (len(ai) + len(bj)) > best_ratio:
+                ratio = _similarity(ai, bj)
+                if ratio > best_ratio:
+                    best_ratio, best_i, best_j = ratio, i, j
+
+    if best_ratio < cutoff:
+        if eqi is None:
+            # straight replace - the shorter block goes first
+            if bhi - blo < ahi - alo:
+                yield from (('+', j) for j in range(blo, bhi))
+                yield from (('-', i) for i in range(alo, ahi))
+            else:
+                yield from (('-', i) for i in range(alo, ahi))
+                yield from (('+', j) for j in range(blo, bhi))
+            return
+        best_i, best_j = eqi, eqj
+    else:
+        eqi = None
+
+    yield from _replace_helper(a, alo, best_i, b, blo, best_j)
+
+    if eqi is None:
+        yield ('-', best_i)
+        yield ('+', best_j)
+    else:
+        yield (' ', best_i, best_j)
+
+    yield from _replace_helper(a, best_i + 1, ahi, b, best_j + 1, bhi)
+
+
+def _replace_helper(a, alo, ahi, b, blo, bhi):
+    if alo < ahi:
+        if blo < bhi:
+            yield from _replace(a, alo, ahi, b, blo, bhi)
+        else:
+            yield from (('-', i) for i in range(alo, ahi))
+    elif blo < bhi:
+        yield from (('+', j) for j in range(blo, bhi))
+
+
+class Aligner:
+    """Accumulates an ordered list of row keys (stop codes).
+
+    Each call to align() merges a new sequence of keys into the list, adding rows where necessary.
+    """
+
+    def __init__(self):
+        self.keys = []  # the rows, in order
+        self._ints = []  # the rows, interned
+        self._interned = {}
+        self._cache = {}
+
+    def intern(self, key):
+        interned = self._interned.get(key)
+        if interned is None:
+            interned = self._interned[key] = len(self._interned)
+        return interned
+
+    def align(self, keys):
+        """Merge a sequence of keys into the rows.
+
+        Returns a list of (row index, new) tuples, one for each key.
+        Rows for new keys are inserted into self.keys, so the row index is the index *after* insertion.
+        Row indices increase monotonically, so a caller keeping its own list of rows can insert new rows in order
+        as it goes along, and end up with the same order as self.keys.
+        """
+        ints = tuple(self.intern(key) for key in keys)
+
+        result = self._cache.get(ints)
+        if result is not None:
+            return result
+
+        matcher = SequenceMatcher(None, self._ints, ints)
+        instructions = []
+        for tag, alo, ahi, blo, bhi in matcher.get_opcodes():
+            if tag == 'equal':
+                instructions += ((' ', i, j) for i, j in zip(range(alo, ahi), range(blo, bhi)))
+            elif tag == 'delete':
+                instructions += (('-', i) for i in range(alo, ahi))
+            elif tag == 'insert':
+                instructions += (('+', j) for j in range(blo, bhi))
+            else:
+                # use the original (uninterned) keys, because string similarity matters here
+                instructions += _replace(self.keys, alo, ahi, keys, blo, bhi)
+
+        result = []
+        y = 0  # how many rows down we are
+        for instruction in instructions:
+            if instruction[0] == '-':
+                y += 1
+            elif instruction[0] == ' ':
+                result.append((y, False))
+                y += 1
+            else:
+                j = instruction[1]
+                self.keys.insert(y, keys[j])
+                self._ints.insert(y, ints[j])
+                result.append((y, True))
+                y += 1
+
+        if any(new for _, new in result):
+            # the rows have changed, so previous alignments might be wrong now
+            self._cache.clear()
+        else:
+            self._cache[ints] = result
+
+        return result
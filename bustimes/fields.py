@@ -1,6 +1,6 @@
 from datetime import timedelta
 from django.utils.dateparse import parse_duration
-from django.db.models.fields import DurationField
+from django.db.models.fields import BinaryField, DurationField
 
 
 class SecondsField(DurationField):
@@ -34,3 +34,14 @@ class SecondsField(DurationField):
         # if type(value) is timedelta:
         #     return value
         return timedelta(seconds=value)
+
+
+class BytesField(BinaryField):
+    """A BinaryField whose values come out of the database as bytes, like they went in -
+    not as memoryviews, which can't be pickled (or indexed the same way)
+    """
+    @staticmethod
+    def from_db_value(value, _expression, _connection):
+        if value is None:
+            return value
+        return bytes(value)
@@ -0,0 +1,67 @@
+"""Compare the speed of bustimes.alignment.Aligner with the old difflib.Differ way of building timetable rows.
+
+    ./manage.py benchmark_alignment 1-circular 48-cambridge-drummer-street-arbury
+"""
+
+from difflib import Differ
+from functools import cmp_to_key
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from ...alignment import Aligner
+from ...models import prefetch_stop_times, Trip
+
+
+differ = Differ(charjunk=lambda _: True)
+
+
+def differ_rows(sequences):
+    """Merge sequences of keys into rows, the way Grouping.handle_trip used to"""
+    rows = []
+    for keys in sequences:
+        diff = differ.compare(list(rows), keys)
+        y = 0  # how many rows down we are
+        for key in keys:
+            instruction = next(diff)
+            while instruction[0] in '-?':
+                if instruction[0] == '-':
+                    y += 1
+                instruction = next(diff)
+            assert instruction[2:] == key
+            if instruction[0] == '+':
+                rows = rows[:y] + [key] + rows[y:]
+            y += 1
+    return rows
+
+
+def aligner_rows(sequences):
+    aligner = Aligner()
+    for keys in sequences:
+        aligner.align(keys)
+    return aligner.keys
+
+
+class Command(BaseCommand):
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('services', nargs='+', type=str, help='service slugs')
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, services, repeat, **options):
+        for slug in services:
+            trips = Trip.objects.filter(route__service__slug=slug).order_by('start')
+            trips = trips.prefetch_related(*prefetch_stop_times())
+            trips = sorted(trips, key=cmp_to_key(Trip.__cmp__))
+
+            groupings = [[], []]
+            for trip in trips:
+                groupings[int(trip.inbound)].append([stoptime.get_key() for stoptime in trip.get_stop_times()])
+
+            for name, function in (('Differ', differ_rows), ('Aligner', aligner_rows)):
+                start = perf_counter()
+                for _ in range(repeat):
+                    rows = [function(sequences) for sequences in groupings]
+                elapsed = (perf_counter() - start) / repeat
+                self.stdout.write(f'{slug}: {len(trips)} trips, {sum(len(r) for r in rows)} rows, '
+                                  f'{name}: {elapsed * 1000:.1f} ms')
+
+            assert [differ_rows(sequences) for sequences in groupings] == rows
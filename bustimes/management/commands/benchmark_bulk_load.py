@@ -0,0 +1,67 @@
+"""Compare the speed of bustimes.bulk_load.save_trips (COPY) with bulk_create, the way the importers used to save trips.
+
+Copies of one of a route's trips (and its stop times) are saved, then rolled back.
+
+    ./manage.py benchmark_bulk_load --trips 5000 [--route 123]
+"""
+
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ...bulk_load import save_trips
+from ...models import Route, Trip, StopTime
+
+
+def bulk_create_trips(trips, stop_times):
+    Trip.objects.bulk_create(trips)
+    for stop_time in stop_times:
+        stop_time.trip = stop_time.trip  # set trip_id
+    StopTime.objects.bulk_create(stop_times)
+
+
+def copy(obj):
+    """An unsaved copy of a model instance"""
+    return type(obj)(**{
+        field.attname: getattr(obj, field.attname) for field in obj._meta.concrete_fields if not field.primary_key
+    })
+
+
+class Command(BaseCommand):
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--trips', type=int, default=5000)
+        parser.add_argument('--route', type=int)
+
+    def handle(self, trips, route, **options):
+        if route:
+            route = Route.objects.get(id=route)
+        else:
+            route = Route.objects.filter(trip__stoptime__isnull=False).first()
+        trip = route.trip_set.filter(stoptime__isnull=False).first()
+        stop_times = list(trip.stoptime_set.all())
+
+        for name, save in (
+            ('bulk_create', bulk_create_trips),
+            ('COPY', save_trips),
+        ):
+            new_trips = []
+            new_stop_times = []
+            for _ in range(trips):
+                new_trip = copy(trip)
+                new_trips.append(new_trip)
+                for stop_time in stop_times:
+                    new_stop_time = copy(stop_time)
+                    new_stop_time.trip = new_trip
+                    new_stop_times.append(new_stop_time)
+
+            with transaction.atomic():
+                start = perf_counter()
+                save(new_trips, new_stop_times)
+                time_taken = perf_counter() - start
+                transaction.set_rollback(True)
+
+            rows = len(new_trips) + len(new_stop_times)
+            self.stdout.write(
+                f'{name}: {rows} rows ({len(new_trips)} trips) in {time_taken:.3f} seconds '
+                f'- {rows / time_taken:.0f} rows/second'
+            )
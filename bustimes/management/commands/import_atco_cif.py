@@ -7,7 +7,8 @@ from django.contrib.gis.geos import LineString, MultiLineString, Point
 from django.utils import timezone
 from busstops.models import Service, DataSource, StopPoint, StopUsage
 from ...models import Route, Calendar, CalendarDate, Trip, StopTime, Note
-from ...timetables import get_journey_patterns, get_stop_usages
+from ...bulk_load import save_trips
+from ...timetables import add_stop_pattern, align_stop_usages, expire_timetables
 
 
 def parse_date(string):
@@ -34,6 +35,7 @@ class Command(BaseCommand):
 
     def handle_archive(self, archive_name):
         self.routes = {}
+        self.route_patterns = {}  # route id: distinct (inbound, stop times) pairs
         self.calendars = {}
         if 'ulb' in archive_name.lower():
             source_name = 'ULB'
@@ -51,7 +53,18 @@ class Command(BaseCommand):
         assert self.stop_times == []
 
         for route in self.routes.values():
-            groupings = get_stop_usages(route.trip_set.all())
+            # work out stop usages and geometry from the trips handle_line has parsed,
+            # instead of reading them back from the database
+            patterns = self.route_patterns.get(route.id, {}).values()
+            # self.stops doesn't contain all stops, and has latlongs in the Irish Grid projection
+            stops = StopPoint.objects.in_bulk(
+                {stop_time.stop_id for _, stop_times in patterns for stop_time in stop_times}
+            )
+            patterns = [
+                (inbound, [stop_time for stop_time in stop_times if stop_time.stop_id in stops])
+                for inbound, stop_times in patterns
+            ]
+            groupings = align_stop_usages(patterns)
 
             route.service.stops.clear()
             stop_usages = [
@@ -65,12 +78,13 @@ class Command(BaseCommand):
             ]
             StopUsage.objects.bulk_create(stop_usages)
 
-            # self.stops doesn't contain all stops, and has latlongs in the Irish Grid projection
-            stops = StopPoint.objects.in_bulk(stop_usage.stop_id for stop_usage in stop_usages)
             line_strings = []
-            for pattern in get_journey_patterns(route.trip_set.all()):
-                points = (stops[stop_code].latlong for stop_code in pattern if stop_code in stops)
-                line_strings.append(LineString(*points))
+            stop_patterns = []
+            for _, stop_times in patterns:
+                pattern = [stop_time.stop_id for stop_time in stop_times]
+                if pattern not in stop_patterns:
+                    stop_patterns.append(pattern)
+                    line_strings.append(LineString(*(stops[stop_code].latlong for stop_code in pattern)))
             route.service.geometry = MultiLineString(*line_strings)
 
         services = {route.service.id: route.service for route in self.routes.values()}.values()
@@ -78,6 +92,7 @@ class Command(BaseCommand):
                                     fields=['geometry', 'description', 'outbound_description', 'inbound_description'])
         for service in services:
             service.update_search_vector()
+        expire_timetables(service.id for service in services)
 
         self.source.route_set.exclude(code__in=self.routes.keys()).delete()
         self.source.service_set.filter(current=True).exclude(service_code__in=self.routes.keys()).update(current=False)
@@ -88,6 +103,9 @@ class Command(BaseCommand):
         self.trip = None
         self.stop_times = []
         self.notes = []
+        self.trips = []
+        self.notes_by_trip = []
+        self.trips_stop_times = []
 
         # detect encoding
         detector = UniversalDetector()
@@ -139,12 +157,14 @@ class Command(BaseCommand):
             self.handle_line(line, previous_line, encoding)
             previous_line = line
 
+        save_trips(self.trips, self.trips_stop_times, self.notes_by_trip)
+
     def get_calendar(self):
         line = self.trip_header
         key = line[13:38].decode() + str(self.exceptions)
         if key in self.calendars:
             return self.calendars[key]
-        calendar = Calendar.objects.create(
+        calendar = Calendar(
             mon=line[29:30] == b'1',
             tue=line[30:31] == b'1',
             wed=line[31:32] == b'1',
@@ -155,14 +175,18 @@ class Command(BaseCommand):
             start_date=parse_date(line[13:21]),
             end_date=parse_date(line[21:29])
         )
-        CalendarDate.objects.bulk_create(
+        calendar_dates = [
             CalendarDate(
-                calendar=calendar,
                 start_date=parse_date(exception[2:10]),
                 end_date=parse_date(exception[10:18]),
                 operation=exception[18:19] == b'1',
             ) for exception in self.exceptions
-        )
+        ]
+        calendar.compile(calendar_dates)
+        calendar.save()
+        for calendar_date in calendar_dates:
+            calendar_date.calendar = calendar
+        CalendarDate.objects.bulk_create(calendar_dates)
 
         self.calendars[key] = calendar
         return calendar
@@ -280,14 +304,13 @@ class Command(BaseCommand):
                 self.trip.destination_id = stop_code
                 self.trip.end = arrival
 
-                self.trip.save()
+                add_stop_pattern(self.route_patterns.setdefault(self.route.id, {}), self.trip.inbound, self.stop_times)
 
-                self.trip.notes.set(self.notes)
+                # saved at the end of the file
+                self.trips.append(self.trip)
+                self.notes_by_trip.append(self.notes)
                 self.notes = []
-
-                for stop_time in self.stop_times:
-                    stop_time.trip = stop_time.trip  # set trip_id
-                StopTime.objects.bulk_create(self.stop_times)
+                self.trips_stop_times += self.stop_times
                 self.stop_times = []
 
         elif identity == b'QN':  # note
@@ -10,11 +10,14 @@ from chardet.universaldetector import UniversalDetector
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db.models import Count
+from django.utils.dateparse import parse_duration
 from django.contrib.gis.geos import Point
 from django.contrib.gis.geos import LineString, MultiLineString
 from busstops.models import Region, DataSource, StopPoint, Service, StopUsage, Operator, AdminArea
 from ...models import Route, Calendar, CalendarDate, Trip, StopTime
-from ...timetables import get_stop_usages
+from ...bulk_load import save_trips
+from ...timetables import add_stop_pattern, align_stop_usages, expire_timetables
+from ...trip_diff import TripDiff, describe_counts
 from ...utils import download_if_changed
 
 
@@ -28,12 +31,19 @@ MODES = {
     200: 'coach',
 }
 SESSION = requests.Session()
+STOP_TIMES_BATCH_SIZE = 100000  # how many StopTimes (and their trips) to keep in memory before saving them
 
 
 def parse_date(string):
     return datetime.strptime(string, '%Y%m%d')
 
 
+def save_changed_trips(trip_diff, trips, stop_times_by_trip):
+    """Saves the trips (and their stop times) that trip_diff doesn't match to existing trips"""
+    trips, stop_times_by_trip, _ = trip_diff.update(trips, stop_times_by_trip)
+    save_trips(trips, [stop_time for stop_times in stop_times_by_trip for stop_time in stop_times])
+
+
 def read_file(archive, name):
     try:
         with archive.open(name) as open_file:
@@ -103,6 +113,10 @@ def handle_zipfile(path, collection, url, last_modified):
     routes = {}
     services = set()
     headsigns = {}
+    service_patterns = {}  # service id: distinct (inbound, stop times) pairs, for working out stop usages
+
+    # so trips that haven't changed since the last import can be left alone
+    trip_diff = TripDiff(Trip.objects.filter(route__source=source))
 
     with zipfile.ZipFile(path) as archive:
 
@@ -156,8 +170,6 @@ def handle_zipfile(path, collection, url, last_modified):
                 source=source,
                 code=line['route_id'],
             )
-            if not created:
-                route.trip_set.all().delete()
             routes[line['route_id']] = route
 
         stops, stops_not_created = do_stops(archive)
@@ -178,13 +190,21 @@ def handle_zipfile(path, collection, url, last_modified):
             calendar.save()
             calendars[line['service_id']] = calendar
 
+        calendar_dates = {}
         for line in read_file(archive, 'calendar_dates.txt'):
-            CalendarDate.objects.create(
+            calendar_date = CalendarDate.objects.create(
                 calendar=calendars[line['service_id']],
                 start_date=parse_date(line['date']),
                 end_date=parse_date(line['date']),
                 operation=line['exception_type'] == '1'
             )
+            calendar_dates.setdefault(line['service_id'], []).append(calendar_date)
+        for service_id in calendar_dates:
+            calendars[service_id].compile(calendar_dates[service_id])
+        Calendar.objects.bulk_update(
+            [calendars[service_id] for service_id in calendar_dates],
+            ['operating_days', 'operating_weekdays']
+        )
 
         trips = {}
         for line in read_file(archive, 'trips.txt'):
@@ -230,6 +250,9 @@ def handle_zipfile(path, collection, url, last_modified):
 
                     route.service.save(update_fields=['description', 'inbound_description', 'outbound_description'])
 
+        trips_to_save = []
+        stop_times_by_trip = []
+        stop_times_count = 0
         stop_times = []
         trip_id = None
         trip = None
@@ -243,11 +266,16 @@ def handle_zipfile(path, collection, url, last_modified):
                         stop_time.departure = None
                     trip.start = stop_times[0].departure
                     trip.end = stop_times[-1].arrival
-                    trip.save()
-                    for stop_time in stop_times:
-                        stop_time.trip = trip
-                    StopTime.objects.bulk_create(stop_times)
+                    add_stop_pattern(service_patterns.setdefault(trip.route.service_id, {}), trip.inbound, stop_times)
+                    trips_to_save.append(trip)
+                    stop_times_by_trip.append(stop_times)
+                    stop_times_count += len(stop_times)
                     stop_times = []
+                    if stop_times_count >= STOP_TIMES_BATCH_SIZE:
+                        save_changed_trips(trip_diff, trips_to_save, stop_times_by_trip)
+                        trips_to_save = []
+                        stop_times_by_trip = []
+                        stop_times_count = 0
                 trip = Trip()
             trip_id = line['trip_id']
             trip = trips[trip_id]
@@ -258,9 +286,10 @@ def handle_zipfile(path, collection, url, last_modified):
                 arrival_time = None
             stop_time = StopTime(
                 stop=stop,
-                arrival=arrival_time,
-                departure=departure_time,
-                sequence=line['stop_sequence'],
+                arrival=parse_duration(arrival_time) if arrival_time else None,
+                departure=parse_duration(departure_time) if departure_time else None,
+                sequence=int(line['stop_sequence']),
+                trip=trip
             )
             if stop:
                 trip.destination = stop
@@ -277,10 +306,15 @@ def handle_zipfile(path, collection, url, last_modified):
         stop_time.departure = None
     trip.start = stop_times[0].departure
     trip.end = stop_times[-1].arrival
-    trip.save()
-    for stop_time in stop_times:
-        stop_time.trip = trip
-    StopTime.objects.bulk_create(stop_times)
+    add_stop_pattern(service_patterns.setdefault(trip.route.service_id, {}), trip.inbound, stop_times)
+    trips_to_save.append(trip)
+    stop_times_by_trip.append(stop_times)
+    save_changed_trips(trip_diff, trips_to_save, stop_times_by_trip)
+
+    trip_diff.delete_unmatched()
+    # calendars that are only for trips that matched existing trips (which have kept their own calendars)
+    Calendar.objects.filter(id__in=[calendar.id for calendar in calendars.values()], trip=None).delete()
+    logger.info('%s: %s', source, describe_counts(trip_diff.counts))
 
     for service in services:
         if service.id in service_shapes:
@@ -288,7 +322,7 @@ def handle_zipfile(path, collection, url, last_modified):
             service.geometry = MultiLineString(*linestrings)
             service.save(update_fields=['geometry'])
 
-        groupings = get_stop_usages(Trip.objects.filter(route__service=service))
+        groupings = align_stop_usages(service_patterns.get(service.id, {}).values())
 
         service.stops.clear()
         stop_usages = [
@@ -309,6 +343,8 @@ def handle_zipfile(path, collection, url, last_modified):
             service.save(update_fields=['region'])
         service.update_search_vector()
 
+    expire_timetables(service.id for service in services)
+
     for operator in operators.values():
         operator.region = Region.objects.filter(adminarea__stoppoint__service__operator=operator).annotate(
             Count('adminarea__stoppoint__service__operator')
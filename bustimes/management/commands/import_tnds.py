@@ -12,6 +12,7 @@ class Command(BaseCommand):
     def add_arguments(parser):
         parser.add_argument('username', type=str)
         parser.add_argument('password', type=str)
+        parser.add_argument('--jobs', type=int, default=1, help='number of processes to import each archive with')
 
     def get_existing_file(self, key):
         for file in self.existing_files['Contents']:
@@ -44,7 +45,7 @@ class Command(BaseCommand):
 
                 self.changed_files.append(path)
 
-    def handle(self, username, password, *args, **options):
+    def handle(self, username, password, jobs, *args, **options):
         self.client = boto3.client('s3', endpoint_url='https://ams3.digitaloceanspaces.com')
 
         self.existing_files = self.client.list_objects_v2(Bucket='bustimes-data')
@@ -71,5 +72,9 @@ class Command(BaseCommand):
         for file in self.changed_files:
             print(file)
             before = timezone.now()
-            call_command('import_transxchange', file)
+            call_command('import_transxchange', file, jobs=jobs)
             print(timezone.now() - before)
+
+        if self.changed_files:
+            sources = [os.path.splitext(os.path.basename(file))[0].upper() for file in self.changed_files]
+            call_command('warm_timetables', *(f'--source={source}' for source in sources))
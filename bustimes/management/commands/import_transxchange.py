@@ -2,32 +2,55 @@
 Usage:
 
     ./manage.py import_transxchange EA.zip [EM.zip etc]
+
+or, to import an archive's files in several processes at once:
+
+    ./manage.py import_transxchange EA.zip --jobs 4
 """
 
+import io
 import logging
 import os
 import re
 import csv
 import yaml
+import hashlib
 import zipfile
 import xml.etree.cElementTree as ET
 import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
 from psycopg2.extras import DateRange
 from titlecase import titlecase
 from django.conf import settings
 from django.contrib.gis.geos import MultiLineString
 from django.core.management.base import BaseCommand
-from django.db import transaction, DataError, IntegrityError
+from django.db import connection, connections, transaction, DataError, IntegrityError
 from django.db.models import Exists, OuterRef, Q
 from django.utils import timezone
 from busstops.models import Operator, Service, DataSource, StopPoint, StopUsage, ServiceCode, ServiceLink
-from ...models import Route, Calendar, CalendarDate, Trip, StopTime, Note, Garage
-from ...timetables import get_stop_usages
+from ...models import (Route, Calendar, CalendarDate, Trip, StopTime, Note, Garage, JourneyPatternStop,
+                       create_journey_patterns, prefetch_stop_times)
+from ...bulk_load import save_trips
+from ...timetables import add_stop_pattern, align_stop_usages, expire_timetables
+from ...trip_diff import TripDiff, describe_counts
 from transxchange.txc import TransXChange, sanitize_description_part, Grouping
 
 
 logger = logging.getLogger(__name__)
 
+# for get_file_keys, which looks for line names and service codes without parsing the XML
+LINE_NAME_REGEX = re.compile(rb'<(?:\w+:)?LineName>([^<]*)<')
+SERVICE_CODE_REGEX = re.compile(rb'<(?:\w+:)?ServiceCode>([^<]*)<')
+# a Postgres advisory lock, for worker processes (with --jobs) creating objects that other workers might also create
+SHARED_OBJECTS_LOCK = 18791
+# with --jobs, the Command, set up in the main process and copied into each worker process when it's forked
+worker_command = None
+# each worker process's own open ZipFile
+worker_archive = None
+
 """
 _________________________________________________________________________________________________
 | AllBankHolidays | AllHolidaysExceptChristmas | Holidays             | NewYearsDay              |
@@ -123,6 +146,72 @@ def get_service_code(filename):
             return '-'.join(parts[:-1])
 
 
+def get_file_keys(archive, filename):
+    """Returns a set of a file's line names and service codes - the things handle_service matches existing Services by
+    """
+    with archive.open(filename) as open_file:
+        data = open_file.read()
+    keys = {('line', name.split(b'|')[0].strip().lower()) for name in LINE_NAME_REGEX.findall(data)}
+    keys.update(('service', code.strip().decode()) for code in SERVICE_CODE_REGEX.findall(data))
+    keys.add(('service', get_service_code(filename) or filename))
+    return keys
+
+
+def get_file_groups(archive, filenames):
+    """Groups an archive's files so that files that might be about the same Service - with a line name or service
+    code in common - will be imported in order, by the same worker process.
+    That way, no two workers can both create the same new Service, or each replace a Service's operators with their
+    own. Largest groups first, so they don't hold things up at the end
+    """
+    parents = list(range(len(filenames)))  # a disjoint-set forest of the files' indices
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    first_files = {}  # key: index of the first file with that key
+    for i, filename in enumerate(filenames):
+        for key in get_file_keys(archive, filename):
+            if key in first_files:
+                parents[find(i)] = find(first_files[key])
+            else:
+                first_files[key] = i
+
+    groups = {}
+    for i, filename in enumerate(filenames):
+        groups.setdefault(find(i), []).append(filename)
+    return sorted(
+        groups.values(),
+        key=lambda group: sum(archive.getinfo(filename).file_size for filename in group),
+        reverse=True
+    )
+
+
+def set_up_worker(archive_name):
+    global worker_archive
+
+    worker_archive = zipfile.ZipFile(archive_name)
+
+
+def handle_files_in_worker(filenames):
+    """Imports some files in a worker process, and returns what the main process needs to know about them"""
+    command = worker_command
+    command.service_ids = set()
+    command.unchanged_service_ids = set()
+    command.route_ids = set()
+    command.missing_operators = []
+    command.undefined_holidays = set()
+    command.file_counts = Counter()
+    command.trip_counts = Counter()
+
+    command.handle_files(worker_archive, filenames)
+
+    return (command.service_ids, command.unchanged_service_ids, command.route_ids, command.missing_operators,
+            command.undefined_holidays, command.file_counts, command.trip_counts)
+
+
 def get_operator_name(operator_element):
     "Given an Operator element, returns the operator name or None"
 
@@ -170,10 +259,13 @@ def get_open_data_operators():
 
 
 class Command(BaseCommand):
+    jobs = 1
+
     @staticmethod
     def add_arguments(parser):
         parser.add_argument('archives', nargs=1, type=str)
         parser.add_argument('files', nargs='*', type=str)
+        parser.add_argument('--jobs', type=int, default=1, help='number of worker processes')
 
     def set_up(self):
         self.service_descriptions = {}
@@ -183,9 +275,15 @@ class Command(BaseCommand):
         self.notes = {}
         self.corrections = {}
         self.garages = {}
+        self.file_hash = ''  # of the file being imported
+        self.unchanged_service_ids = set()
+        self.trip_counts = Counter()  # trips and stop times written and left alone, for debrief
+        self.route_patterns = {}  # route id: (service id, [(inbound, stop times)]), for get_stop_usages
+        self.service_stop_patterns = {}  # service id: [[stops]], for update_geometries
 
     def handle(self, *args, **options):
         self.set_up()
+        self.jobs = options['jobs']
 
         self.open_data_operators, self.incomplete_operators = get_open_data_operators()
 
@@ -196,8 +294,10 @@ class Command(BaseCommand):
 
     def debrief(self):
         """
-        Log the names of any undefined public holiday names, and operators that couldn't be found
+        Log the names of any undefined public holiday names, and operators that couldn't be found,
+        and how many trips were written
         """
+        logger.info(describe_counts(self.trip_counts))
         if self.undefined_holidays:
             print(self.undefined_holidays)
         for operator in self.missing_operators:
@@ -297,12 +397,31 @@ class Command(BaseCommand):
 
     def mark_old_services_as_not_current(self):
         self.source.route_set.exclude(id__in=self.route_ids).delete()
-        old_services = self.source.service_set.filter(current=True, route=None).exclude(id__in=self.service_ids)
+        old_services = self.source.service_set.filter(current=True, route=None).exclude(
+            id__in=self.service_ids | self.unchanged_service_ids
+        )
         old_services.update(current=False)
 
+    def get_imported_files(self):
+        """Returns a dict of the source's filenames to lists of (file hash, route id, service id) tuples
+        for the routes that were imported from them.
+        A route that has ended gets no hash, so its file is imported again (which gets rid of the route)
+        """
+        files = {}
+        today = self.source.datetime.date()
+        for code, file_hash, route_id, service_id, end_date in self.source.route_set.values_list(
+            'code', 'file_hash', 'id', 'service', 'end_date'
+        ):
+            if end_date is not None and end_date < today:
+                file_hash = None
+            files.setdefault(code.split('#')[0], []).append((file_hash, route_id, service_id))
+        return files
+
     def handle_archive(self, archive_name, filenames):
         self.service_ids = set()
+        self.unchanged_service_ids = set()  # of services in files skipped by handle_files
         self.route_ids = set()
+        self.file_counts = Counter()
 
         self.set_region(archive_name)
 
@@ -311,18 +430,23 @@ class Command(BaseCommand):
         with open(os.path.join(settings.DATA_DIR, 'services.yaml')) as open_file:
             self.corrections = yaml.load(open_file, Loader=yaml.FullLoader)
 
+        # (if only some files have been asked for, import them even if they haven't changed)
+        self.imported_files = {} if filenames else self.get_imported_files()
+
         with zipfile.ZipFile(archive_name) as archive:
 
             self.set_service_descriptions(archive)
 
-            for filename in filenames or archive.namelist():
-                if filename.endswith('.xml'):
-                    with archive.open(filename) as open_file:
-                        with transaction.atomic():
-                            try:
-                                self.handle_file(open_file, filename)
-                            except (AttributeError, DataError) as error:
-                                logger.error(error, exc_info=True)
+            members = [filename for filename in filenames or archive.namelist() if filename.endswith('.xml')]
+
+            start = perf_counter()
+            if self.jobs > 1:
+                self.handle_files_in_parallel(archive_name, get_file_groups(archive, members))
+            else:
+                self.handle_files(archive, members)
+            logger.info('%s: %s files in %.1f seconds (%s jobs) - %s unchanged, %s changed, %s new',
+                        archive_name, len(members), perf_counter() - start, self.jobs,
+                        self.file_counts['unchanged'], self.file_counts['changed'], self.file_counts['new'])
 
         self.update_geometries()
 
@@ -334,9 +458,100 @@ class Command(BaseCommand):
 
         StopPoint.objects.filter(active=False, service__current=True).update(active=True)
 
+    def handle_files(self, archive, filenames):
+        """Imports files from an archive - except ones whose contents haven't changed since they were last imported.
+        Those files' routes are left alone, but still count as current
+        """
+        for filename in filenames:
+            with archive.open(filename) as open_file:
+                data = open_file.read()
+
+            file_hash = hashlib.sha1(data).hexdigest()
+            routes = self.imported_files.get(filename)
+            if routes and all(route_hash == file_hash for route_hash, _, _ in routes):
+                self.file_counts['unchanged'] += 1
+                for _, route_id, service_id in routes:
+                    self.route_ids.add(route_id)
+                    self.unchanged_service_ids.add(service_id)
+                continue
+            self.file_counts['changed' if routes else 'new'] += 1
+
+            self.file_hash = file_hash
+            with transaction.atomic():
+                try:
+                    self.handle_file(io.BytesIO(data), filename)
+                except (AttributeError, DataError) as error:
+                    logger.error(error, exc_info=True)
+
+    def handle_files_in_parallel(self, archive_name, groups):
+        """Imports groups of files in self.jobs worker processes, and merges what they've done into
+        self.service_ids, self.route_ids, etc, so everything afterwards can carry on as if it had all happened here.
+
+        (Each worker has its own calendar_cache, notes and garages, filled as it goes along)
+        """
+        global worker_command
+
+        worker_command = self
+        connections.close_all()  # so the workers don't share this process's database connection
+
+        with ProcessPoolExecutor(
+            max_workers=self.jobs, mp_context=get_context('fork'), initializer=set_up_worker, initargs=(archive_name,)
+        ) as executor:
+            for (
+                service_ids, unchanged_service_ids, route_ids, missing_operators, undefined_holidays, file_counts,
+                trip_counts
+            ) in executor.map(handle_files_in_worker, groups):
+                self.service_ids |= service_ids
+                self.unchanged_service_ids |= unchanged_service_ids
+                self.route_ids |= route_ids
+                self.missing_operators += missing_operators
+                self.undefined_holidays |= undefined_holidays
+                self.file_counts += file_counts
+                self.trip_counts += trip_counts
+
+        worker_command = None
+
+    def lock_shared_objects(self):
+        """With --jobs, waits for (and then holds, until the end of the current file's transaction)
+        a lock on creating stops, notes and garages, which another worker process might be about to create too.
+        Returns whether it did
+        """
+        if self.jobs > 1:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [SHARED_OBJECTS_LOCK])
+            return True
+
     def update_geometries(self):
         for service in Service.objects.filter(id__in=self.service_ids):
-            service.update_geometry()
+            service.update_geometry(self.service_stop_patterns.get(service.id))
+        self.route_patterns = {}
+        self.service_stop_patterns = {}
+        # don't show any cached timetables built from old data
+        expire_timetables(self.service_ids)
+
+    def get_stop_usages(self, service):
+        """Returns the service's outbound and inbound stop times, in order (see align_stop_usages), without reading back
+        the trips of routes that handle_journeys has imported - only the trips of the service's other routes (if any)
+        are read from the database.
+
+        Also keeps the service's trips' stops, so update_geometries needn't read the trips either
+        """
+        route_ids = []
+        patterns = []
+        for route_id, (service_id, route_patterns) in self.route_patterns.items():
+            if service_id == service.id:
+                route_ids.append(route_id)
+                patterns += route_patterns
+
+        other_trips = Trip.objects.filter(route__service=service).exclude(route__in=route_ids)
+        other_trips = other_trips.prefetch_related(*prefetch_stop_times(('stop',), stop__isnull=False))
+        patterns += [(trip.inbound, trip.get_stop_times()) for trip in other_trips]
+
+        self.service_stop_patterns[service.id] = [
+            [stop_time.stop for stop_time in stop_times] for _, stop_times in patterns
+        ]
+
+        return align_stop_usages(patterns)
 
     def get_calendar(self, operating_profile, operating_period):
         calendar_dates = [
@@ -472,21 +687,38 @@ class Command(BaseCommand):
             elif day == 6:
                 calendar.sun = True
 
-        calendar.save()
-        for date in calendar_dates:
-            date.calendar = calendar
-        CalendarDate.objects.bulk_create(calendar_dates)
+        # not saved yet - by save_calendars, if any new trips turn out to need it
+        calendar.compile(calendar_dates)
 
         self.calendar_cache[calendar_hash] = calendar
 
         return calendar
 
-    def handle_journeys(self, route, stops, journeys, txc_service, line_id):
+    @staticmethod
+    def save_calendars(trips):
+        """Saves the calendars (and their CalendarDates) of some trips, if they haven't been saved already.
+        (So a calendar that's only needed by trips that turn out to be the same as existing trips is never saved)
+        """
+        calendars = {id(trip.calendar): trip.calendar for trip in trips if trip.calendar.pk is None}
+        for calendar in calendars.values():
+            calendar_dates = calendar.compiled_calendar_dates
+            calendar.save()
+            for date in calendar_dates:
+                date.calendar = calendar
+            CalendarDate.objects.bulk_create(calendar_dates)
+        for trip in trips:
+            trip.calendar = trip.calendar  # set calendar_id
+
+    def handle_journeys(self, route, stops, journeys, txc_service, line_id, trip_diff):
+        """Saves a route's trips - except ones that trip_diff matches to existing trips, which are left alone
+        (or updated in place). Existing trips that don't match any of the new ones are deleted
+        """
         default_calendar = None
 
         stop_times = []
 
         trips = []
+        stop_times_by_trip = []
         notes_by_trip = []
 
         for journey in journeys:
@@ -515,6 +747,7 @@ class Command(BaseCommand):
             if journey.garage_ref:
                 trip.garage = self.garages[journey.garage_ref]
 
+            trip_stop_times = []
             blank = False
             for i, cell in enumerate(journey.get_times()):
                 timing_status = cell.stopusage.timingstatus
@@ -550,11 +783,12 @@ class Command(BaseCommand):
                     if type(stops[atco_code]) is str:
                         stop_time.stop_code = stops[atco_code]
                     else:
-                        stop_time.stop_id = cell.stopusage.stop.atco_code
+                        stop_time.stop = stops[atco_code]
                         trip.destination_id = stop_time.stop_id
                 else:
                     stop_time.stop_code = atco_code
                 stop_times.append(stop_time)
+                trip_stop_times.append(stop_time)
 
             # last stop
             if not stop_time.arrival:
@@ -562,6 +796,7 @@ class Command(BaseCommand):
                 stop_time.departure = None
             trip.end = stop_time.departure_or_arrival()
             trips.append(trip)
+            stop_times_by_trip.append(trip_stop_times)
 
             if blank and any(stop_time.timing_status for stop_time in stop_times):
                 # not all timing statuses are blank - mark any blank ones as minor
@@ -575,20 +810,36 @@ class Command(BaseCommand):
                 if note_cache_key in self.notes:
                     note = self.notes[note_cache_key]
                 else:
-                    note, _ = Note.objects.get_or_create(code=note or '', text=journey.notes[note])
+                    try:
+                        note = Note.objects.get(code=note or '', text=journey.notes[note])
+                    except Note.DoesNotExist:
+                        if self.lock_shared_objects():
+                            # another worker process might have created it in the meantime
+                            note, _ = Note.objects.get_or_create(code=note or '', text=journey.notes[note])
+                        else:
+                            note = Note.objects.create(code=note or '', text=journey.notes[note])
                     self.notes[note_cache_key] = note
                 notes.append(note)
             notes_by_trip.append(notes)
 
-        Trip.objects.bulk_create(trips)
+        # for get_stop_usages
+        patterns = {}
+        for trip, trip_stop_times in zip(trips, stop_times_by_trip):
+            add_stop_pattern(patterns, trip.inbound, trip_stop_times)
+        self.route_patterns[route.id] = (route.service_id, list(patterns.values()))
 
-        for i, trip in enumerate(trips):
-            if notes_by_trip[i]:
-                trip.notes.set(notes_by_trip[i])
+        trips, stop_times_by_trip, notes_by_trip = trip_diff.update(trips, stop_times_by_trip, notes_by_trip)
+        trip_diff.delete_unmatched()
+        self.trip_counts += trip_diff.counts
+        self.save_calendars(trips)
 
-        for stop_time in stop_times:
-            stop_time.trip = stop_time.trip  # set trip_id
-        StopTime.objects.bulk_create(stop_times)
+        if settings.COMPACT_STOP_TIMES:
+            create_journey_patterns(route, list(zip(trips, stop_times_by_trip)))
+            stop_times = []  # stored as JourneyPatternStops instead
+        else:
+            stop_times = [stop_time for trip_stop_times in stop_times_by_trip for stop_time in trip_stop_times]
+
+        save_trips(trips, stop_times, notes_by_trip)
 
     def get_description(self, txc_service):
         description = txc_service.description
@@ -713,6 +964,9 @@ class Command(BaseCommand):
 
                 if len(transxchange.services) == 1:
                     has_stop_time = Exists(StopTime.objects.filter(stop__in=stops, trip__route__service=OuterRef('id')))
+                    has_stop_time |= Exists(
+                        JourneyPatternStop.objects.filter(stop__in=stops, pattern__route__service=OuterRef('id'))
+                    )
                     has_stop_usage = Exists(StopUsage.objects.filter(stop__in=stops, service=OuterRef('id')))
                     has_no_route = ~Exists(Route.objects.filter(service=OuterRef('id')))
                     existing = existing.filter(has_stop_time | (has_stop_usage & has_no_route))
@@ -797,7 +1051,10 @@ class Command(BaseCommand):
                 else:
                     if self.source.name in {'Oxford Bus Company', 'Go South West'}:
                         pass
-                    elif service.id in self.service_ids or all(o.parent == 'Go South Coast' for o in operators):
+                    elif (
+                        service.id in self.service_ids or service.id in self.unchanged_service_ids
+                        or all(o.parent == 'Go South Coast' for o in operators)
+                    ):
                         service.operator.add(*operators)
                     else:
                         service.operator.set(operators)
@@ -834,7 +1091,8 @@ class Command(BaseCommand):
                 'dates': txc_service.operating_period.dates(),
                 'service': service,
                 'revision_number': transxchange.attributes['RevisionNumber'],
-                'service_code': txc_service.service_code
+                'service_code': txc_service.service_code,
+                'file_hash': self.file_hash,
             }
             if description:
                 route_defaults['description'] = description
@@ -880,15 +1138,14 @@ class Command(BaseCommand):
             route, route_created = Route.objects.update_or_create(route_defaults,
                                                                   source=self.source, code=route_code)
             self.route_ids.add(route.id)
-            if not route_created:
-                # if 'opendata.ticketer' in self.source.url and route.service_id == service_id:
-                #     continue
-                route.trip_set.all().delete()
+            # if 'opendata.ticketer' in self.source.url and route.service_id == service_id:
+            #     continue
+            trip_diff = TripDiff(None if route_created else route.trip_set.all())
 
-            self.handle_journeys(route, stops, journeys, txc_service, line.id)
+            self.handle_journeys(route, stops, journeys, txc_service, line.id, trip_diff)
 
             service.stops.clear()
-            outbound, inbound = get_stop_usages(Trip.objects.filter(route__service=service))
+            outbound, inbound = self.get_stop_usages(service)
 
             changed_fields = []
 
@@ -957,8 +1214,7 @@ class Command(BaseCommand):
                     if not ServiceLink.objects.filter(**kwargs).exists():
                         ServiceLink.objects.create(**kwargs, how='also')
 
-    @staticmethod
-    def do_stops(transxchange_stops):
+    def do_stops(self, transxchange_stops):
         stops = StopPoint.objects.in_bulk(transxchange_stops.keys())
         stops_to_create = {}
         for atco_code, stop in transxchange_stops.items():
@@ -968,6 +1224,12 @@ class Command(BaseCommand):
                 else:
                     stops_to_create[atco_code] = StopPoint(atco_code=atco_code, common_name=str(stop)[:48], active=True)
 
+        if stops_to_create and self.lock_shared_objects():
+            # another worker process might have created some of them in the meantime
+            for atco_code, stop in StopPoint.objects.in_bulk(stops_to_create.keys()).items():
+                stops[atco_code] = stop
+                del stops_to_create[atco_code]
+
         if stops_to_create:
             StopPoint.objects.bulk_create(stops_to_create.values())
             stops = {**stops, **stops_to_create}
@@ -988,7 +1250,10 @@ class Command(BaseCommand):
                 try:
                     garage = Garage.objects.get(code=garage_code, name=name)
                 except Garage.DoesNotExist:
-                    garage = Garage.objects.create(code=garage_code, name=name)
+                    if self.lock_shared_objects():
+                        garage, _ = Garage.objects.get_or_create(code=garage_code, name=name)
+                    else:
+                        garage = Garage.objects.create(code=garage_code, name=name)
                 self.garages[garage_code] = garage
 
         for txc_service in transxchange.services.values():
@@ -0,0 +1,38 @@
+"""Build and cache the timetables of current services for the next few days,
+so the first visitor after an import doesn't have to wait.
+
+    ./manage.py warm_timetables [--days 7] [--source EA --source SW]
+"""
+
+import datetime
+import logging
+from django.core.management.base import BaseCommand
+from django.utils.timezone import localdate
+from busstops.models import Service
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--days', type=int, default=7)
+        parser.add_argument('--source', action='append', help='only services from these data sources (by name)')
+
+    def handle(self, days, source, **options):
+        services = Service.objects.filter(current=True, show_timetable=True, timetable_wrong=False)
+        if source:
+            services = services.filter(source__name__in=source)
+        services = services.select_related('source').defer('geometry', 'search_vector')
+
+        today = localdate()
+        dates = [None] + [today + datetime.timedelta(days=i) for i in range(days)]
+
+        for service in services.iterator():
+            parallel = service.get_linked_services()
+            for date in dates:
+                try:
+                    service.get_timetable(date, parallel)
+                except Exception as e:
+                    logger.error(e, exc_info=True)
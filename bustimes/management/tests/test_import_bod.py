@@ -10,6 +10,7 @@ from django.test import TestCase, override_settings
 from django.core.management import call_command
 from busstops.models import Region, Operator, DataSource, OperatorCode, Service, ServiceCode
 from vehicles.models import VehicleJourney
+from vehicles.management.trip_index import TripIndex
 from ...models import Route
 
 
@@ -133,6 +134,18 @@ class ImportBusOpenDataTest(TestCase):
         trip = journey.get_trip()
         self.assertIsNone(trip)
 
+        # the same, but from a TripIndex
+        trip_index = TripIndex()
+        with self.assertNumQueries(1):
+            self.assertIsNone(trip_index.get_trip(journey))
+        journey.code = '0915'
+        with self.assertNumQueries(0):
+            self.assertEqual(trip_index.get_trip(journey).ticket_machine_code, '1')
+        journey.code = '1'
+        with self.assertNumQueries(0):
+            self.assertEqual(trip_index.get_trip(journey).ticket_machine_code, '1')
+        self.assertEqual((trip_index.hits, trip_index.misses), (2, 1))
+
     @override_settings(STAGECOACH_OPERATORS=[('EA', 'sccm', 'Stagecoach East', ['SCHU', 'SCPB'])])
     @time_machine.travel(datetime.datetime(2020, 6, 10))
     @patch('bustimes.management.commands.import_transxchange.BANK_HOLIDAYS', {
@@ -162,7 +175,7 @@ class ImportBusOpenDataTest(TestCase):
                     'bustimes.management.commands.import_bod.download_if_changed',
                     return_value=(True, parse_datetime('2020-06-10T12:00:00+01:00')),
                 ) as download_if_changed:
-                    with self.assertNumQueries(79):
+                    with self.assertNumQueries(68):
                         with patch('builtins.print') as mocked_print:
                             call_command('import_bod', 'stagecoach')
                     download_if_changed.assert_called_with(path, 'https://opendata.stagecoachbus.com/' + archive_name)
@@ -171,7 +184,7 @@ class ImportBusOpenDataTest(TestCase):
                     with self.assertNumQueries(1):
                         call_command('import_bod', 'stagecoach')
 
-                    with self.assertNumQueries(76):
+                    with self.assertNumQueries(51):
                         with patch('builtins.print') as mocked_print:
                             call_command('import_bod', 'stagecoach', 'sccm')
                     mocked_print.assert_called_with(undefined_holidays)
@@ -188,7 +201,7 @@ class ImportBusOpenDataTest(TestCase):
         self.assertEqual(1, Service.objects.count())
         self.assertEqual(2, Route.objects.count())
 
-        with self.assertNumQueries(14):
+        with self.assertNumQueries(15):
             response = self.client.get('/services/904-huntingdon-peterborough')
         self.assertContains(response, '<option selected value="2020-08-31">Monday 31 August 2020</option>')
         self.assertContains(response, '<a href="/operators/huntingdon">Huntingdon</a>')
@@ -11,6 +11,7 @@ from django.core.management import call_command
 from django.contrib.gis.geos import Point
 from busstops.models import Region, StopPoint, Service, Operator, OperatorCode, DataSource, ServiceLink
 from ...models import Route, Trip, Calendar, CalendarDate
+from ...timetables import Timetable, expire_timetables
 from ..commands import import_transxchange
 
 
@@ -107,6 +108,33 @@ class ImportTransXChangeTest(TestCase):
         self.assertEqual(2, len(timetable.groupings[0].rows[1].times))
         self.assertEqual(2, len(timetable.groupings[0].rows[20].times))
 
+        # cached timetable
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            timetable = route.service.get_timetable()
+            # (patch __init__, not the class itself, which pickling and unpickling timetables needs)
+            with patch.object(Timetable, '__init__', autospec=True, side_effect=Timetable.__init__) as mocked_init:
+                cached_timetable = route.service.get_timetable()
+                mocked_init.assert_not_called()
+            self.assertEqual(len(cached_timetable.groupings[0].rows), 21)
+            self.assertEqual(
+                str(cached_timetable.groupings[0].rows[1].times), str(timetable.groupings[0].rows[1].times)
+            )
+
+            expire_timetables([route.service_id])
+            with patch.object(Timetable, '__init__', autospec=True, side_effect=Timetable.__init__) as mocked_init:
+                route.service.get_timetable()
+                mocked_init.assert_called_once()
+
+            # a timetable for a specific date isn't used the next day, when its date options would be out of date
+            day = date(2016, 10, 5)
+            timetable = route.service.get_timetable(day)
+            self.assertEqual(timetable.today, date(2016, 10, 3))
+            with time_machine.travel('4 October 2016'):
+                with patch.object(Timetable, '__init__', autospec=True, side_effect=Timetable.__init__) as mocked_init:
+                    timetable = route.service.get_timetable(day)
+                    mocked_init.assert_called_once()
+            self.assertEqual(timetable.today, date(2016, 10, 4))
+
         # Test operating profile days of non operation
         res = self.client.get(route.service.get_absolute_url() + '?date=2016-12-28')
         timetable = res.context_data['timetable']
@@ -671,8 +699,17 @@ class ImportTransXChangeTest(TestCase):
                                            'Megabus_Megabus14032016 163144_MEGA_M12.xml'))
                 self.write_file_to_zipfile(open_zipfile, 'IncludedServices.csv')
             call_command('import_transxchange', zipfile_path)
+            route_ids = set(Route.objects.values_list('id', flat=True))
+
+            # unchanged files aren't imported again
+            with self.assertLogs('bustimes.management.commands.import_transxchange', 'INFO') as logs:
+                call_command('import_transxchange', zipfile_path)
+            self.assertTrue(any('2 unchanged, 0 changed, 0 new' in line for line in logs.output))
+            self.assertEqual(set(Route.objects.values_list('id', flat=True)), route_ids)
+
             # test re-importing a previously imported service again
-            call_command('import_transxchange', zipfile_path)
+            call_command('import_transxchange', zipfile_path,
+                         os.path.join('NCSD_TXC', 'Megabus_Megabus14032016 163144_MEGA_M11A.xml'))
 
         # M11A
 
@@ -756,6 +793,25 @@ class ImportTransXChangeTest(TestCase):
             'ArrivaCymru51S-Rhyl-StBrigid`s-Denbigh1_TXC_2016108-0319_DGAO051S.xml')
         )
 
+    def test_get_file_groups(self):
+        filenames = ['ea_21-13B-B-y08-1.xml', 'ea_20-12-_-y08-1.xml', 'SVRABAO421.xml']
+        with TemporaryDirectory() as directory:
+            with zipfile.ZipFile(os.path.join(directory, 'EA.zip'), 'a') as archive:
+                for filename in filenames:
+                    self.write_file_to_zipfile(archive, filename)
+                # another part of the same service
+                archive.write(os.path.join(FIXTURES_DIR, filenames[0]), 'ea_21-13B-B-y08-2.xml')
+                # might match the same existing service as ea_20-12-_-y08-1.xml
+                archive.writestr('SVRABAO012.xml', '<Lines><Line id="1"><LineName> 12 </LineName></Line></Lines>')
+
+                groups = import_transxchange.get_file_groups(
+                    archive, filenames + ['ea_21-13B-B-y08-2.xml', 'SVRABAO012.xml']
+                )
+
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(groups[0], ['ea_21-13B-B-y08-1.xml', 'ea_21-13B-B-y08-2.xml'])  # the biggest
+        self.assertEqual(sorted(groups[1:]), [['SVRABAO421.xml'], ['ea_20-12-_-y08-1.xml', 'SVRABAO012.xml']])
+
     def test_get_operator_name(self):
         blue_triangle_element = ET.fromstring("""
             <Operator id='OId_BE'>
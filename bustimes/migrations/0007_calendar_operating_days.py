@@ -0,0 +1,102 @@
+from django.db import migrations, models
+
+
+def get_operating_days(calendar, calendar_dates):
+    """Compile a calendar and its CalendarDates into an (operating_days, operating_weekdays) pair.
+    (A copy of bustimes.models.get_operating_days as it was when this migration was written)
+
+    Bit n of operating_days (bit n % 8 of byte n // 8, the same order as PostgreSQL's get_bit) is set if the calendar
+    runs n days after its start date. Beyond the end of operating_days, the calendar runs on the weekdays whose bits
+    (Monday = bit 0) are set in operating_weekdays.
+    """
+    start_date = calendar.start_date
+    end_date = calendar.end_date
+    weekdays = [calendar.mon, calendar.tue, calendar.wed, calendar.thu, calendar.fri, calendar.sat, calendar.sun]
+    only_certain_dates = any(date.operation and not date.special for date in calendar_dates)
+
+    # after the last CalendarDate boundary, only the open-ended CalendarDates apply - and they apply to every day
+    open_ended = [date for date in calendar_dates if date.end_date is None]
+    if any(not date.operation for date in open_ended):
+        operating_weekdays = 0
+    elif only_certain_dates and not any(date.operation for date in open_ended):
+        operating_weekdays = 0
+    else:
+        every_day = any(date.operation and date.special for date in open_ended)
+        operating_weekdays = sum(1 << day for day, value in enumerate(weekdays) if value or every_day)
+
+    boundaries = [date.start_date for date in calendar_dates]
+    boundaries += [date.end_date for date in calendar_dates if date.end_date is not None]
+    if not boundaries:
+        return b'', operating_weekdays
+    last_date = max(boundaries)
+    if end_date and end_date < last_date:
+        last_date = end_date
+    length = (last_date - start_date).days + 1
+    if length <= 0:
+        return b'', operating_weekdays
+    length += -length % 8  # round up to a whole number of bytes
+
+    excluded = [False] * length
+    included = [False] * length
+    specially_included = [False] * length
+    for date in calendar_dates:
+        first = max((date.start_date - start_date).days, 0)
+        if date.end_date is None:
+            last = length - 1
+        else:
+            last = min((date.end_date - start_date).days, length - 1)
+        for i in range(first, last + 1):
+            if not date.operation:
+                excluded[i] = True
+            else:
+                included[i] = True
+                if date.special:
+                    specially_included[i] = True
+
+    bits = 0
+    first_weekday = start_date.weekday()
+    for i in range(length):
+        if (
+            not excluded[i]
+            and (included[i] or not only_certain_dates)
+            and (specially_included[i] or weekdays[(first_weekday + i) % 7])
+        ):
+            bits |= 1 << i
+    return bits.to_bytes(length // 8, 'little'), operating_weekdays
+
+
+def compile_calendars(apps, schema_editor):
+    Calendar = apps.get_model('bustimes', 'Calendar')
+    calendars = Calendar.objects.prefetch_related('calendardate_set').order_by('id')
+    last_id = 0
+    while True:
+        chunk = list(calendars.filter(id__gt=last_id)[:1000])
+        if not chunk:
+            break
+        for calendar in chunk:
+            calendar.operating_days, calendar.operating_weekdays = get_operating_days(
+                calendar, calendar.calendardate_set.all()
+            )
+        Calendar.objects.bulk_update(chunk, ['operating_days', 'operating_weekdays'])
+        last_id = chunk[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bustimes', '0006_auto_20210115_1956'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendar',
+            name='operating_days',
+            field=models.BinaryField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='calendar',
+            name='operating_weekdays',
+            field=models.PositiveSmallIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(compile_calendars, migrations.RunPython.noop),
+    ]
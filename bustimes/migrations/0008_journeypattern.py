@@ -0,0 +1,45 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import bustimes.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('busstops', '0006_auto_20201225_0004'),
+        ('bustimes', '0007_calendar_operating_days'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JourneyPattern',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bustimes.route')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='JourneyPatternStop',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stop_code', models.CharField(blank=True, max_length=255)),
+                ('arrival', bustimes.fields.SecondsField(blank=True, null=True)),
+                ('departure', bustimes.fields.SecondsField(blank=True, null=True)),
+                ('sequence', models.PositiveSmallIntegerField()),
+                ('timing_status', models.CharField(blank=True, max_length=3)),
+                ('activity', models.CharField(blank=True, max_length=16)),
+                ('pick_up', models.BooleanField(default=True)),
+                ('set_down', models.BooleanField(default=True)),
+                ('pattern', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bustimes.journeypattern')),
+                ('stop', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='busstops.stoppoint')),
+            ],
+            options={
+                'ordering': ('sequence',),
+            },
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='pattern',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='bustimes.journeypattern'),
+        ),
+    ]
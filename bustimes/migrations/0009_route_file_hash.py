@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bustimes', '0008_journeypattern'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='file_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+    ]
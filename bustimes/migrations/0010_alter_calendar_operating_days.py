@@ -0,0 +1,17 @@
+import bustimes.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bustimes', '0009_route_file_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='calendar',
+            name='operating_days',
+            field=bustimes.fields.BytesField(editable=False, null=True),
+        ),
+    ]
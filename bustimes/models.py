@@ -1,11 +1,14 @@
-from django.db.models import Q, Exists, OuterRef
+from django.db.models import Q, Prefetch
 from django.contrib.gis.db import models
 from django.contrib.postgres.fields import DateRangeField
 from django.urls import reverse
-from .fields import SecondsField
+from .fields import SecondsField, BytesField
 from .utils import format_timedelta
 
 
+to_date = models.DateField().to_python
+
+
 def get_routes(routes, when):
     routes = [route for route in routes if route.contains(when)]
 
@@ -47,31 +50,144 @@ def get_routes(routes, when):
     return routes
 
 
+def get_operating_days(calendar, calendar_dates):
+    """Compile a calendar and its CalendarDates into an (operating_days, operating_weekdays) pair.
+
+    Bit n of operating_days (bit n % 8 of byte n // 8, the same order as PostgreSQL's get_bit) is set if the calendar
+    runs n days after its start date. Beyond the end of operating_days, the calendar runs on the weekdays whose bits
+    (Monday = bit 0) are set in operating_weekdays.
+    """
+    start_date = to_date(calendar.start_date)
+    end_date = to_date(calendar.end_date)
+    weekdays = [calendar.mon, calendar.tue, calendar.wed, calendar.thu, calendar.fri, calendar.sat, calendar.sun]
+    only_certain_dates = any(date.operation and not date.special for date in calendar_dates)
+
+    # after the last CalendarDate boundary, only the open-ended CalendarDates apply - and they apply to every day
+    open_ended = [date for date in calendar_dates if date.end_date is None]
+    if any(not date.operation for date in open_ended):
+        operating_weekdays = 0
+    elif only_certain_dates and not any(date.operation for date in open_ended):
+        operating_weekdays = 0
+    else:
+        every_day = any(date.operation and date.special for date in open_ended)
+        operating_weekdays = sum(1 << day for day, value in enumerate(weekdays) if value or every_day)
+
+    boundaries = [to_date(date.start_date) for date in calendar_dates]
+    boundaries += [to_date(date.end_date) for date in calendar_dates if date.end_date is not None]
+    if not boundaries:
+        return b'', operating_weekdays
+    last_date = max(boundaries)
+    if end_date and end_date < last_date:
+        last_date = end_date
+    length = (last_date - start_date).days + 1
+    if length <= 0:
+        return b'', operating_weekdays
+    length += -length % 8  # round up to a whole number of bytes
+
+    excluded = [False] * length
+    included = [False] * length
+    specially_included = [False] * length
+    for date in calendar_dates:
+        first = max((to_date(date.start_date) - start_date).days, 0)
+        if date.end_date is None:
+            last = length - 1
+        else:
+            last = min((to_date(date.end_date) - start_date).days, length - 1)
+        for i in range(first, last + 1):
+            if not date.operation:
+                excluded[i] = True
+            else:
+                included[i] = True
+                if date.special:
+                    specially_included[i] = True
+
+    bits = 0
+    first_weekday = start_date.weekday()
+    for i in range(length):
+        if (
+            not excluded[i]
+            and (included[i] or not only_certain_dates)
+            and (specially_included[i] or weekdays[(first_weekday + i) % 7])
+        ):
+            bits |= 1 << i
+    return bits.to_bytes(length // 8, 'little'), operating_weekdays
+
+
+class OperatesOn(models.Func):
+    """A condition for filtering calendars by their compiled operating_days and operating_weekdays"""
+    output_field = models.BooleanField()
+
+    def __init__(self, date):
+        self.date = date
+        super().__init__(models.F('operating_days'), models.F('start_date'), models.F('operating_weekdays'))
+
+    def as_sql(self, compiler, connection):
+        (operating_days, start_date, operating_weekdays), _ = zip(
+            *(compiler.compile(expression) for expression in self.get_source_expressions())
+        )
+        sql = (
+            f'CASE WHEN %s - {start_date} < octet_length({operating_days}) * 8 '
+            f'THEN get_bit({operating_days}, %s - {start_date}) = 1 '
+            f'ELSE {operating_weekdays} & %s != 0 END'
+        )
+        return sql, [self.date, self.date, 1 << self.date.weekday()]
+
+
 def get_calendars(when, calendar_ids=None):
+    when = to_date(when)
     calendars = Calendar.objects.filter(Q(end_date__gte=when) | Q(end_date=None),
                                         start_date__lte=when)
-    calendar_dates = CalendarDate.objects.filter(Q(end_date__gte=when) | Q(end_date=None),
-                                                 start_date__lte=when)
     if calendar_ids is not None:
         # cunningly make the query faster
         calendars = calendars.filter(id__in=calendar_ids)
-        calendar_dates = calendar_dates.filter(calendar__in=calendar_ids)
-    exclusions = calendar_dates.filter(operation=False)
-    inclusions = calendar_dates.filter(operation=True)
-    special_inclusions = inclusions.filter(special=True)
-    only_certain_dates = Exists(CalendarDate.objects.filter(calendar=OuterRef('id'), special=False, operation=True))
-    return calendars.filter(
-        ~Q(calendardate__in=exclusions)
-    ).filter(
-        Q(~only_certain_dates) | Q(calendardate__in=inclusions)
-    ).filter(
-        Q(**{when.strftime('%a').lower(): True}) | Q(calendardate__in=special_inclusions)
+    return calendars.filter(OperatesOn(when))
+
+
+def prefetch_stop_times(select_related=(), **filters):
+    """Prefetch objects for trips' stop times, however they're stored, for Trip.get_stop_times.
+    The filters and select_related apply to both StopTimes and JourneyPatternStops
+    """
+    return (
+        Prefetch('stoptime_set', queryset=StopTime.objects.filter(**filters).select_related(*select_related)),
+        Prefetch(
+            'pattern__journeypatternstop_set',
+            queryset=JourneyPatternStop.objects.filter(**filters).select_related(*select_related)
+        )
     )
 
 
+def create_journey_patterns(route, trips):
+    """Store some trips' stop times as JourneyPatterns, instead of as StopTimes.
+
+    trips is a list of (trip, stop_times) pairs, where the trips and StopTimes haven't been saved yet.
+    Trips whose stop times only differ by start time share a pattern. Each trip's pattern is set, but the caller
+    still needs to save the trips.
+    """
+    patterns = {}
+    pattern_stops = []
+    for trip, stop_times in trips:
+        stops = [JourneyPatternStop.from_stop_time(stop_time, trip.start) for stop_time in stop_times]
+        key = tuple(stop.get_key() for stop in stops)
+        pattern = patterns.get(key)
+        if pattern is None:
+            pattern = patterns[key] = JourneyPattern(route=route)
+            pattern_stops.append((pattern, stops))
+        trip.pattern = pattern
+
+    JourneyPattern.objects.bulk_create(patterns.values())
+    for pattern, stops in pattern_stops:
+        for stop in stops:
+            stop.pattern = pattern
+    JourneyPatternStop.objects.bulk_create(stop for _, stops in pattern_stops for stop in stops)
+    for trip, _ in trips:
+        trip.pattern = trip.pattern  # set pattern_id
+
+
 class Route(models.Model):
     source = models.ForeignKey('busstops.DataSource', models.CASCADE)
     code = models.CharField(max_length=255)  # qualified filename
+    # of the file's contents, so an unchanged file needn't be imported again
+    file_hash = models.CharField(max_length=40, blank=True, editable=False)
     service_code = models.CharField(max_length=255, blank=True)
     registration = models.ForeignKey('vosa.Registration', models.SET_NULL, null=True, blank=True)
     line_brand = models.CharField(max_length=255, blank=True)
@@ -127,6 +243,8 @@ class Calendar(models.Model):
     end_date = models.DateField(null=True, blank=True)
     dates = DateRangeField(null=True)
     summary = models.CharField(max_length=255, blank=True)
+    operating_days = BytesField(null=True, editable=False)
+    operating_weekdays = models.PositiveSmallIntegerField(null=True, editable=False)
 
     contains = Route.contains
 
@@ -135,6 +253,33 @@ class Calendar(models.Model):
             ('start_date', 'end_date'),
         )
 
+    # the CalendarDates last passed to compile(), which might not have been saved yet
+    compiled_calendar_dates = None
+
+    def save(self, *args, **kwargs):
+        """Recompiles operating_days and operating_weekdays (so they can't go stale), then saves"""
+        calendar_dates = self.compiled_calendar_dates
+        if calendar_dates is None:
+            calendar_dates = [] if self._state.adding else self.calendardate_set.all()
+        self.compile(calendar_dates)
+        self.compiled_calendar_dates = None
+        super().save(*args, **kwargs)
+
+    def compile(self, calendar_dates):
+        """Update operating_days and operating_weekdays (but don't save).
+        The next save() will use the same calendar_dates, so they needn't have been saved yet
+        """
+        self.operating_days, self.operating_weekdays = get_operating_days(self, calendar_dates)
+        self.compiled_calendar_dates = calendar_dates
+
+    def runs_on(self, date):
+        if not self.contains(date):
+            return False
+        offset = (date - self.start_date).days
+        if offset < len(self.operating_days) * 8:
+            return self.operating_days[offset // 8] >> offset % 8 & 1 == 1
+        return self.operating_weekdays >> date.weekday() & 1 == 1
+
     def is_sufficiently_simple(self, future):
         if self.summary or all(date.start_date > future for date in self.calendardate_set.all()):
             if str(self):
@@ -142,6 +287,9 @@ class Calendar(models.Model):
         return False
 
     def allows(self, date):
+        if self.operating_weekdays is not None:
+            return self.runs_on(date)
+
         if not self.contains(date):
             return False
 
@@ -227,10 +375,19 @@ class Trip(models.Model):
     start = SecondsField()
     end = SecondsField()
     garage = models.ForeignKey('Garage', models.SET_NULL, null=True, blank=True)
+    pattern = models.ForeignKey('JourneyPattern', models.CASCADE, null=True, blank=True)
 
     def __str__(self):
         return format_timedelta(self.start)
 
+    def get_stop_times(self):
+        """This trip's StopTimes - either actual ones, or ones worked out from the trip's JourneyPattern"""
+        if self.pattern_id is None:
+            return self.stoptime_set.all()
+        if not hasattr(self, '_stop_times'):
+            self._stop_times = [stop.get_stop_time(self) for stop in self.pattern.journeypatternstop_set.all()]
+        return self._stop_times
+
     def start_time(self):
         return format_timedelta(self.start)
 
@@ -250,8 +407,8 @@ class Trip(models.Model):
         else:
             a_time = a.start
             b_time = b.start
-            a_times = a.stoptime_set.all()
-            b_times = b.stoptime_set.all()
+            a_times = a.get_stop_times()
+            b_times = b.get_stop_times()
             if a_times and b_times and a_times[0].get_key() != b_times[0].get_key():
                 if a.destination_id == b.destination_id:
                     a_time = a.end
@@ -278,6 +435,7 @@ class Trip(models.Model):
         new_trip.start += difference
         new_trip.end += difference
         new_trip.save()
+        # (if the trip has a pattern, times will be empty, and the new trip can share the pattern)
         for time in times:
             time.id = None
             time.arrival += difference
@@ -334,6 +492,54 @@ class StopTime(models.Model):
         return self.timing_status == 'OTH'
 
 
+class JourneyPattern(models.Model):
+    """A sequence of stops and run times, shared by trips that only differ by start time.
+    (A more compact alternative to giving each trip its own StopTimes)
+    """
+    route = models.ForeignKey(Route, models.CASCADE)
+
+
+class JourneyPatternStop(models.Model):
+    """Like a StopTime, but with arrival and departure times relative to the trip's start"""
+    pattern = models.ForeignKey(JourneyPattern, models.CASCADE)
+    stop_code = models.CharField(max_length=255, blank=True)
+    stop = models.ForeignKey('busstops.StopPoint', models.SET_NULL, null=True, blank=True)
+    arrival = SecondsField(null=True, blank=True)
+    departure = SecondsField(null=True, blank=True)
+    sequence = models.PositiveSmallIntegerField()
+    timing_status = models.CharField(max_length=3, blank=True)
+    activity = models.CharField(max_length=16, blank=True)
+    pick_up = models.BooleanField(default=True)
+    set_down = models.BooleanField(default=True)
+
+    copied_fields = ('stop_code', 'stop_id', 'sequence', 'timing_status', 'activity', 'pick_up', 'set_down')
+
+    class Meta:
+        ordering = ('sequence',)
+
+    @classmethod
+    def from_stop_time(cls, stop_time, start):
+        stop = cls(**{field: getattr(stop_time, field) for field in cls.copied_fields})
+        if stop_time.arrival is not None:
+            stop.arrival = stop_time.arrival - start
+        if stop_time.departure is not None:
+            stop.departure = stop_time.departure - start
+        return stop
+
+    def get_key(self):
+        return tuple(getattr(self, field) for field in self.copied_fields) + (self.arrival, self.departure)
+
+    def get_stop_time(self, trip):
+        stop_time = StopTime(trip=trip, **{field: getattr(self, field) for field in self.copied_fields})
+        if JourneyPatternStop.stop.is_cached(self):
+            stop_time.stop = self.stop
+        if self.arrival is not None:
+            stop_time.arrival = trip.start + self.arrival
+        if self.departure is not None:
+            stop_time.departure = trip.start + self.departure
+        return stop_time
+
+
 class Garage(models.Model):
     operator = models.ForeignKey('busstops.Operator', models.SET_NULL, null=True, blank=True)
     code = models.CharField(max_length=50, blank=True)
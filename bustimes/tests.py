@@ -1,6 +1,39 @@
 import os
+import pickle
+import random
+from datetime import date, timedelta
+from psycopg2.extras import DateRange
 from vcr import use_cassette
-from django.test import TestCase
+from django.db import connection
+from django.db.models import Q, Exists, OuterRef
+from django.test import TestCase, SimpleTestCase
+from accounts.models import User
+from .alignment import Aligner
+from .bulk_load import allocate_ids, copy_objects, escape, save_trips
+from .trip_diff import TripDiff, describe_counts
+from .management.commands.benchmark_alignment import differ_rows, aligner_rows
+from busstops.models import DataSource, Service
+from .models import (Calendar, CalendarDate, Route, Trip, StopTime, Note, JourneyPattern, get_calendars,
+                     create_journey_patterns, prefetch_stop_times)
+
+
+def legacy_get_calendars(when):
+    """The query that get_calendars used to do, before Calendar.operating_days"""
+    calendars = Calendar.objects.filter(Q(end_date__gte=when) | Q(end_date=None),
+                                        start_date__lte=when)
+    calendar_dates = CalendarDate.objects.filter(Q(end_date__gte=when) | Q(end_date=None),
+                                                 start_date__lte=when)
+    exclusions = calendar_dates.filter(operation=False)
+    inclusions = calendar_dates.filter(operation=True)
+    special_inclusions = inclusions.filter(special=True)
+    only_certain_dates = Exists(CalendarDate.objects.filter(calendar=OuterRef('id'), special=False, operation=True))
+    return calendars.filter(
+        ~Q(calendardate__in=exclusions)
+    ).filter(
+        Q(~only_certain_dates) | Q(calendardate__in=inclusions)
+    ).filter(
+        Q(**{when.strftime('%a').lower(): True}) | Q(calendardate__in=special_inclusions)
+    )
 
 
 class BusTimesTest(TestCase):
@@ -22,3 +55,321 @@ class BusTimesTest(TestCase):
 
             response = self.client.get('/vehicles/tfl/LJ53NHP')
             self.assertEqual(response.status_code, 404)
+
+
+class AlignmentTest(SimpleTestCase):
+    def test_align(self):
+        aligner = Aligner()
+        self.assertEqual(aligner.align(['a', 'b', 'c']), [(0, True), (1, True), (2, True)])
+        self.assertEqual(aligner.align(['a', 'c', 'd']), [(0, False), (2, False), (3, True)])
+        self.assertEqual(aligner.keys, ['a', 'b', 'c', 'd'])
+
+        # memoised
+        self.assertIs(aligner.align(['a', 'c']), aligner.align(['a', 'c']))
+
+    def test_same_as_differ(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            stops = [f'0100BRP9{rng.randint(0, 60):04}' for _ in range(rng.randint(2, 30))] + ['1800SB12345', 'x']
+            patterns = [
+                [rng.choice(stops) for _ in range(rng.randint(1, 30))] for _ in range(rng.randint(1, 6))
+            ]
+            trips = [rng.choice(patterns) for _ in range(rng.randint(1, 20))]
+
+            self.assertEqual(differ_rows(trips), aligner_rows(trips))
+
+
+class CalendarTest(TestCase):
+    def test_same_as_legacy_get_calendars(self):
+        rng = random.Random(3)
+        start = date(2021, 3, 1)
+        calendars = []
+        for _ in range(50):
+            calendar = Calendar(
+                start_date=start + timedelta(days=rng.randrange(14)),
+                end_date=rng.choice((None, start + timedelta(days=rng.randrange(14, 60)))),
+                **{day: rng.random() < 0.6 for day in ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')}
+            )
+            calendar_dates = []
+            for _ in range(rng.randrange(5)):
+                start_date = start + timedelta(days=rng.randrange(-7, 60))
+                operation = rng.random() < 0.5
+                calendar_dates.append(CalendarDate(
+                    start_date=start_date,
+                    end_date=rng.choice((None, start_date, start_date + timedelta(days=rng.randrange(1, 10)))),
+                    operation=operation,
+                    special=operation and rng.random() < 0.5
+                ))
+            calendar.compile(calendar_dates)
+            calendar.save()
+            for calendar_date in calendar_dates:
+                calendar_date.calendar = calendar
+            CalendarDate.objects.bulk_create(calendar_dates)
+            calendars.append(calendar)
+
+        # as they come out of the database (and the cache)
+        saved_calendars = pickle.loads(pickle.dumps(list(Calendar.objects.all())))
+
+        for days in range(-3, 90):
+            when = start + timedelta(days=days)
+            expected = set(legacy_get_calendars(when).values_list('id', flat=True))
+            self.assertEqual(set(get_calendars(when).values_list('id', flat=True)), expected)
+            self.assertEqual({calendar.id for calendar in calendars if calendar.runs_on(when)}, expected)
+            self.assertEqual({calendar.id for calendar in saved_calendars if calendar.runs_on(when)}, expected)
+
+            calendar_ids = [calendar.id for calendar in calendars[:10]]
+            self.assertEqual(
+                set(get_calendars(when, calendar_ids).values_list('id', flat=True)),
+                expected.intersection(calendar_ids)
+            )
+
+    def test_recompile(self):
+        calendar = Calendar.objects.create(mon=True, tue=False, wed=False, thu=False, fri=False, sat=False, sun=False,
+                                           start_date=date(2021, 3, 1))
+        self.assertEqual(set(get_calendars(date(2021, 3, 8))), {calendar})
+
+        # changing the weekdays
+        calendar.mon = False
+        calendar.tue = True
+        calendar.save()
+        self.assertEqual(set(get_calendars(date(2021, 3, 8))), set())
+        self.assertEqual(set(get_calendars(date(2021, 3, 9))), {calendar})
+
+        # adding, changing and deleting CalendarDates in the admin
+        user = User.objects.create(username='josh', is_staff=True, is_superuser=True)
+        self.client.force_login(user)
+        url = f'/admin/bustimes/calendar/{calendar.id}/change/'
+        data = {
+            'tue': 'on',
+            'start_date': '2021-03-01',
+            'dates_0': '2021-03-01',
+            'summary': '',
+            'calendardate_set-TOTAL_FORMS': '1',
+            'calendardate_set-INITIAL_FORMS': '0',
+            'calendardate_set-0-start_date': '2021-03-09',
+            'calendardate_set-0-end_date': '2021-03-09',
+            'calendardate_set-0-dates_0': '2021-03-09',
+            'calendardate_set-0-summary': '',
+        }
+        self.client.post(url, data)
+        self.assertEqual(set(get_calendars(date(2021, 3, 9))), set())
+        self.assertEqual(set(get_calendars(date(2021, 3, 16))), {calendar})
+
+        calendar_date = calendar.calendardate_set.get()
+        data['calendardate_set-INITIAL_FORMS'] = '1'
+        data['calendardate_set-0-id'] = calendar_date.id
+        data['calendardate_set-0-calendar'] = calendar.id
+        data['calendardate_set-0-end_date'] = '2021-03-16'
+        self.client.post(url, data)
+        self.assertEqual(set(get_calendars(date(2021, 3, 16))), set())
+
+        data['calendardate_set-0-DELETE'] = 'on'
+        self.client.post(url, data)
+        self.assertFalse(calendar.calendardate_set.exists())
+        self.assertEqual(set(get_calendars(date(2021, 3, 16))), {calendar})
+
+
+class BulkLoadTest(TestCase):
+    def test_escape(self):
+        self.assertEqual(escape(None), '\\N')
+        self.assertEqual(escape(False), 'f')
+        self.assertEqual(escape('a\tb\\c\n'), 'a\\tb\\\\c\\n')
+        self.assertEqual(escape(b'\x01\xff'), '\\\\x01ff')
+        self.assertEqual(escape(Calendar.operating_days.field.get_db_prep_save(b'\x01', connection)), '\\\\x01')
+        self.assertEqual(escape(DateRange(date(2021, 3, 1), None)), '[2021-03-01,)')
+
+        # what Postgres makes of them
+        with connection.cursor() as cursor:
+            for value, cast in (
+                (timedelta(days=1, hours=1), 'interval'),
+                (timedelta(seconds=-1.5), 'interval'),
+                (DateRange(date(2021, 3, 1), date(2021, 3, 8)), 'daterange'),
+            ):
+                # unescape, as COPY would
+                cursor.execute(f'SELECT %s::{cast}', [escape(value).replace('\\\\', '\\')])
+                self.assertEqual(cursor.fetchone()[0], value)
+
+    def test_save_trips(self):
+        calendars = [
+            Calendar(mon=True, tue=True, wed=True, thu=True, fri=True, sat=False, sun=False,
+                     start_date=date(2021, 3, 1), dates=DateRange(date(2021, 3, 1), None)),
+            Calendar(mon=False, tue=False, wed=False, thu=False, fri=False, sat=True, sun=True,
+                     start_date=date(2021, 3, 1), end_date=date(2021, 3, 31), summary='Weekends\tonly'),
+        ]
+        for calendar in calendars:
+            calendar.compile([])
+        allocate_ids(Calendar, calendars)
+        copy_objects(Calendar, calendars)
+        for calendar in calendars:
+            self.assertFalse(calendar._state.adding)
+            saved = Calendar.objects.get(id=calendar.id)
+            for field in Calendar._meta.concrete_fields:
+                self.assertEqual(getattr(saved, field.attname), getattr(calendar, field.attname))
+            self.assertTrue(saved.runs_on(date(2021, 3, 6)) is calendar.sat)
+
+        source = DataSource.objects.create(name='Test')
+        service = Service.objects.create(service_code='1', line_name='1', date='2021-01-01')
+        route = Route.objects.create(service=service, source=source, code='1')
+        note = Note.objects.create(code='a', text='Schooldays only')
+        trips = [
+            Trip(route=route, calendar=calendar, start=timedelta(hours=25), end=timedelta(hours=25, minutes=5))
+            for calendar in calendars
+        ]
+        stop_times = [
+            StopTime(trip=trip, sequence=sequence, stop_code='Market Place', departure=trip.start + timedelta(
+                minutes=sequence
+            )) for trip in trips for sequence in range(3)
+        ]
+        with self.assertNumQueries(4):
+            save_trips(trips, stop_times, [[note, note], []])
+
+        trip = Trip.objects.get(id=trips[0].id)
+        self.assertEqual(trip.end, timedelta(hours=25, minutes=5))
+        self.assertEqual(list(trip.notes.all()), [note])
+        self.assertEqual(
+            [stop_time.departure for stop_time in trip.stoptime_set.all()],
+            [timedelta(hours=25), timedelta(hours=25, minutes=1), timedelta(hours=25, minutes=2)]
+        )
+        self.assertFalse(trips[1].notes.exists())
+
+
+class JourneyPatternTest(TestCase):
+    def test_create_journey_patterns(self):
+        source = DataSource.objects.create(name='Test')
+        service = Service.objects.create(service_code='1', line_name='1', date='2021-01-01')
+        route = Route.objects.create(service=service, source=source, code='1')
+        calendar = Calendar.objects.create(mon=True, tue=True, wed=True, thu=True, fri=True, sat=False, sun=False,
+                                           start_date='2021-01-01')
+
+        trips = []
+        for start, minutes in ((7, 10), (8, 10), (9, 12)):
+            start = timedelta(hours=start)
+            trip = Trip(route=route, calendar=calendar, start=start, end=start + timedelta(minutes=minutes))
+            trips.append((trip, [
+                StopTime(sequence=0, stop_code='Market Place', departure=start, timing_status='PTP'),
+                StopTime(sequence=1, stop_code='Bus Station', arrival=trip.end, activity='setDown')
+            ]))
+        create_journey_patterns(route, trips)
+        Trip.objects.bulk_create(trip for trip, _ in trips)
+
+        # the 9 o'clock trip takes longer, so gets its own pattern
+        self.assertEqual(2, JourneyPattern.objects.count())
+        self.assertFalse(StopTime.objects.exists())
+
+        trips = Trip.objects.prefetch_related(*prefetch_stop_times()).order_by('start')
+        with self.assertNumQueries(4):
+            stop_times = [trip.get_stop_times() for trip in trips]
+        self.assertEqual(['Market Place', 'Bus Station'], [stop_time.stop_code for stop_time in stop_times[1]])
+        self.assertEqual(timedelta(hours=8), stop_times[1][0].departure)
+        self.assertEqual(timedelta(hours=8, minutes=10), stop_times[1][1].arrival)
+        self.assertEqual(timedelta(hours=9, minutes=12), stop_times[2][1].arrival)
+        self.assertEqual('setDown', stop_times[2][1].activity)
+
+        response = self.client.get(f'/trips/{trips[1].id}.json')
+        self.assertEqual(response.json()['times'][1], {
+            'stop': {'name': 'Bus Station'},
+            'aimed_arrival_time': '08:10',
+            'aimed_departure_time': None
+        })
+
+
+class TripDiffTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        source = DataSource.objects.create(name='Test')
+        service = Service.objects.create(service_code='1', line_name='1', date='2021-01-01')
+        cls.route = Route.objects.create(service=service, source=source, code='1')
+        cls.note = Note.objects.create(code='s', text='Schooldays only')
+
+    def get_calendar(self, weekdays=True):
+        calendar = Calendar(mon=weekdays, tue=weekdays, wed=weekdays, thu=weekdays, fri=weekdays, sat=not weekdays,
+                            sun=False, start_date=date(2021, 1, 1))
+        calendar.compile([])
+        return calendar
+
+    def get_trip(self, hour, calendar, minutes=10, **kwargs):
+        """A trip (and its stop times) as an import would make it, unsaved"""
+        start = timedelta(hours=hour)
+        trip = Trip(route=self.route, calendar=calendar, start=start, end=start + timedelta(minutes=minutes), **kwargs)
+        return trip, [
+            StopTime(trip=trip, sequence=0, stop_code='Market Place', departure=start),
+            StopTime(trip=trip, sequence=1, stop_code='Bus Station', arrival=trip.end)
+        ]
+
+    def test_trip_diff(self):
+        calendar = self.get_calendar()
+        calendar.save()
+        saturdays = self.get_calendar(weekdays=False)
+        saturdays.save()
+
+        existing = [self.get_trip(hour, calendar) for hour in (7, 8, 9, 10, 10)]
+        existing.append(self.get_trip(11, saturdays))
+        save_trips(
+            [trip for trip, _ in existing], [stop_time for _, stop_times in existing for stop_time in stop_times]
+        )
+        patterned = [self.get_trip(12, calendar)]
+        create_journey_patterns(self.route, patterned)
+        Trip.objects.bulk_create(trip for trip, _ in patterned)
+        existing_ids = [trip.id for trip, _ in existing + patterned]
+
+        # a reimport, with new (but identical) calendars
+        calendar = self.get_calendar()
+        trips = [
+            self.get_trip(7, calendar),  # unchanged
+            self.get_trip(8, calendar, block='2'),  # updated in place
+            self.get_trip(9, calendar),  # note added
+            self.get_trip(10, calendar),  # matches one of two identical trips
+            self.get_trip(13, calendar),  # new
+            self.get_trip(13, calendar),  # new, and identical to the last one
+        ]
+        # (the 11 o'clock Saturday trip and 12 o'clock patterned trip are gone)
+
+        trip_diff = TripDiff(self.route.trip_set.all())
+        with self.assertNumQueries(3):  # setting the 9 o'clock trip's notes, and updating the 8 o'clock trip
+            new_trips, new_stop_times, new_notes = trip_diff.update(
+                [trip for trip, _ in trips], [stop_times for _, stop_times in trips],
+                [[], [], [self.note], [], [], []]
+            )
+        self.assertEqual(new_trips, [trips[4][0], trips[5][0]])
+        self.assertEqual(new_stop_times, [trips[4][1], trips[5][1]])
+        self.assertEqual(new_notes, [[], []])
+
+        trip_diff.delete_unmatched()
+        self.assertEqual(trip_diff.counts, {
+            'created': 2, 'updated': 2, 'unchanged': 2, 'deleted': 3,
+            'stop times written': 4, 'stop times unchanged': 8
+        })
+        self.assertEqual(
+            describe_counts(trip_diff.counts),
+            'trips: 2 created, 2 updated, 2 unchanged, 3 deleted - stop times: 4 written, 8 unchanged'
+        )
+
+        # unchanged and updated trips have kept their ids (and calendars)
+        saved_trips = Trip.objects.order_by('start', 'id')
+        self.assertEqual(
+            [(trip.id, trip.block, trip.calendar_id) for trip in saved_trips],
+            [(existing_ids[i], block, existing[0][0].calendar_id) for i, block in ((0, ''), (1, '2'), (2, ''), (4, ''))]
+        )  # (one of the two identical 10 o'clock trips is left over, and deleted)
+        self.assertEqual(list(saved_trips[2].notes.all()), [self.note])
+        self.assertFalse(saved_trips[3].notes.exists())
+
+        # the deleted trips' stop times, calendar and journey pattern have gone too
+        self.assertEqual(StopTime.objects.count(), 8)
+        self.assertFalse(Calendar.objects.filter(id=saturdays.id).exists())
+        self.assertFalse(JourneyPattern.objects.exists())
+
+        # a note-only change
+        trip_diff = TripDiff(self.route.trip_set.all())
+        trips = [self.get_trip(hour, calendar) for hour in (7, 8, 9, 10)]
+        trips[1][0].block = '2'
+        with self.assertNumQueries(2):  # clearing the 9 o'clock trip's notes
+            new_trips, _, _ = trip_diff.update([trip for trip, _ in trips], [stop_times for _, stop_times in trips])
+        self.assertEqual(new_trips, [])
+        self.assertEqual(trip_diff.counts, {'unchanged': 3, 'updated': 1, 'stop times unchanged': 8})
+        self.assertFalse(saved_trips[2].notes.exists())
+
+        # an existing trip whose stop times have changed doesn't match
+        trip_diff = TripDiff(self.route.trip_set.all())
+        trip = self.get_trip(7, calendar, minutes=11)
+        new_trips, _, _ = trip_diff.update([trip[0]], [trip[1]])
+        self.assertEqual(new_trips, [trip[0]])
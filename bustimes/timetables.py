@@ -1,85 +1,86 @@
 import datetime
+import pickle
+import zlib
+from hashlib import md5
+from django.core.cache import cache
 from django.utils.timezone import localdate
-from difflib import Differ
 from functools import cmp_to_key
-from django.db.models import Prefetch
+from .alignment import Aligner
 from .utils import format_timedelta
-from .models import get_calendars, get_routes, Calendar, Trip, StopTime
+from .models import get_calendars, get_routes, prefetch_stop_times, Calendar, Trip
 
-differ = Differ(charjunk=lambda _: True)
 
-
-def get_journey_patterns(trips):
-    trips = trips.prefetch_related(Prefetch('stoptime_set', queryset=StopTime.objects.filter(stop__isnull=False)))
-
-    patterns = []
-    pattern_hashes = set()
-
-    for trip in trips:
-        pattern = [stoptime.stop_id for stoptime in trip.stoptime_set.all()]
-        pattern_hash = str(pattern)
-        if pattern_hash not in pattern_hashes:
-            patterns.append(pattern)
-            pattern_hashes.add(pattern_hash)
-
-    return patterns
+def add_stop_pattern(patterns, inbound, stop_times):
+    """Adds a trip's stop times (the ones at stops) to a dict of distinct (inbound, stop times) pairs, for
+    align_stop_usages - so importers can work out stop usages from the trips they've just parsed,
+    instead of reading them back from the database
+    """
+    stop_times = [stop_time for stop_time in stop_times if stop_time.stop_id]
+    patterns.setdefault((inbound, tuple(stop_time.stop_id for stop_time in stop_times)), (inbound, stop_times))
 
 
-def get_stop_usages(trips):
+def align_stop_usages(patterns):
+    """Given some (inbound, stop times) pairs, returns a list of outbound stop times and a list of inbound stop times,
+    with every stop in an order consistent with (as many as possible of) the trips'
+    """
     groupings = [[], []]
+    aligners = [Aligner(), Aligner()]
 
-    trips = trips.prefetch_related(Prefetch('stoptime_set', queryset=StopTime.objects.filter(stop__isnull=False)))
-
-    for trip in trips:
-        if trip.inbound:
+    for inbound, stop_times in patterns:
+        if inbound:
             grouping_id = 1
         else:
             grouping_id = 0
         grouping = groupings[grouping_id]
 
-        stop_times = trip.stoptime_set.all()
+        alignment = aligners[grouping_id].align([stop_time.stop_id for stop_time in stop_times])
 
-        old_rows = [stop_time.stop_id for stop_time in grouping]
-        new_rows = [stop_time.stop_id for stop_time in stop_times]
-        diff = differ.compare(old_rows, new_rows)
+        for stop_time, (y, new) in zip(stop_times, alignment):
+            if new:
+                grouping.insert(y, stop_time)
 
-        y = 0  # how many rows down we are
+    return groupings
 
-        for stop_time in stop_times:
-            if y < len(old_rows):
-                existing_row = old_rows[y]
-            else:
-                existing_row = None
 
-            instruction = next(diff)
+def get_version_key(service_id):
+    return f'timetable_version:{service_id}'
 
-            while instruction[0] in '-?':
-                if instruction[0] == '-':
-                    y += 1
-                    if y < len(old_rows):
-                        existing_row = old_rows[y]
-                    else:
-                        existing_row = None
-                instruction = next(diff)
 
-            assert instruction[2:] == stop_time.stop_id
+def expire_timetables(service_ids):
+    """Stop any cached timetables for these services being used again.
+    Should be called by importers after they change any timetable data
+    """
+    version = datetime.datetime.now().timestamp()
+    cache.set_many({get_version_key(service_id): version for service_id in service_ids}, None)
 
-            if instruction[0] == '+':
-                if not existing_row:
-                    grouping.append(stop_time)
-                    old_rows.append(stop_time.stop_id)
-                else:
-                    grouping = grouping[:y] + [stop_time] + grouping[y:]
-                    old_rows = old_rows[:y] + [stop_time.stop_id] + old_rows[y:]
-                # existing_row = stop_time.stop_id
-            else:
-                assert instruction[2:] == existing_row
 
-            y += 1
+def get_cache_key(routes, date):
+    """A key for a timetable built from these routes,
+    that will change whenever the data the timetable is built from changes - and every day,
+    because a timetable's date options and notes depend on what day it was built, even if a date was specified
+    """
+    service_ids = sorted({route.service_id for route in routes})
+    versions = cache.get_many([get_version_key(service_id) for service_id in service_ids])
+    key = ':'.join(
+        [f'{date or "default"} {localdate()}']
+        + [f'{route.id} {route.source.datetime}' for route in routes]
+        + [f'{key} {versions[key]}' for key in sorted(versions)]
+    )
+    return f'timetable:{md5(key.encode()).hexdigest()}'
 
-        groupings[grouping_id] = grouping
 
-    return groupings
+def get_timetable(routes, date):
+    """Given a QuerySet of routes and a date (or None), return a Timetable - from the cache if possible"""
+    routes = list(routes.select_related('source').defer('geometry'))
+    key = get_cache_key(routes, date)
+
+    timetable = cache.get(key)
+    if timetable is not None:
+        return pickle.loads(zlib.decompress(timetable))
+
+    timetable = Timetable(routes, date)
+    cache.set(key, zlib.compress(pickle.dumps(timetable, pickle.HIGHEST_PROTOCOL)), 691200)  # 8 days
+    return timetable
 
 
 class Timetable:
@@ -88,9 +89,9 @@ class Timetable:
     start_date = None
 
     def __init__(self, routes, date):
+        """routes should be a list of Routes, with their sources"""
         self.today = localdate()
 
-        routes = list(routes.select_related('source'))
         self.routes = routes
         self.current_routes = routes
 
@@ -131,7 +132,7 @@ class Timetable:
             calendar_ids = [calendar.id for calendar in self.calendars]
             trips = trips.filter(calendar__in=get_calendars(self.date, calendar_ids))
         trips = trips.order_by('start').defer('route__service__geometry').select_related('route__service')
-        trips = trips.prefetch_related('notes', 'stoptime_set')
+        trips = trips.prefetch_related('notes', *prefetch_stop_times())
 
         for trip in trips:
             if trip.inbound:
@@ -158,12 +159,14 @@ class Timetable:
     def get_date_options(self):
         date = self.today
 
+        start_dates = []
         for calendar in self.calendars:
+            start_date = calendar.start_date
             for calendar_date in calendar.calendardate_set.all():
                 if not calendar_date.operation and calendar_date.contains(date):
-                    calendar.start_date = calendar_date.end_date
+                    start_date = calendar_date.end_date
                     break
-        start_dates = [calendar.start_date for calendar in self.calendars]
+            start_dates.append(start_date)
         if start_dates:
             date = max(date, min(start_dates))
 
@@ -196,12 +199,18 @@ class Timetable:
         for grouping in self.groupings:
             for row in grouping.rows:
                 for cell in row.times:
-                    if type(cell) is Cell and not cell.last and cell.stoptime.activity == 'setDown':
+                    if type(cell) is Cell and not cell.last and cell.activity == 'setDown':
                         return True
 
     def credits(self):
         return [route.source.credit(route) for route in self.current_routes]
 
+    def __getstate__(self):
+        # for caching - the calendars are only needed while building the timetable
+        state = self.__dict__.copy()
+        state.pop('calendars', None)
+        return state
+
 
 class Repetition:
     """Represents a special cell in a timetable, spanning multiple rows and columns,
@@ -256,6 +265,7 @@ class Grouping:
         self.heads = []
         self.rows = []
         self.trips = []
+        self.aligner = Aligner()
         self.inbound = inbound
         self.column_feet = {}
 
@@ -283,51 +293,32 @@ class Grouping:
     def min_height(self):
         return sum(2 if row.has_waittimes else 1 for row in self.rows if not row.is_minor())
 
+    def __getstate__(self):
+        # for caching - the trips are only needed while building the timetable
+        state = self.__dict__.copy()
+        state['trips'] = []
+        del state['aligner']
+        return state
+
     def handle_trip(self, trip):
         rows = self.rows
         if rows:
             x = len(rows[0].times)  # number of existing columns
         else:
             x = 0
-        previous_list = [row.stop.atco_code for row in rows]
-        current_list = [stoptime.get_key() for stoptime in trip.stoptime_set.all()]
-        diff = differ.compare(previous_list, current_list)
-
-        y = 0  # how many rows along we are
-        first = True
-
-        for stoptime in trip.stoptime_set.all():
-            key = stoptime.get_key()
 
-            if y < len(rows):
-                existing_row = rows[y]
-            else:
-                existing_row = None
-
-            instruction = next(diff)
-
-            while instruction[0] in '-?':
-                if instruction[0] == '-':
-                    y += 1
-                    if y < len(rows):
-                        existing_row = rows[y]
-                    else:
-                        existing_row = None
-                instruction = next(diff)
+        stoptimes = trip.get_stop_times()
+        alignment = self.aligner.align([stoptime.get_key() for stoptime in stoptimes])
 
-            assert instruction[2:] == key
+        first = True
 
-            if instruction[0] == '+':
-                row = Row(Stop(key), [''] * x)
+        for stoptime, (y, new) in zip(stoptimes, alignment):
+            if new:
+                row = Row(Stop(stoptime.get_key()), [''] * x)
                 row.timing_status = stoptime.timing_status
-                if not existing_row:
-                    rows.append(row)
-                else:
-                    rows = self.rows = rows[:y] + [row] + rows[y:]
-                existing_row = row
+                rows.insert(y, row)
             else:
-                row = existing_row
-                assert instruction[2:] == existing_row.stop.atco_code
+                row = rows[y]
 
             cell = Cell(stoptime, stoptime.arrival, stoptime.departure)
             if first:
@@ -335,8 +326,6 @@ class Grouping:
                 first = False
             row.times.append(cell)
 
-            y += 1
-
         if not first:  # (there was at least 1 stoptime in the trip)
             cell.last = True
 
@@ -480,7 +469,7 @@ class Cell:
     last = False
 
     def __init__(self, stoptime, arrival, departure):
-        self.stoptime = stoptime
+        self.activity = stoptime.activity
         self.arrival = arrival
         self.departure = departure
         if arrival is None:
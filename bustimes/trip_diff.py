@@ -0,0 +1,175 @@
+"""Working out which of an import's trips are the same as trips that already exist,
+so reimporting a changed route only writes the trips that have actually changed.
+
+Unchanged trips keep their ids, so VehicleJourney.trip (which has no database constraint) doesn't go dangling,
+and a reimport doesn't churn through the StopTime table and its indexes.
+"""
+
+from collections import Counter
+from django.db.models import Exists, OuterRef
+from .models import Calendar, JourneyPattern, JourneyPatternStop, StopTime, Trip, to_date
+
+
+# Trip fields that aren't part of a trip's key - if they're all that's changed, the trip is updated in place
+UPDATABLE_FIELDS = ('inbound', 'journey_pattern', 'block', 'destination', 'garage', 'end', 'sequence')
+
+
+def get_calendar_key(calendar):
+    return (
+        calendar.mon, calendar.tue, calendar.wed, calendar.thu, calendar.fri, calendar.sat, calendar.sun,
+        to_date(calendar.start_date), to_date(calendar.end_date), calendar.summary,
+        bytes(calendar.operating_days or b''), calendar.operating_weekdays
+    )
+
+
+def get_stop_times_key(stop_times, start):
+    """A hash of some StopTimes (or JourneyPatternStops, if start is None), relative to their trip's start time"""
+    if start is not None:
+        stop_times = (JourneyPatternStop.from_stop_time(stop_time, start) for stop_time in stop_times)
+    return hash(tuple(stop.get_key() for stop in stop_times))
+
+
+def get_trip_key(trip, stop_times_key):
+    return (trip.route_id, trip.ticket_machine_code, trip.start, get_calendar_key(trip.calendar), stop_times_key)
+
+
+def describe_counts(counts):
+    return (
+        f"trips: {counts['created']} created, {counts['updated']} updated, {counts['unchanged']} unchanged, "
+        f"{counts['deleted']} deleted - stop times: {counts['stop times written']} written, "
+        f"{counts['stop times unchanged']} unchanged"
+    )
+
+
+class TripDiff:
+    """Some existing trips (of a route, or a whole source), indexed by key - route, ticket machine code,
+    start time, calendar and stop times - for matching an import's trips to.
+
+    Existing trips are loaded in at most four queries.
+    (Hashes of their stop times are kept, rather than the stop times themselves, so a whole source's worth fits in
+    memory.) Afterwards, counts says how many trips and stop times were written, and how many were left alone
+    """
+
+    def __init__(self, trips=None):
+        """trips is a queryset of the existing trips, or None if there can't be any (if the route is new)"""
+        self.existing = {}  # key: [trips]
+        self.pattern_ids = set()
+        self.counts = Counter()
+        if trips is not None:
+            self.load(trips)
+
+    def load(self, trips):
+        trip_list = list(trips.select_related('calendar'))
+        if not trip_list:
+            return
+
+        notes = {}
+        for trip_id, note_id in Trip.notes.through.objects.filter(trip__in=trips).values_list('trip', 'note'):
+            notes.setdefault(trip_id, set()).add(note_id)
+
+        starts = {trip.id: trip.start for trip in trip_list if trip.pattern_id is None}
+        stop_times_keys = {}
+        if starts:
+            stop_times = StopTime.objects.filter(trip__in=trips.filter(pattern=None)).order_by('trip', 'sequence')
+            trip_id = None
+            trip_stop_times = []
+            for stop_time in stop_times.iterator():
+                if stop_time.trip_id != trip_id:
+                    if trip_stop_times:
+                        stop_times_keys[trip_id] = get_stop_times_key(trip_stop_times, starts[trip_id])
+                    trip_id = stop_time.trip_id
+                    trip_stop_times = []
+                trip_stop_times.append(stop_time)
+            if trip_stop_times:
+                stop_times_keys[trip_id] = get_stop_times_key(trip_stop_times, starts[trip_id])
+
+        self.pattern_ids = {trip.pattern_id for trip in trip_list if trip.pattern_id is not None}
+        pattern_keys = {}
+        if self.pattern_ids:
+            pattern_stops = {}
+            for stop in JourneyPatternStop.objects.filter(pattern__in=self.pattern_ids).order_by('pattern', 'sequence'):
+                pattern_stops.setdefault(stop.pattern_id, []).append(stop)
+            pattern_keys = {
+                pattern_id: get_stop_times_key(stops, None) for pattern_id, stops in pattern_stops.items()
+            }
+
+        empty_key = get_stop_times_key((), None)
+        for trip in trip_list:
+            if trip.pattern_id is None:
+                stop_times_key = stop_times_keys.get(trip.id, empty_key)
+            else:
+                stop_times_key = pattern_keys.get(trip.pattern_id, empty_key)
+            trip.note_ids = notes.get(trip.id, set())
+            self.existing.setdefault(get_trip_key(trip, stop_times_key), []).append(trip)
+
+    def update(self, trips, stop_times_by_trip, notes_by_trip=None):
+        """Matches some new (unsaved) trips to existing ones.
+        Existing trips that match but differ in some other way (block, destination, notes, etc) are updated in place.
+
+        Returns (trips, stop_times_by_trip, notes_by_trip) for the trips that don't match any existing trip,
+        for the caller to save
+        """
+        if notes_by_trip is None:
+            notes_by_trip = [()] * len(trips)
+
+        new_trips = []
+        new_stop_times_by_trip = []
+        new_notes_by_trip = []
+        updated_trips = []
+
+        for trip, stop_times, notes in zip(trips, stop_times_by_trip, notes_by_trip):
+            key = get_trip_key(trip, get_stop_times_key(stop_times, trip.start))
+            matches = self.existing.get(key)
+            if not matches:
+                new_trips.append(trip)
+                new_stop_times_by_trip.append(stop_times)
+                new_notes_by_trip.append(notes)
+                self.counts['created'] += 1
+                self.counts['stop times written'] += len(stop_times)
+                continue
+
+            existing_trip = matches.pop()
+            if not matches:
+                del self.existing[key]
+            self.counts['stop times unchanged'] += len(stop_times)
+
+            changed = False
+            for field in UPDATABLE_FIELDS:
+                attname = Trip._meta.get_field(field).attname
+                value = getattr(trip, attname)
+                if getattr(existing_trip, attname) != value:
+                    setattr(existing_trip, attname, value)
+                    changed = True
+            if changed:
+                updated_trips.append(existing_trip)
+
+            note_ids = {note.id for note in notes}
+            if note_ids != existing_trip.note_ids:
+                existing_trip.notes.set(note_ids)
+                changed = True
+
+            self.counts['updated' if changed else 'unchanged'] += 1
+
+        if updated_trips:
+            Trip.objects.bulk_update(updated_trips, UPDATABLE_FIELDS)
+
+        return new_trips, new_stop_times_by_trip, new_notes_by_trip
+
+    def delete_unmatched(self):
+        """Deletes the existing trips that nothing has matched, and any calendars and journey patterns that were
+        only theirs
+        """
+        trips = [trip for trips in self.existing.values() for trip in trips]
+        if trips:
+            Trip.objects.filter(id__in=[trip.id for trip in trips]).delete()
+            self.counts['deleted'] += len(trips)
+            Calendar.objects.filter(
+                ~Exists(Trip.objects.filter(calendar=OuterRef('id'))), id__in={trip.calendar_id for trip in trips}
+            ).delete()
+        self.existing = {}
+
+        if self.pattern_ids:
+            JourneyPattern.objects.filter(
+                ~Exists(Trip.objects.filter(pattern=OuterRef('id'))), id__in=self.pattern_ids
+            ).delete()
+            self.pattern_ids = set()
@@ -4,14 +4,14 @@ import requests
 from datetime import timedelta
 from ciso8601 import parse_datetime
 from django.conf import settings
-from django.db.models import Prefetch, F, Exists, OuterRef, DurationField, ExpressionWrapper
+from django.db.models import Prefetch, F, Exists, OuterRef, DurationField, ExpressionWrapper, prefetch_related_objects
 from django.utils import timezone
 from django.shortcuts import get_object_or_404, render
 from django.views.generic.detail import DetailView
 from django.http import FileResponse, Http404, HttpResponse, JsonResponse, HttpResponseBadRequest
 from busstops.models import Service, DataSource, StopPoint
-from departures.live import TimetableDepartures
-from .models import Route, Trip, CalendarDate
+from departures.live import TimetableDepartures, get_midnight
+from .models import prefetch_stop_times, Route, Trip, CalendarDate
 
 
 class ServiceDebugView(DetailView):
@@ -114,11 +114,10 @@ def stop_times_json(request, atco_code):
             routes[route.service_id] = [route]
 
     departures = TimetableDepartures(stop, services, when, routes)
-    time_since_midnight = timedelta(hours=when.hour, minutes=when.minute, seconds=when.second,
-                                    microseconds=when.microsecond)
-    midnight = when - time_since_midnight
-
-    for stop_time in departures.get_times(when).prefetch_related("trip__route__service__operator")[:limit]:
+    stop_times = [stop_time for stop_time in departures.get_times(limit, timedelta(days=1)) if not stop_time.recent]
+    prefetch_related_objects(stop_times, 'trip__route__service__operator')
+    for stop_time in stop_times:
+        midnight = get_midnight(stop_time.service_date, when.tzinfo)
         service = {
             "line_name": stop_time.trip.route.service.line_name,
             "operators": [{
@@ -151,9 +150,9 @@ def stop_times_json(request, atco_code):
 
 
 def trip_json(request, id):
-    trip = get_object_or_404(Trip, id=id)
+    trip = get_object_or_404(Trip.objects.prefetch_related(*prefetch_stop_times(('stop__locality',))), id=id)
     times = []
-    for stop_time in trip.stoptime_set.select_related('stop__locality'):
+    for stop_time in trip.get_stop_times():
         stop = {}
         if stop_time.stop:
             stop['atco_code'] = stop_time.stop_id
@@ -174,12 +173,14 @@ def trip_json(request, id):
 
 class TripDetailView(DetailView):
     model = Trip
-    queryset = model.objects.select_related('route__service')
+    queryset = model.objects.select_related('route__service').prefetch_related(
+        *prefetch_stop_times(('stop__locality',))
+    )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        context['stops'] = self.object.stoptime_set.select_related('stop__locality')
+        context['stops'] = self.object.get_stop_times()
 
         context['breadcrumb'] = [self.object.route.service]
 
@@ -1,5 +1,7 @@
 """Various ways of getting live departures from some web service"""
 import re
+import json
+import redis
 import ciso8601
 import datetime
 import requests
@@ -7,21 +9,40 @@ import pytz
 import logging
 import xmltodict
 import xml.etree.cElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import perf_counter, sleep, time
 from pytz.exceptions import AmbiguousTimeError
 from django.conf import settings
 from django.core.cache import cache
-from django.db.models import Q, Exists, OuterRef, Value
+from django.db import connections
+from django.db.models import Q, F, Exists, OuterRef, Value, DateField
 from django.db.models.functions import Concat
 from django.utils import timezone
 from busstops.models import Service, ServiceCode, SIRISource
-from bustimes.models import get_calendars, get_routes, Route, StopTime
+from bustimes.fields import SecondsField
+from bustimes.models import get_calendars, get_routes, Route, Trip, StopTime, JourneyPatternStop
 from vehicles.tasks import create_service_code, create_journey_code, log_vehicle_journey
+from vehicles.utils import PREDICTIONS_MAX_AGE, get_predictions_key
 
 
 logger = logging.getLogger(__name__)
 DESTINATION_REGEX = re.compile(r'.+\((.+)\)')
 LOCAL_TIMEZONE = pytz.timezone('Europe/London')
 SESSION = requests.Session()
+# for getting departures from several live sources at once
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+LIVE_DEPARTURES_TIMEOUT = 5  # seconds, overall
+# live and scheduled times of the same service this close together are the same departure
+BLEND_WINDOW = datetime.timedelta(minutes=2)
+NAIVE_EPOCH = datetime.datetime(2000, 1, 1)
+AWARE_EPOCH = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+# for refreshing cached departure boards before they expire
+REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+STALE_AGE = 300  # seconds a board can be served after its max_age, while another worker refreshes it
+REFRESH_AHEAD = 10  # refresh a board in the background when it has this many seconds left
+LOCK_AGE = LIVE_DEPARTURES_TIMEOUT + 10
+LOCK_WAIT = 3  # seconds to wait for another worker to finish building a board
+CACHE_COUNTERS = ('hit', 'miss', 'stale', 'lock_wait')
 
 
 class Departures:
@@ -302,9 +323,10 @@ class NorfolkDepartures(Departures):
 
 
 class TimetableDepartures(Departures):
-    def get_row(self, stop_time, midnight):
+    def get_row(self, stop_time):
         trip = stop_time.trip
         destination = trip.destination
+        midnight = get_midnight(stop_time.service_date, self.now.tzinfo)
         if stop_time.departure is not None:
             time = midnight + stop_time.departure
         else:
@@ -317,30 +339,54 @@ class TimetableDepartures(Departures):
             'link': trip.get_absolute_url()
         }
 
-    def get_times(self, when):
-        times = get_stop_times(when, self.stop.atco_code, self.services, self.routes)
-        times = times.select_related('trip__route__service', 'trip__destination__locality')
-        times = times.defer('trip__route__service__geometry', 'trip__route__service__search_vector',
-                            'trip__destination__locality__latlong', 'trip__destination__locality__search_vector')
-        return times.order_by('departure')
+    def get_times(self, limit, duration=datetime.timedelta(days=3)):
+        """Returns a list of up to limit StopTimes in the duration after self.now, in order,
+        preceded by up to one (per service day) StopTime in the hour before self.now, if there are any.
+        Each StopTime has service_date and recent attributes
+        """
+        end = self.now + duration
+        times, pattern_stops, recent_parts = get_stop_times(self.now, end, self.stop.atco_code, self.routes)
+        times = list(times[:limit + recent_parts])
+
+        if pattern_stops is not None:
+            pattern_stops = pattern_stops[:limit + recent_parts]
+            if pattern_stops:
+                trips = Trip.objects.select_related('route__service', 'destination__locality')
+                trips = trips.defer('route__service__geometry', 'route__service__search_vector',
+                                    'destination__locality__latlong', 'destination__locality__search_vector')
+                trips = trips.in_bulk({pattern_stop.trip_id for pattern_stop in pattern_stops})
+                for pattern_stop in pattern_stops:
+                    stop_time = pattern_stop.get_stop_time(trips[pattern_stop.trip_id])
+                    stop_time.service_date = pattern_stop.service_date
+                    stop_time.time = pattern_stop.time
+                    times.append(stop_time)
+                times.sort(key=lambda stop_time: stop_time.time)
+
+        time_since_midnight = datetime.timedelta(hours=self.now.hour, minutes=self.now.minute,
+                                                 seconds=self.now.second)
+        for stop_time in times:
+            stop_time.recent = stop_time.time < time_since_midnight
+        return times
 
     def get_departures(self):
-        key = f'TimetableDepartures:{self.stop.atco_code}'
-        times = cache.get(key)
-        if times is not None:
+        """Returns a list of up to 10 departures in the next 3 days, and sets self.recent
+        (whether there were any departures in the last hour)
+        """
+        key = f'TimetableDepartures:{self.stop.atco_code}:recent'
+        cached = cache.get(key)
+        if cached is not None:
+            times, self.recent = cached
             return times
-        time_since_midnight = datetime.timedelta(hours=self.now.hour, minutes=self.now.minute, seconds=self.now.second,
-                                                 microseconds=self.now.microsecond)
-        midnight = self.now - time_since_midnight
-        times = [self.get_row(stop_time, midnight) for stop_time in self.get_times(self.now)[:10]]
-        i = 0
-        while len(times) < 10 and i < 3:
-            i += 1
-            midnight += datetime.timedelta(1)
-            times += [self.get_row(stop_time, midnight) for stop_time in self.get_times(midnight)[:10-len(times)]]
+        self.recent = False
+        times = []
+        for stop_time in self.get_times(10):
+            if stop_time.recent:
+                self.recent = True
+            elif len(times) < 10:
+                times.append(self.get_row(stop_time))
         if times:
             max_age = (times[0]['time'] - self.now).seconds + 60
-            cache.set(key, times, max_age)
+            cache.set(key, (times, self.recent), max_age)
         return times
 
     def __init__(self, stop, services, now, routes):
@@ -469,12 +515,53 @@ class StagecoachDepartures(Departures):
         return departures
 
 
+class AvlDepartures(Departures):
+    """Predictions worked out from our own tracking of vehicles' locations
+    (by vehicles.management.arrival_predictions.ArrivalPredictions), for stops without another live source
+    """
+    def get_departures(self):
+        try:
+            predictions = redis.from_url(settings.REDIS_URL).hgetall(get_predictions_key(self.stop.atco_code))
+        except redis.exceptions.ConnectionError:
+            return
+
+        now = time()
+        services = {service.id: service for service in self.services}
+        departures = []
+        for prediction in predictions.values():
+            prediction = json.loads(prediction)
+            if (
+                prediction['service'] in services
+                and prediction['expected'] > now - 60  # (hasn't already gone)
+                and now - prediction['updated'] < PREDICTIONS_MAX_AGE
+            ):
+                departures.append({
+                    'time': datetime.datetime.fromtimestamp(prediction['aimed'], LOCAL_TIMEZONE),
+                    'live': datetime.datetime.fromtimestamp(prediction['expected'], LOCAL_TIMEZONE),
+                    'service': services[prediction['service']],
+                    'destination': prediction['destination'],
+                })
+        departures.sort(key=lambda departure: departure['time'])
+        return departures
+
+
 def services_match(a, b):
-    if type(a) is Service:
-        a = a.line_name
-    if type(b) is Service:
-        b = b.line_name
-    return a.lower() == b.lower()
+    return get_line_name(a) == get_line_name(b)
+
+
+def get_line_name(service):
+    if type(service) is Service:
+        service = service.line_name
+    return service.lower()
+
+
+def get_bucket(time):
+    """Returns which BLEND_WINDOW-long bucket a datetime is in - so two datetimes within BLEND_WINDOW of each other
+    are in the same or neighbouring buckets. Naive and aware datetimes have separate buckets
+    """
+    if timezone.is_naive(time):
+        return False, (time - NAIVE_EPOCH) // BLEND_WINDOW
+    return True, (time - AWARE_EPOCH) // BLEND_WINDOW
 
 
 def can_sort(departure):
@@ -492,36 +579,177 @@ def get_departure_order(departure):
 
 
 def blend(departures, live_rows, stop=None):
+    """Adds the "live" times and "data" from live_rows to any matching rows in departures -
+    the first row for the same service with a scheduled time within BLEND_WINDOW. Unmatched live rows are appended.
+
+    To avoid comparing every live row with every row, rows are indexed by line name and get_bucket
+    """
+    index = {}
+
+    def add_to_index(position, row):
+        if row['time']:
+            key = (get_line_name(row['service']), *get_bucket(row['time']))
+            if key in index:
+                index[key].append((position, row))
+            else:
+                index[key] = [(position, row)]
+
+    for position, row in enumerate(departures):
+        add_to_index(position, row)
+
     added = False
     for live_row in live_rows:
-        replaced = False
-        for row in departures:
-            if services_match(row['service'], live_row['service']) and row['time'] and live_row['time']:
-                if abs(row['time'] - live_row['time']) <= datetime.timedelta(minutes=2):
-                    if live_row.get('live'):
-                        row['live'] = live_row['live']
-                    if 'data' in live_row:
-                        row['data'] = live_row['data']
-                    replaced = True
-                    break
-        if not replaced and (live_row.get('live') or live_row['time']):
+        match = None
+        if live_row['time']:
+            line_name = get_line_name(live_row['service'])
+            aware, bucket = get_bucket(live_row['time'])
+            for key in (
+                (line_name, aware, bucket - 1), (line_name, aware, bucket), (line_name, aware, bucket + 1)
+            ):
+                for position, row in index.get(key, ()):
+                    if match and position > match[0]:
+                        break  # (each bucket's rows are in order)
+                    if abs(row['time'] - live_row['time']) <= BLEND_WINDOW:
+                        match = position, row
+                        break
+        if match:
+            row = match[1]
+            if live_row.get('live'):
+                row['live'] = live_row['live']
+            if 'data' in live_row:
+                row['data'] = live_row['data']
+        elif live_row.get('live') or live_row['time']:
+            add_to_index(len(departures), live_row)
             departures.append(live_row)
             added = True
     if added and all(can_sort(departure) for departure in departures):
         departures.sort(key=get_departure_order)
 
 
-def get_stop_times(when, stop, services, services_routes):
-    time_since_midnight = datetime.timedelta(hours=when.hour, minutes=when.minute, seconds=when.second)
+def get_departures_with_latency(source):
+    start = perf_counter()
+    try:
+        return source.get_departures()
+    finally:
+        source.latency = perf_counter() - start
+
+
+def fetch_live_departures(sources, timeout=LIVE_DEPARTURES_TIMEOUT):
+    """Given a list of Departures objects, calls all their get_departures methods at once (in EXECUTOR's threads).
+
+    Returns a list of results, in the same order - None for any that fail or don't finish within the timeout
+    (those will keep going in the background, and get_departures will still call set_poorly if they time out)
+    """
+    futures = [EXECUTOR.submit(get_departures_with_latency, source) for source in sources]
+    wait(futures, timeout=timeout)
+
+    results = []
+    for source, future in zip(sources, futures):
+        name = type(source).__name__
+        rows = None
+        if future.done():
+            try:
+                rows = future.result()
+            except Exception as e:
+                logger.error(e, exc_info=True)
+            logger.info('%s took %.3f seconds', name, source.latency)
+        else:
+            logger.warning('%s took more than %s seconds', name, timeout)
+        results.append(rows)
+    return results
+
+
+def get_midnight(date, tzinfo):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time()), tzinfo)
+
+
+def get_stop_times(start, end, stop, services_routes):
+    """Get departures from a stop between two datetimes, and in the hour before the start,
+    in a single query (or two, if settings.COMPACT_STOP_TIMES).
+
+    There's a part of the query for each service day that might have departures in that time - including the day
+    before, for journeys after midnight. Each part is a union of the trips that run on that day, with times relative
+    to that day's midnight, annotated with the service_date and an overall time to order by.
+
+    Returns a queryset of StopTimes, a queryset of JourneyPatternStops (annotated with trip_id) or None, and the
+    number of "recent" parts. Each recent part has at most one departure from the hour before the start, and sorts
+    first - so the querysets should be sliced with [:limit + recent_parts].
+    """
+    one_hour = datetime.timedelta(hours=1)
+    time_since_midnight = datetime.timedelta(hours=start.hour, minutes=start.minute, seconds=start.second)
+    duration = end - start
+    first_date = start.date()
+
     times = StopTime.objects.filter(~Q(activity='setDown'), stop_id=stop)
-    if time_since_midnight:
-        times = times.filter(departure__gte=time_since_midnight)
-    services = [service for service in services if not service.timetable_wrong]
-    services = {}
-    routes = []
-    for service_routes in services_routes.values():
-        routes += get_routes(service_routes, when.date())
-    return times.filter(trip__route__in=routes, trip__calendar__in=get_calendars(when))
+    times = times.select_related('trip__route__service', 'trip__destination__locality')
+    times = times.defer('trip__route__service__geometry', 'trip__route__service__search_vector',
+                        'trip__destination__locality__latlong', 'trip__destination__locality__search_vector')
+    if settings.COMPACT_STOP_TIMES:
+        pattern_stops = JourneyPatternStop.objects.filter(~Q(activity='setDown'), stop_id=stop)
+    else:
+        pattern_stops = None
+
+    time_parts = []
+    pattern_parts = []
+    recent_parts = 0
+
+    for days in range(-1, duration.days + 2):
+        date = first_date + datetime.timedelta(days=days)
+        routes = []
+        for service_routes in services_routes.values():
+            routes += get_routes(service_routes, date)
+        if not routes:
+            continue
+
+        # start and end, relative to this date's midnight
+        offset = datetime.timedelta(days=days)
+        window_start = time_since_midnight - offset
+        window_end = window_start + duration
+        if window_end <= datetime.timedelta():
+            continue
+
+        calendars = get_calendars(date)
+        annotations = {
+            'service_date': Value(date, output_field=DateField()),
+        }
+        day_times = times.filter(trip__route__in=routes, trip__calendar__in=calendars).annotate(
+            **annotations, time=F('departure') + Value(offset, output_field=SecondsField())
+        )
+        if pattern_stops is not None:
+            day_pattern_stops = pattern_stops.filter(
+                pattern__trip__route__in=routes, pattern__trip__calendar__in=calendars
+            ).annotate(
+                **annotations,
+                trip_id=F('pattern__trip__id'),
+                departure_time=F('pattern__trip__start') + F('departure'),
+            ).annotate(
+                time=F('departure_time') + Value(offset, output_field=SecondsField())
+            )
+
+        for recent, low, high in (
+            (False, window_start, window_end),
+            (True, window_start - one_hour, window_start),
+        ):
+            if high <= datetime.timedelta():
+                continue
+            part = day_times.filter(departure__gte=low, departure__lt=high)
+            if recent:
+                part = part[:1]
+                recent_parts += 1
+            time_parts.append(part)
+            if pattern_stops is not None:
+                part = day_pattern_stops.filter(departure_time__gte=low, departure_time__lt=high)
+                if recent:
+                    part = part[:1]
+                pattern_parts.append(part)
+
+    if not time_parts:
+        return times.none(), None, 0
+
+    times = time_parts[0].union(*time_parts[1:], all=True).order_by('time')
+    if pattern_parts:
+        pattern_stops = pattern_parts[0].union(*pattern_parts[1:], all=True).order_by('time')
+    return times, pattern_stops, recent_parts
 
 
 def get_departures(stop, services):
@@ -546,14 +774,14 @@ def get_departures(stop, services):
         else:
             routes[route.service_id] = [route]
 
-    departures = TimetableDepartures(stop, services, now, routes)
-    departures = departures.get_departures()
+    timetable_departures = TimetableDepartures(stop, services, now, routes)
+    departures = timetable_departures.get_departures()
 
     one_hour = datetime.timedelta(hours=1)
 
-    if not departures or (departures[0]['time'] - now) < one_hour or (
-        get_stop_times(now - one_hour, stop.atco_code, services, routes)
-    ).exists():
+    if not departures or (departures[0]['time'] - now) < one_hour or timetable_departures.recent or (
+        departures[0]['time'].date() == (now - one_hour).date()  # (later today)
+    ):
 
         operators = set()
         for service in services:
@@ -565,20 +793,20 @@ def get_departures(stop, services):
 
         # Belfast
         if stop.atco_code[0] == '7' and ('Translink Metro' in operators or 'Translink Glider' in operators):
-            live_rows = AcisHorizonDepartures(stop, services).get_departures()
+            live_rows, = fetch_live_departures([AcisHorizonDepartures(stop, services)])
             if live_rows:
                 blend(departures, live_rows)
         elif departures:
+            # work out which sources to ask, then ask them all at once
+            sources = {}
+
             if (
                 'Lothian Buses' in operators
                 or 'Lothian Country Buses' in operators
                 or 'East Coast Buses' in operators
                 or 'Edinburgh Trams' in operators
             ):
-                live_rows = EdinburghDepartures(stop, services, now).get_departures()
-            if live_rows:
-                blend(departures, live_rows)
-                live_rows = None
+                sources['edinburgh'] = EdinburghDepartures(stop, services, now)
 
             source = None
 
@@ -593,21 +821,33 @@ def get_departures(stop, services):
                         break
 
             if source:
-                live_rows = SiriSmDepartures(source, stop, services).get_departures()
+                sources['live'] = SiriSmDepartures(source, stop, services)
             elif stop.atco_code[:3] == '430':
-                live_rows = WestMidlandsDepartures(stop, services).get_departures()
+                sources['live'] = WestMidlandsDepartures(stop, services)
             elif stop.atco_code[:3] == '290':
-                live_rows = NorfolkDepartures(stop, services, now).get_departures()
+                sources['live'] = NorfolkDepartures(stop, services, now)
+            else:
+                sources['live'] = AvlDepartures(stop, services)
 
             if any(operator[:11] == 'Stagecoach ' for operator in operators):
+                # (only used if the other live source doesn't have any live Stagecoach times)
+                sources['stagecoach'] = StagecoachDepartures(stop, services)
+
+            results = dict(zip(sources, fetch_live_departures(list(sources.values()))))
+
+            if results.get('edinburgh'):
+                blend(departures, results['edinburgh'])
+
+            live_rows = results.get('live')
+
+            stagecoach_rows = results.get('stagecoach')
+            if stagecoach_rows:
                 if not (live_rows and any(
                     row.get('live') and type(row['service']) is Service and any(
                         operator.name[:11] == 'Stagecoach ' for operator in row['service'].operator.all()
                     ) for row in live_rows
                 )):
-                    stagecoach_rows = StagecoachDepartures(stop, services).get_departures()
-                    if stagecoach_rows:
-                        blend(departures, stagecoach_rows)
+                    blend(departures, stagecoach_rows)
 
             if live_rows:
                 blend(departures, live_rows)
@@ -657,3 +897,96 @@ def get_departures(stop, services):
         'departures': departures,
         'today': now.date(),
     },  max_age)
+
+
+def count(counter):
+    key = f'departures_cache:{counter}'
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:  # expired in the meantime
+            pass
+
+
+def get_cache_stats():
+    """Returns a dictionary of get_cached_departures's hit, miss, stale and lock_wait counts"""
+    counts = cache.get_many([f'departures_cache:{counter}' for counter in CACHE_COUNTERS])
+    return {
+        counter: counts.get(f'departures_cache:{counter}', 0) for counter in CACHE_COUNTERS
+    }
+
+
+def build_departures(stop, services):
+    departures, max_age = get_departures(stop, services)
+    if hasattr(departures['departures'], 'get_departures'):
+        departures['departures'] = departures['departures'].get_departures()
+    return departures, max_age
+
+
+def refresh_departures(stop, services, key):
+    """Builds a board and caches it, alongside the time it should be refreshed -
+    for STALE_AGE seconds beyond that, so it can be served while it's being refreshed
+    """
+    try:
+        departures, max_age = build_departures(stop, services)
+        if max_age:
+            fresh_until = timezone.now() + datetime.timedelta(seconds=max_age)
+            cache.set(key, (departures, fresh_until), max_age + STALE_AGE)
+        return departures
+    finally:
+        cache.delete(f'{key}:lock')
+
+
+def refresh_departures_in_background(stop, services, key):
+    try:
+        refresh_departures(stop, services, key)
+    except Exception as e:
+        logger.error(e, exc_info=True)
+    finally:
+        connections.close_all()
+
+
+def get_cached_departures(stop, services):
+    """Like get_departures, but only returns the context dictionary, and uses the cache.
+
+    Only one worker at a time (whichever gets the lock) builds a board for a stop -
+    meanwhile, others are served the stale board, or wait for up to LOCK_WAIT seconds for a new one.
+    A board that's nearly due to expire is refreshed in the background.
+    """
+    key = f'{stop.atco_code}:departures'
+    lock_key = f'{key}:lock'
+
+    cached = cache.get(key)
+    if cached is not None:
+        departures, fresh_until = cached
+        seconds_left = (fresh_until - timezone.now()).total_seconds()
+        if seconds_left > REFRESH_AHEAD:
+            count('hit')
+            return departures
+        if seconds_left > 0:
+            count('hit')
+            if cache.add(lock_key, True, LOCK_AGE):
+                REFRESH_EXECUTOR.submit(refresh_departures_in_background, stop, services, key)
+            return departures
+        if not cache.add(lock_key, True, LOCK_AGE):
+            count('stale')  # another worker is refreshing it
+            return departures
+        count('miss')
+        return refresh_departures(stop, services, key)
+
+    if cache.add(lock_key, True, LOCK_AGE):
+        count('miss')
+        return refresh_departures(stop, services, key)
+
+    # another worker is building the board - wait for it
+    count('lock_wait')
+    waited = 0
+    while waited < LOCK_WAIT:
+        sleep(0.1)
+        waited += 0.1
+        cached = cache.get(key)
+        if cached is not None:
+            return cached[0]
+
+    count('miss')
+    return build_departures(stop, services)[0]
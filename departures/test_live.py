@@ -4,12 +4,18 @@
 import vcr
 import time_machine
 import datetime
+from time import sleep, time
 from unittest.mock import patch
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.shortcuts import render
+from django.utils import timezone
 from busstops.models import StopPoint, Service, Region, Operator, StopUsage, AdminArea, DataSource, SIRISource
 from bustimes.models import Route, Trip, Calendar, StopTime
-from vehicles.models import VehicleJourney
+from vehicles.management.arrival_predictions import ArrivalPredictions, remove_stale_predictions
+from vehicles.management.schedule_adherence import Shape
+from vehicles.models import VehicleJourney, VehicleLocation
+from vehicles.utils import PREDICTION_UPDATES, PREDICTIONS_MAX_AGE
 from . import live
 
 
@@ -183,7 +189,7 @@ class LiveDeparturesTest(TestCase):
     @time_machine.travel(datetime.datetime(2017, 3, 14, 20))
     def test_stagecoach(self):
         with vcr.use_cassette('data/vcr/stagecoach.yaml'):
-            with self.assertNumQueries(9):
+            with self.assertNumQueries(6):
                 res = self.client.get('/stops/64801092')
         self.assertContains(res, '<td><a href="/services/15">15</a></td>', html=True)
         self.assertContains(res, '<td>Hillend</td>')
@@ -201,7 +207,7 @@ class LiveDeparturesTest(TestCase):
     @time_machine.travel(datetime.datetime(2017, 3, 28, 17))
     def test_stagecoach_timezone(self):
         with vcr.use_cassette('data/vcr/stagecoach_timezone.yaml'):
-            with self.assertNumQueries(9):
+            with self.assertNumQueries(6):
                 res = self.client.get('/stops/64801092')
         departures = res.context_data['departures']
         self.assertEqual(6, len(departures))
@@ -216,6 +222,126 @@ class LiveDeparturesTest(TestCase):
         self.assertEqual(str(departures[2]['time']), '2017-03-28 19:08:00+01:00')
         self.assertEqual(str(departures[2]['live']), '2017-03-28 19:08:25+01:00')
 
+    @time_machine.travel(datetime.datetime(2017, 3, 15, 0, 10))
+    def test_timetable_departures_after_midnight(self):
+        trip = Trip.objects.filter(calendar__start_date='2017-03-14').first()
+        late_trip = Trip.objects.create(calendar=trip.calendar, route=trip.route, destination=self.cardiff_stop,
+                                        start='24:00:00', end='24:45:00')
+        StopTime.objects.create(trip=late_trip, sequence=0, departure='24:30:00', stop=self.stagecoach_stop)
+
+        departures = live.TimetableDepartures(self.stagecoach_stop, [self.stagecoach_service],
+                                              timezone.localtime(), {trip.route.service_id: [trip.route]})
+        with self.assertNumQueries(1):
+            rows = departures.get_departures()
+        self.assertEqual(1, len(rows))
+        self.assertEqual(str(rows[0]['time']), '2017-03-15 00:30:00+00:00')
+        self.assertEqual(str(rows[0]['origin_departure_time']), '2017-03-15 00:00:00+00:00')
+        # the 21:23 departure was more than an hour ago
+        self.assertFalse(departures.recent)
+
+    def test_fetch_live_departures(self):
+        class SlowDepartures(live.Departures):
+            def get_departures(self):
+                sleep(0.5)
+                return ['slow']
+
+        class FastDepartures(live.Departures):
+            def get_departures(self):
+                return ['fast']
+
+        class BrokenDepartures(live.Departures):
+            def get_departures(self):
+                raise ValueError
+
+        sources = [SlowDepartures(None, ()), FastDepartures(None, ()), BrokenDepartures(None, ())]
+        with self.assertLogs('departures.live', 'INFO') as logs:
+            self.assertEqual([None, ['fast'], None], live.fetch_live_departures(sources, timeout=0.2))
+        self.assertIn('WARNING:departures.live:SlowDepartures took more than 0.2 seconds', logs.output)
+        self.assertLess(sources[1].latency, 0.2)
+
+    def test_avl_departures(self):
+        service = self.stagecoach_service
+        shape = Shape([
+            ('64801091', (-2.7, 54.3), 0),
+            (self.stagecoach_stop.atco_code, (-2.7, 54.31), 600),
+            ('64801093', (-2.7, 54.32), 1200)
+        ])
+        start = timezone.now().replace(microsecond=0)
+        journey = VehicleJourney(id=1, service=service, destination='Kendal')
+        location = VehicleLocation(journey=journey)
+        location.progress = (shape, start, 300, 420)  # halfway to the stop, 2 minutes late
+
+        predictions = ArrivalPredictions()
+        r = live.redis.from_url(live.settings.REDIS_URL)
+        pipeline = r.pipeline(transaction=False)
+        predictions.add_to_pipeline(pipeline, [location])
+        pipeline.execute()
+
+        departures = live.AvlDepartures(self.stagecoach_stop, [service]).get_departures()
+        self.assertEqual(departures, [{
+            'time': start + datetime.timedelta(minutes=10),
+            'live': start + datetime.timedelta(minutes=12),
+            'service': service,
+            'destination': 'Kendal',
+        }])
+
+        # past the stop
+        location.progress = (shape, start, 900, 1020)
+        pipeline = r.pipeline(transaction=False)
+        predictions.add_to_pipeline(pipeline, [location])
+        pipeline.execute()
+        self.assertEqual(live.AvlDepartures(self.stagecoach_stop, [service]).get_departures(), [])
+        self.assertTrue(r.hexists('predictions64801093', 1))
+
+        # so late it's probably the wrong trip
+        location.progress = (shape, start, 900, 4600)
+        pipeline = r.pipeline(transaction=False)
+        predictions.add_to_pipeline(pipeline, [location])
+        pipeline.execute()
+        self.assertFalse(r.hexists('predictions64801093', 1))
+
+        # stopped being tracked
+        location.progress = (shape, start, 900, 1020)
+        pipeline = r.pipeline(transaction=False)
+        predictions.add_to_pipeline(pipeline, [location])
+        pipeline.execute()
+        self.assertTrue(r.hexists('predictions64801093', 1))
+        remove_stale_predictions(r, time() + 60)
+        self.assertTrue(r.hexists('predictions64801093', 1))
+        remove_stale_predictions(r, time() + PREDICTIONS_MAX_AGE + 1)
+        self.assertFalse(r.exists('predictions64801093', PREDICTION_UPDATES))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_get_cached_departures(self):
+        board = {'departures': [], 'today': datetime.date(2017, 3, 14)}
+        key = f'{self.cardiff_stop.atco_code}:departures'
+
+        with time_machine.travel(datetime.datetime(2017, 3, 14, 20), tick=False) as traveller:
+            with patch('departures.live.get_departures', return_value=(board, 60)) as get_departures:
+                self.assertEqual(board, live.get_cached_departures(self.cardiff_stop, []))
+                self.assertEqual(board, live.get_cached_departures(self.cardiff_stop, []))
+                self.assertEqual(1, get_departures.call_count)
+
+                # expired, but another worker is refreshing it
+                traveller.shift(61)
+                cache.add(f'{key}:lock', True)
+                self.assertEqual(board, live.get_cached_departures(self.cardiff_stop, []))
+                self.assertEqual(1, get_departures.call_count)
+
+                # expired, so refresh it
+                cache.delete(f'{key}:lock')
+                self.assertEqual(board, live.get_cached_departures(self.cardiff_stop, []))
+                self.assertEqual(2, get_departures.call_count)
+
+                # nothing cached, and another worker is taking too long
+                cache.delete(key)
+                cache.add(f'{key}:lock', True)
+                with patch('departures.live.LOCK_WAIT', 0.2):
+                    self.assertEqual(board, live.get_cached_departures(self.cardiff_stop, []))
+                self.assertEqual(3, get_departures.call_count)
+
+        self.assertEqual({'hit': 1, 'miss': 3, 'stale': 1, 'lock_wait': 1}, live.get_cache_stats())
+
     def test_blend(self):
         service = Service(line_name='X98')
         a = [{
@@ -243,6 +369,27 @@ class LiveDeparturesTest(TestCase):
             'live': datetime.datetime(2017, 4, 21, 20, 5)
         }])
 
+    def test_blend_window(self):
+        time = timezone.make_aware(datetime.datetime(2021, 3, 1, 12))
+        minute = datetime.timedelta(minutes=1)
+        departures = [
+            {'service': 'x1', 'time': time - minute},
+            {'service': 'X1', 'time': time},
+            {'service': '2', 'time': time},
+        ]
+        live.blend(departures, [
+            {'service': 'X1', 'time': time + minute, 'live': time + 3 * minute},  # matches the first X1
+            {'service': '2', 'time': time + 2 * minute, 'live': time + 2 * minute},  # exactly 2 minutes
+            {'service': '2', 'time': time + 3 * minute, 'live': time + 4 * minute},  # too late
+            {'service': '2', 'time': time + 4 * minute, 'live': time + 5 * minute},  # matches the previous one
+        ])
+        self.assertEqual(departures, [
+            {'service': 'X1', 'time': time},
+            {'service': '2', 'time': time, 'live': time + 2 * minute},
+            {'service': 'x1', 'time': time - minute, 'live': time + 3 * minute},
+            {'service': '2', 'time': time + 3 * minute, 'live': time + 5 * minute},
+        ])
+
     def test_render(self):
         response = render(None, 'departures.html', {
             'departures': [
@@ -276,7 +423,7 @@ class LiveDeparturesTest(TestCase):
     def test_worcestershire(self, log_vehicle_journey):
         with time_machine.travel('Sat Feb 09 10:45:45 GMT 2019'):
             with vcr.use_cassette('data/vcr/worcester.yaml'):
-                with self.assertNumQueries(10):
+                with self.assertNumQueries(7):
                     response = self.client.get(self.worcester_stop.get_absolute_url())
             with vcr.use_cassette('data/vcr/worcester.yaml'):
                 with self.assertNumQueries(3):
@@ -0,0 +1,172 @@
+"""Journey location histories that have been moved out of Redis by the archive_journey_locations command.
+
+There's one file per (local) day, named like 2020-11-28.bin:
+
+    b'BTJA', number of journeys
+    (journey id, offset, length) for each journey, ordered by journey id
+    a zlib-compressed block for each journey
+
+and each block contains the number of locations, then columns of times, latitudes and longitudes (delta-encoded),
+headings and earlinesses - in the same units as VehicleLocation.get_appendage's records.
+"""
+
+import os
+import fcntl
+import mmap
+import struct
+import zlib
+from datetime import datetime, timezone
+from itertools import accumulate
+from django.conf import settings
+from django.utils.timezone import localdate
+from .models import NONE_SHORT
+
+
+HEADER = struct.Struct('<4sI')
+MAGIC = b'BTJA'
+INDEX_ENTRY = struct.Struct('<III')
+COUNT = struct.Struct('<I')
+
+
+def get_path(date):
+    return os.path.join(settings.JOURNEY_ARCHIVE_DIR, f'{date}.bin')
+
+
+def get_date(when):
+    return localdate(when)
+
+
+def get_deltas(values):
+    return [values[0]] + [b - a for a, b in zip(values, values[1:])]
+
+
+def encode_track(locations):
+    """Returns a compressed block from a list of (datetime, (longitude, latitude), heading, early) tuples,
+    like the ones from VehicleLocation.decode_appendage
+    """
+    locations = sorted(locations, key=lambda location: location[0])
+    count = len(locations)
+    times = [int(location[0].timestamp()) for location in locations]
+    latitudes = [round(location[1][1] * 1000000) for location in locations]
+    longitudes = [round(location[1][0] * 1000000) for location in locations]
+    headings = [NONE_SHORT if location[2] is None else round(location[2]) for location in locations]
+    earlies = [NONE_SHORT if location[3] is None else location[3] for location in locations]
+
+    return zlib.compress(b''.join((
+        COUNT.pack(count),
+        struct.pack(f'<{count}i', *get_deltas(times)),
+        struct.pack(f'<{count}i', *get_deltas(latitudes)),
+        struct.pack(f'<{count}i', *get_deltas(longitudes)),
+        struct.pack(f'<{count}h', *headings),
+        struct.pack(f'<{count}h', *earlies),
+    )))
+
+
+def decode_track(block):
+    data = zlib.decompress(block)
+    count, = COUNT.unpack_from(data)
+    offset = COUNT.size
+
+    columns = []
+    for code in 'iiihh':
+        column = struct.unpack_from(f'<{count}{code}', data, offset)
+        offset += struct.calcsize(f'<{count}{code}')
+        columns.append(column)
+    times, latitudes, longitudes, headings, earlies = columns
+
+    return [(
+        datetime.fromtimestamp(when, timezone.utc),
+        (longitude / 1000000, latitude / 1000000),
+        None if heading == NONE_SHORT else heading,
+        None if early == NONE_SHORT else early
+    ) for when, latitude, longitude, heading, early in zip(
+        accumulate(times), accumulate(latitudes), accumulate(longitudes), headings, earlies
+    )]
+
+
+def read_index(data):
+    magic, count = HEADER.unpack_from(data)
+    assert magic == MAGIC
+    return [INDEX_ENTRY.unpack_from(data, HEADER.size + i * INDEX_ENTRY.size) for i in range(count)]
+
+
+def read_day(date):
+    """Returns a dict of journey ids to compressed blocks"""
+    try:
+        with open(get_path(date), 'rb') as open_file:
+            data = open_file.read()
+    except FileNotFoundError:
+        return {}
+    return {journey_id: data[offset:offset + length] for journey_id, offset, length in read_index(data)}
+
+
+def write_day(date, tracks):
+    """Adds tracks (a dict of journey ids to lists of locations) to a day's file,
+    merging them with any locations already archived for the same journeys.
+
+    Holds a lock on the day's .lock file throughout, so that two processes can't both read the file
+    and then each write it back without the other's tracks
+    """
+    path = get_path(date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when lock_file is closed
+
+        blocks = read_day(date)
+        for journey_id, locations in tracks.items():
+            if journey_id in blocks:
+                locations = set(locations).union(decode_track(blocks[journey_id]))
+            blocks[journey_id] = encode_track(locations)
+
+        journey_ids = sorted(blocks)
+        index = []
+        offset = HEADER.size + INDEX_ENTRY.size * len(journey_ids)
+        for journey_id in journey_ids:
+            index.append(INDEX_ENTRY.pack(journey_id, offset, len(blocks[journey_id])))
+            offset += len(blocks[journey_id])
+
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as open_file:
+            open_file.write(HEADER.pack(MAGIC, len(journey_ids)))
+            open_file.writelines(index)
+            open_file.writelines(blocks[journey_id] for journey_id in journey_ids)
+        os.replace(temp_path, path)  # so readers never see a half-written file
+
+
+def get_journey_ids(date):
+    """Returns the set of ids of journeys archived on a day"""
+    try:
+        with open(get_path(date), 'rb') as open_file:
+            magic, count = HEADER.unpack(open_file.read(HEADER.size))
+            index = open_file.read(INDEX_ENTRY.size * count)
+    except FileNotFoundError:
+        return set()
+    return {journey_id for journey_id, _, _ in INDEX_ENTRY.iter_unpack(index)}
+
+
+def read_track(when, journey_id):
+    """Returns a list of (datetime, (longitude, latitude), heading, early) tuples for the journey that started at when,
+    or None if it hasn't been archived.
+
+    Memory-maps the day's file and does a binary search of its index, so only the journey's own block is read
+    """
+    try:
+        open_file = open(get_path(get_date(when)), 'rb')
+    except FileNotFoundError:
+        return
+
+    with open_file, mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, count = HEADER.unpack_from(data)
+        assert magic == MAGIC
+
+        low = 0
+        high = count
+        while low < high:
+            middle = (low + high) // 2
+            entry_id, offset, length = INDEX_ENTRY.unpack_from(data, HEADER.size + middle * INDEX_ENTRY.size)
+            if entry_id == journey_id:
+                return decode_track(data[offset:offset + length])
+            if entry_id < journey_id:
+                low = middle + 1
+            else:
+                high = middle
@@ -0,0 +1,81 @@
+import json
+import redis
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import WebsocketConsumer
+from django.conf import settings
+from .utils import BUCKET_SUBSCRIPTIONS, BUCKET_SUBSCRIPTION_TTL, get_buckets, get_milliseconds
+from .views import get_vehicle_ids_in_box, get_vehicles_json
+
+
+class VehicleMapConsumer(WebsocketConsumer):
+    """Sends a map the vehicles in its viewport - all of them at first, and then changes as they happen,
+    in the same format as vehicles_json with a 'since' parameter.
+
+    The map sends its bounds (as JSON like [xmin, ymin, xmax, ymax]) whenever it moves, and every minute anyway.
+    The consumer subscribes to the channel groups of the "buckets" covering the bounds,
+    which ImportLiveVehiclesCommand.send_to_groups sends updates to - and renews the buckets' subscriptions
+    whenever it gets the bounds, so they expire if the consumer dies
+    """
+
+    def connect(self):
+        self.redis = redis.from_url(settings.REDIS_URL)
+        self.bounds = None
+        self.buckets = set()
+        self.location_ids = set()  # vehicles the map knows about
+        self.accept()
+
+    def disconnect(self, code):
+        self.subscribe(set())
+
+    def subscribe(self, buckets):
+        for bucket in self.buckets - buckets:
+            async_to_sync(self.channel_layer.group_discard)(bucket, self.channel_name)
+        for bucket in buckets - self.buckets:
+            async_to_sync(self.channel_layer.group_add)(bucket, self.channel_name)
+        if buckets:
+            # (replacing other websockets' expiry times for the same buckets, which can only be earlier)
+            expires = get_milliseconds() + BUCKET_SUBSCRIPTION_TTL * 1000
+            self.redis.zadd(BUCKET_SUBSCRIPTIONS, {bucket: expires for bucket in buckets})
+        self.buckets = buckets
+
+    def receive(self, text_data=None, bytes_data=None):
+        try:
+            bounds = xmin, ymin, xmax, ymax = tuple(float(value) for value in json.loads(text_data))
+        except (TypeError, ValueError):
+            return
+
+        buckets = get_buckets(xmin, ymin, xmax, ymax)
+        if buckets is None:
+            self.close(4000)  # too big (or nonsense) - the map should fall back to polling vehicles_json
+            return
+
+        self.subscribe(buckets)
+        if bounds == self.bounds:
+            return  # the map hasn't moved, it's just keeping the subscriptions alive
+        self.bounds = bounds
+
+        vehicles = get_vehicles_json(self.redis, get_vehicle_ids_in_box(self.redis, xmin, ymin, xmax, ymax))
+        self.location_ids = {item['id'] for item in json.loads(vehicles)}
+        self.send(text_data=(b'{"full": true, "vehicles": %s, "expired": []}' % vehicles).decode())
+
+    def vehicle_locations(self, event):
+        xmin, ymin, xmax, ymax = self.bounds
+
+        vehicles = []
+        expired = []
+        for location_id, (x, y), item in event['items']:
+            if xmin <= x <= xmax and ymin <= y <= ymax:
+                vehicles.append(item)
+                self.location_ids.add(location_id)
+            elif location_id in self.location_ids:
+                # moved out of the viewport
+                expired.append(location_id)
+                self.location_ids.remove(location_id)
+        for location_id in event['expired']:
+            if location_id in self.location_ids:
+                expired.append(location_id)
+                self.location_ids.remove(location_id)
+
+        if vehicles or expired:
+            vehicles = ','.join(vehicles)
+            self.send(text_data=f'{{"full": false, "vehicles": [{vehicles}], "expired": {json.dumps(expired)}}}')
@@ -0,0 +1,116 @@
+import json
+from datetime import timedelta
+from django.utils import timezone
+from ..utils import PREDICTION_UPDATES, PREDICTIONS_MAX_AGE, PREDICTIONS_TTL, get_predictions_key
+
+
+class ArrivalPredictions:
+    """Predicts when vehicles will reach the stops ahead of them, from how early or late they're running
+    (worked out by ScheduleAdherence), and writes the predictions to each stop's predictions{stop id} hash in Redis
+    - for departures.live.AvlDepartures.
+
+    Lateness is assumed to carry on to the end of the trip. Earliness isn't, because a vehicle that's running early
+    is supposed to wait at timing points.
+
+    To save rewriting every downstream stop of every vehicle every time, predictions are only rewritten when a
+    journey's delay (to the nearest minute) changes, when it passes a stop, or every rewrite_interval anyway
+    (so AvlDepartures can ignore predictions for vehicles that have stopped being tracked,
+    and remove_stale_predictions can remove them)
+    """
+    max_delay = 3600  # seconds - anything more is more likely to be a mismatched trip
+    rewrite_interval = timedelta(seconds=PREDICTIONS_MAX_AGE / 2)
+    prune_interval = timedelta(hours=1)
+
+    def __init__(self):
+        self.journeys = {}  # journey id: (ids of stops still to come, delay in minutes, when they were written)
+        self.pruned_at = None
+
+    def prune(self, now):
+        if not self.pruned_at or now - self.pruned_at > self.prune_interval:
+            self.journeys = {
+                journey_id: journey for journey_id, journey in self.journeys.items()
+                if now - journey[2] < self.prune_interval
+            }
+            self.pruned_at = now
+
+    @staticmethod
+    def remove(pipeline, journey_id, stop_ids):
+        """Adds commands to a Redis pipeline to delete a journey's predictions for some stops"""
+        if stop_ids:
+            for stop_id in stop_ids:
+                pipeline.hdel(get_predictions_key(stop_id), journey_id)
+            pipeline.zrem(PREDICTION_UPDATES, *(f'{stop_id}:{journey_id}' for stop_id in stop_ids))
+
+    def add_to_pipeline(self, pipeline, locations):
+        """Adds commands to a Redis pipeline to update predictions for the journeys of a batch of VehicleLocations
+        (those that ScheduleAdherence.set_earlinesses has given a progress attribute)
+        """
+        now = timezone.now()
+        self.prune(now)
+        updated = int(now.timestamp())
+
+        for location in locations:
+            if not hasattr(location, 'progress'):
+                continue
+            journey = location.journey
+            shape, start_datetime, scheduled, actual = location.progress
+
+            delay = actual - scheduled
+            if delay > self.max_delay:
+                previous = self.journeys.pop(journey.id, None)
+                if previous:
+                    self.remove(pipeline, journey.id, previous[0])
+                continue
+            delay = max(delay, 0)
+            minutes = round(delay / 60)
+
+            stops = {}  # (if a trip calls at a stop more than once, the next call)
+            for stop_id, seconds in shape.stops:
+                if seconds > scheduled and stop_id not in stops:
+                    stops[stop_id] = seconds
+
+            previous = self.journeys.get(journey.id)
+            if previous:
+                previous_stops, previous_minutes, written_at = previous
+                if (
+                    previous_minutes == minutes and len(previous_stops) == len(stops)
+                    and now - written_at < self.rewrite_interval
+                ):
+                    continue  # nothing much has changed
+                self.remove(pipeline, journey.id, [
+                    stop_id for stop_id in previous_stops if stop_id not in stops  # passed them
+                ])
+
+            start = start_datetime.timestamp()
+            for stop_id, seconds in stops.items():
+                aimed = int(start + seconds)
+                key = get_predictions_key(stop_id)
+                pipeline.hset(key, journey.id, json.dumps({
+                    'service': journey.service_id,
+                    'destination': journey.destination,
+                    'aimed': aimed,
+                    'expected': aimed + int(delay),
+                    'updated': updated,
+                }))
+                pipeline.expire(key, PREDICTIONS_TTL)
+            if stops:
+                pipeline.zadd(PREDICTION_UPDATES, {f'{stop_id}:{journey.id}': updated for stop_id in stops})
+
+            self.journeys[journey.id] = (list(stops), minutes, now)
+
+
+def remove_stale_predictions(r, now):
+    """Removes predictions that haven't been updated for PREDICTIONS_MAX_AGE seconds (because their vehicles have
+    stopped being tracked, or the process tracking them has restarted) from stops' predictions{stop id} hashes.
+
+    now is a Unix timestamp in seconds
+    """
+    stale_before = now - PREDICTIONS_MAX_AGE
+    members = r.zrangebyscore(PREDICTION_UPDATES, '-inf', stale_before)
+    if members:
+        pipeline = r.pipeline(transaction=False)
+        for member in members:
+            stop_id, journey_id = member.decode().rsplit(':', 1)
+            pipeline.hdel(get_predictions_key(stop_id), journey_id)
+        pipeline.zremrangebyscore(PREDICTION_UPDATES, '-inf', stale_before)
+        pipeline.execute()
@@ -0,0 +1,64 @@
+"""Move finished journeys' location histories out of Redis and into vehicles.archive's files.
+
+A journey is finished if its vehicle has moved on to another journey, or if it started more than --hours ago
+"""
+
+import redis
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from ... import archive
+from ...models import Vehicle, VehicleJourney, VehicleLocation
+
+
+class Command(BaseCommand):
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--hours', type=int, default=12)
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, hours, chunk_size, **options):
+        r = redis.from_url(settings.REDIS_URL)
+        cutoff = timezone.now() - timedelta(hours=hours)
+
+        journey_ids = [int(key[7:]) for key in r.scan_iter('journey*', count=chunk_size) if key[7:].isdigit()]
+
+        archived = 0
+        for i in range(0, len(journey_ids), chunk_size):
+            journeys = VehicleJourney.objects.filter(
+                id__in=journey_ids[i:i + chunk_size]
+            ).annotate(
+                latest=Exists(Vehicle.objects.filter(latest_journey=OuterRef('pk')))
+            ).filter(
+                Q(latest=False) | Q(datetime__lt=cutoff)
+            ).values_list('id', 'datetime')
+            journeys = list(journeys)
+            if not journeys:
+                continue
+
+            pipeline = r.pipeline(transaction=False)
+            for journey_id, _ in journeys:
+                pipeline.lrange(f'journey{journey_id}', 0, -1)
+            histories = pipeline.execute()
+
+            days = {}
+            for (journey_id, when), history in zip(journeys, histories):
+                if history:
+                    locations = [VehicleLocation.decode_appendage(location) for location in history]
+                    days.setdefault(archive.get_date(when), {})[journey_id] = locations
+
+            for date, tracks in days.items():
+                archive.write_day(date, tracks)
+
+            # only remove them from Redis once they've been safely written -
+            # and only the locations that were read, not any that have been pushed since
+            pipeline = r.pipeline(transaction=False)
+            for (journey_id, _), history in zip(journeys, histories):
+                if history:
+                    pipeline.ltrim(f'journey{journey_id}', len(history), -1)
+            pipeline.execute()
+            archived += len(journeys)
+
+        self.stdout.write(f'{archived} journeys archived')
@@ -0,0 +1,97 @@
+"""Time ScheduleAdherence.set_earlinesses and ArrivalPredictions.add_to_pipeline
+on a made-up national snapshot of vehicles, in chunks the size that ImportLiveVehiclesCommand.update handles them.
+
+Postgres and Redis aren't involved - the trips' shapes are made up too, and put straight into the
+ScheduleAdherence's cache - so this measures the projecting and interpolating, not the (once an hour per trip) loading,
+and counts the Redis commands without sending them.
+
+    ./manage.py benchmark_schedule_adherence --vehicles 20000
+"""
+
+import random
+from datetime import timedelta
+from time import perf_counter
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from ...models import VehicleJourney, VehicleLocation
+from ..arrival_predictions import ArrivalPredictions
+from ..schedule_adherence import ScheduleAdherence, Shape
+
+
+class FakePipeline:
+    """Just counts the commands that would have been sent to Redis"""
+    def __init__(self):
+        self.commands = 0
+
+    def hset(self, *args):
+        self.commands += 1
+
+    hdel = expire = hset
+
+
+def get_points(stops):
+    """A wiggly route with stops about 400 metres and a minute or two apart"""
+    lon = random.uniform(-5, 1)
+    lat = random.uniform(50.5, 55)
+    seconds = 0
+    points = []
+    for i in range(stops):
+        points.append((str(i), (lon, lat), seconds))
+        lon += random.uniform(-0.004, 0.008)
+        lat += random.uniform(-0.002, 0.004)
+        seconds += random.randrange(60, 150)
+    return points
+
+
+class Command(BaseCommand):
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--vehicles', type=int, default=20000)
+        parser.add_argument('--stops', type=int, default=40)
+        parser.add_argument('--chunk-size', type=int, default=50)
+
+    def handle(self, vehicles, stops, chunk_size, **options):
+        random.seed(vehicles)
+
+        schedule_adherence = ScheduleAdherence()
+        schedule_adherence.refresh()
+
+        now = timezone.now().replace(microsecond=0)
+        locations = []
+        for trip_id in range(vehicles):
+            points = get_points(stops)
+            start = timedelta(hours=random.randrange(6, 20), minutes=random.randrange(60))
+            schedule_adherence.shapes[trip_id] = (start, Shape(points))
+
+            # somewhere along the route, a few minutes either side of schedule
+            _, (lon, lat), seconds = random.choice(points)
+            journey = VehicleJourney(id=trip_id, trip_id=trip_id, service_id=trip_id % 200, datetime=now)
+            start_datetime = timezone.localtime(now).replace(hour=0, minute=0, second=0) + start
+            locations.append(VehicleLocation(
+                journey=journey,
+                latlong=Point(lon + random.uniform(-0.0005, 0.0005), lat + random.uniform(-0.0005, 0.0005)),
+                datetime=start_datetime + timedelta(seconds=seconds + random.randrange(-300, 900))
+            ))
+
+        start = perf_counter()
+        for i in range(0, vehicles, chunk_size):
+            schedule_adherence.set_earlinesses(locations[i:i + chunk_size])
+        time_taken = perf_counter() - start
+
+        matched = sum(1 for location in locations if location.early is not None)
+        self.stdout.write(
+            f'schedule adherence: {vehicles} vehicles ({matched} on their routes) in {time_taken:.3f} seconds '
+            f'- {vehicles / time_taken:.0f} vehicles/second'
+        )
+
+        arrival_predictions = ArrivalPredictions()
+        for cycle in ('first', 'second'):
+            pipeline = FakePipeline()
+            start = perf_counter()
+            for i in range(0, vehicles, chunk_size):
+                arrival_predictions.add_to_pipeline(pipeline, locations[i:i + chunk_size])
+            time_taken = perf_counter() - start
+            self.stdout.write(
+                f'arrival predictions ({cycle} cycle): {time_taken:.3f} seconds, {pipeline.commands} Redis commands'
+            )
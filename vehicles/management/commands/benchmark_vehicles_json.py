@@ -0,0 +1,119 @@
+"""Compare how many vehicles.json responses per second can be built from vehicles' JSON in Redis
+the old way (decoding every vehicle, and looking up its service) and the new way (stitching the saved JSON together),
+using made-up vehicles.
+
+Redis and Postgres aren't involved - a dict stands in for each - so the old way's Service query isn't counted,
+and the real difference is bigger than this shows.
+
+    ./manage.py benchmark_vehicles_json --vehicles 100 1000 5000
+"""
+
+import json
+import random
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from ...views import get_vehicles_json
+
+
+class FakePipeline:
+    def __init__(self, data):
+        self.data = data
+        self.keys = []
+
+    def get(self, key):
+        self.keys.append(key)
+
+    def execute(self):
+        return [self.data.get(key) for key in self.keys]
+
+
+class FakeRedis:
+    def __init__(self, data):
+        self.data = data
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self.data)
+
+
+def get_vehicles(count, detailed):
+    """Returns a dict of Redis keys to vehicles' JSON, as saved by ImportLiveVehiclesCommand.save -
+    with the services' details if detailed, or just their ids like it used to
+    """
+    random.seed(count)
+    now = timezone.now()
+    data = {}
+    for vehicle_id in range(count):
+        item = {
+            'id': vehicle_id,
+            'coordinates': (random.uniform(-5, 2), random.uniform(50, 58)),
+            'vehicle': {
+                'url': f'/vehicles/{vehicle_id}',
+                'name': f'{vehicle_id} - AB12\xa0CDE',
+                'livery': random.randrange(100),
+            },
+            'heading': random.randrange(360),
+            'datetime': now,
+            'destination': 'Great Yarmouth',
+        }
+        service_id = random.randrange(200)
+        if detailed:
+            item['service'] = {'line_name': str(service_id), 'url': f'/services/{service_id}'}
+        else:
+            item['service_id'] = service_id
+        data[f'vehicle{vehicle_id}'] = json.dumps(item, cls=DjangoJSONEncoder).encode()
+    return data
+
+
+def legacy_vehicles_json(r, vehicle_ids, services):
+    """The way vehicles_json used to work"""
+    pipeline = r.pipeline(transaction=False)
+    for vehicle_id in vehicle_ids:
+        pipeline.get(f'vehicle{int(vehicle_id)}')
+    vehicle_locations = pipeline.execute()
+
+    locations = []
+    for item in vehicle_locations:
+        if item:
+            item = json.loads(item)
+            locations.append(item)
+
+    for item in locations:
+        if 'service_id' in item:
+            if item['service_id']:
+                item['service'] = services[item['service_id']]
+            del item['service_id']
+
+    return JsonResponse(locations, safe=False)
+
+
+class Command(BaseCommand):
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--vehicles', nargs='+', type=int, default=[100, 1000, 5000])
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, vehicles, repeat, **options):
+        services = {service_id: {'line_name': str(service_id), 'url': f'/services/{service_id}'}
+                    for service_id in range(200)}
+
+        for count in vehicles:
+            vehicle_ids = list(range(count))
+
+            old = FakeRedis(get_vehicles(count, False))
+            start = perf_counter()
+            for _ in range(repeat):
+                old_response = legacy_vehicles_json(old, vehicle_ids, services)
+            old_rate = repeat / (perf_counter() - start)
+
+            new = FakeRedis(get_vehicles(count, True))
+            start = perf_counter()
+            for _ in range(repeat):
+                new_response = HttpResponse(get_vehicles_json(new, vehicle_ids), content_type='application/json')
+            new_rate = repeat / (perf_counter() - start)
+
+            assert json.loads(old_response.content) == json.loads(new_response.content)
+
+            self.stdout.write(f'{count} vehicles: {old_rate:.1f} responses/second before, {new_rate:.1f} after')
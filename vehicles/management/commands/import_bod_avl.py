@@ -1,20 +1,124 @@
 import io
+import zlib
+import struct
 import zipfile
 import xmltodict
+import xml.etree.cElementTree as ET
 from django.core.cache import cache
 from django.conf import settings
 from datetime import timedelta
-from xml.parsers.expat import ExpatError
 from ciso8601 import parse_datetime
 from django.contrib.gis.geos import Point
 from django.db.models import Q, Exists, OuterRef
 from busstops.models import Operator, OperatorCode, Service, Locality, StopPoint, ServiceCode
-from bustimes.models import Trip, StopTime
+from bustimes.models import Trip, StopTime, JourneyPatternStop
 from ..import_live_vehicles import ImportLiveVehiclesCommand
+from ..arrival_predictions import ArrivalPredictions
+from ..schedule_adherence import ScheduleAdherence
+from ..service_index import ServiceIndex
+from ..trip_index import TripIndex
 from ...models import Vehicle, VehicleJourney, VehicleLocation
 
 
 TWELVE_HOURS = timedelta(hours=12)
+SIRI_NAMESPACE = '{http://www.siri.org.uk/siri}'
+
+
+class ZipMemberStream(io.RawIOBase):
+    """The first file in a zip archive, decompressed while it's being read from a non-seekable stream
+    (like response.raw) - unlike zipfile.ZipFile, which needs the whole archive first
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        header = self.read_exactly(30)
+        signature, _, _, method, _, _, _, compressed_size, _, name_length, extra_length = struct.unpack(
+            '<IHHHHHIIIHH', header
+        )
+        if signature != 0x04034b50:
+            raise zipfile.BadZipFile('Bad magic number for file header')
+        self.name = self.read_exactly(name_length).decode()
+        self.read_exactly(extra_length)
+        if method == zipfile.ZIP_DEFLATED:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == zipfile.ZIP_STORED:
+            self.decompressor = None
+            self.remaining = compressed_size
+        else:
+            raise zipfile.BadZipFile(f'Unsupported compression method {method}')
+        self.buffer = b''
+
+    def read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.stream.read(size - len(data))
+            if not chunk:
+                raise zipfile.BadZipFile('Truncated file header')
+            data += chunk
+        return data
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.buffer:
+            if self.decompressor:
+                if self.decompressor.eof:
+                    return 0
+                chunk = self.decompressor.unconsumed_tail or self.stream.read(16384)
+                if not chunk:
+                    raise zipfile.BadZipFile('Truncated file data')
+                self.buffer = self.decompressor.decompress(chunk, len(buffer))
+            else:
+                if not self.remaining:
+                    return 0
+                self.buffer = self.stream.read(min(self.remaining, len(buffer)))
+                if not self.buffer:
+                    raise zipfile.BadZipFile('Truncated file data')
+                self.remaining -= len(self.buffer)
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def element_to_dict(element):
+    """Like xmltodict.parse, but for an ElementTree element"""
+    result = {}
+    for key, value in element.attrib.items():
+        result[f'@{key}'] = value
+    for child in element:
+        tag = child.tag.removeprefix(SIRI_NAMESPACE)
+        value = element_to_dict(child)
+        if tag not in result:
+            result[tag] = value
+        elif type(result[tag]) is list:
+            result[tag].append(value)
+        else:
+            result[tag] = [result[tag], value]
+    text = element.text and element.text.strip()
+    if text:
+        if not result:
+            return text
+        result['#text'] = text
+    return result or None
+
+
+def iter_siri_vm(open_file):
+    """Parses a SIRI-VM document bit by bit, yielding a ('ResponseTimestamp', string) tuple
+    and a ('VehicleActivity', dict) tuple for each vehicle, and discarding each element when it's been handled
+    """
+    parents = []
+    for event, element in ET.iterparse(open_file, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        tag = element.tag.removeprefix(SIRI_NAMESPACE)
+        if tag == 'VehicleActivity':
+            yield tag, element_to_dict(element)
+            parents[-1].remove(element)
+        elif tag == 'ResponseTimestamp' and parents[-1].tag.endswith('ServiceDelivery'):
+            yield tag, element.text
 
 
 class Command(ImportLiveVehiclesCommand):
@@ -39,6 +143,8 @@ class Command(ImportLiveVehiclesCommand):
     vehicle_cache = {}
     reg_operators = {'BDRB', 'COMT', 'TDY', 'ROST', 'CT4N', 'TBTN', 'OTSS'}
     identifiers = {}
+    service_index = None  # a ServiceIndex, for long-running processes
+    trip_index = None  # a TripIndex, likewise
 
     @staticmethod
     def get_datetime(item):
@@ -91,6 +197,36 @@ class Command(ImportLiveVehiclesCommand):
         vehicle_ref = monitored_vehicle_journey['VehicleRef'].replace(' ', '')
         return f'{operator_ref}-{vehicle_ref}'
 
+    def handle(self, *args, **options):
+        self.service_index = ServiceIndex()
+        self.trip_index = TripIndex()
+        self.schedule_adherence = ScheduleAdherence()
+        self.arrival_predictions = ArrivalPredictions()
+        super().handle(*args, **options)
+
+    def handle_items(self, items, now=None):
+        """Gets the vehicles whose IDs are already known (from earlier items, or in the shared cache) in one query,
+        before handling the items - and afterwards, shares any newly found vehicle IDs
+        """
+        cache_keys = {self.get_vehicle_cache_key(item) for item in items}
+        vehicle_ids = {  # code: id
+            key: self.vehicle_id_cache[key] for key in cache_keys if key in self.vehicle_id_cache
+        }
+        shared_vehicle_ids = cache.get_many(cache_keys - vehicle_ids.keys())
+        vehicle_ids.update(shared_vehicle_ids)
+        vehicles = self.vehicles.in_bulk(vehicle_ids.values())  # id: vehicle
+        self.vehicle_cache = {  # code: vehicle
+            key: vehicles[vehicle_id] for key, vehicle_id in vehicle_ids.items() if vehicle_id in vehicles
+        }
+
+        super().handle_items(items, now)
+
+        cache.set_many({
+            key: self.vehicle_id_cache[key]
+            for key in cache_keys
+            if key in self.vehicle_id_cache and shared_vehicle_ids.get(key) != self.vehicle_id_cache[key]
+        }, 43200)
+
     @staticmethod
     def get_line_name_query(line_ref):
         return (
@@ -194,13 +330,8 @@ class Command(ImportLiveVehiclesCommand):
             else:
                 destination_ref = destination_ref.removeprefix('NT')  # nottingham
 
-        cache_key = f"{vehicle_operator_id}:{line_ref}:{destination_ref}".replace(' ', '')
-        service = cache.get(cache_key)
-        if service is not None:
-            return service or None
-
-        # filter by LineRef or (if present and different) TicketMachineServiceCode
-        line_name_query = self.get_line_name_query(line_ref)
+        # LineRef and (if present and different) TicketMachineServiceCode
+        line_refs = [line_ref]
         try:
             ticket_machine_service_code = (
                 item['Extensions']['VehicleJourney']['Operational']['TicketMachine']['TicketMachineServiceCode']
@@ -209,7 +340,21 @@ class Command(ImportLiveVehiclesCommand):
             pass
         else:
             if ticket_machine_service_code.lower() != line_ref.lower():
-                line_name_query |= self.get_line_name_query(ticket_machine_service_code)
+                line_refs.append(ticket_machine_service_code)
+
+        if self.service_index:
+            found, service = self.service_index.get_service(operator, line_refs, destination_ref, vehicle_operator_id)
+            if found:
+                return service
+
+        cache_key = f"{vehicle_operator_id}:{line_ref}:{destination_ref}".replace(' ', '')
+        service = cache.get(cache_key)
+        if service is not None:
+            return service or None
+
+        line_name_query = self.get_line_name_query(line_refs[0])
+        for code in line_refs[1:]:
+            line_name_query |= self.get_line_name_query(code)
 
         services = Service.objects.using(settings.READ_DATABASE).filter(line_name_query, current=True)
 
@@ -258,6 +403,9 @@ class Command(ImportLiveVehiclesCommand):
                 if origin_ref:
                     trips = trips.filter(
                         Exists(StopTime.objects.filter(trip=OuterRef("pk"), sequence=0, stop=origin_ref))
+                        | Exists(JourneyPatternStop.objects.filter(
+                            pattern=OuterRef("pattern"), sequence=0, stop=origin_ref
+                        ))
                     )
                 try:
                     return services.get(Exists(trips))
@@ -389,7 +537,10 @@ class Command(ImportLiveVehiclesCommand):
             if journey.service and journey_ref and '_' not in journey_ref:
                 if not datetime:
                     datetime = self.get_datetime(item)
-                journey.trip = journey.get_trip(datetime, destination_ref)
+                if self.trip_index:
+                    journey.trip = self.trip_index.get_trip(journey, datetime, destination_ref)
+                else:
+                    journey.trip = journey.get_trip(datetime, destination_ref)
 
         return journey
 
@@ -426,8 +577,19 @@ class Command(ImportLiveVehiclesCommand):
             force_list=['VehicleActivity']
         )
 
+    def items_from_stream(self, open_file):
+        for tag, value in iter_siri_vm(open_file):
+            if tag == 'VehicleActivity':
+                yield value
+            else:
+                self.when = value
+                self.source.datetime = parse_datetime(self.when)
+
     def get_items(self):
-        response = self.session.get(self.source.url, params=self.source.settings)
+        """Yields VehicleActivity items while the response is still downloading,
+        so memory use doesn't grow with the size of the feed
+        """
+        response = self.session.get(self.source.url, params=self.source.settings, stream=True)
         if not response.ok:
             if 'datafeed' in self.source.url:
                 print(response.content.decode())
@@ -435,27 +597,15 @@ class Command(ImportLiveVehiclesCommand):
                 print(response)
             return
 
-        if 'datafeed' in self.source.url:
-            try:
-                data = self.items_from_response(response.content)
-            except ExpatError:
-                print(response.content.decode())
-                return
-        else:
-            try:
-                with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-                    assert archive.namelist() == ['siri.xml']
-                    with archive.open('siri.xml') as open_file:
-                        try:
-                            data = self.items_from_response(open_file)
-                        except ExpatError:
-                            print(open_file.read())
-                            return
-            except zipfile.BadZipFile:
-                print(response.content.decode())
-                return
-
-        self.when = data['Siri']['ServiceDelivery']['ResponseTimestamp']
-        self.source.datetime = parse_datetime(self.when)
+        response.raw.decode_content = True
 
-        return data['Siri']['ServiceDelivery']['VehicleMonitoringDelivery'].get('VehicleActivity')
+        with response:
+            try:
+                if 'datafeed' in self.source.url:
+                    yield from self.items_from_stream(response.raw)
+                else:
+                    with ZipMemberStream(response.raw) as open_file:
+                        assert open_file.name == 'siri.xml'
+                        yield from self.items_from_stream(open_file)
+            except (ET.ParseError, zipfile.BadZipFile) as e:
+                print(e)
@@ -8,7 +8,7 @@ class Command(ImportLiveVehiclesCommand):
     def update(self):
         now = timezone.now()
 
-        items = self.get_items()
+        items = list(self.get_items() or ())
         if items:
             # encourage items to be grouped by operator
             items.sort(key=lambda item: item['MonitoredVehicleJourney']['OperatorRef'])
@@ -15,7 +15,7 @@ class Command(ImportLiveVehiclesCommand):
         })
 
     def update(self):
-        items = self.get_items()
+        items = list(self.get_items() or ())
         if not items:
             return 300  # wait five minutes
 
@@ -74,6 +74,8 @@ class Command(ImportLiveVehiclesCommand):
     services = {}
 
     def get_items(self):
+        # (update handles items in chunks, which can span operators, so keep every operator's vehicles)
+        self.vehicles_cache = {}
         for operator in self.operator_codes:
             params = {
                 # 'clip': 1,
@@ -84,20 +86,13 @@ class Command(ImportLiveVehiclesCommand):
                 response = self.session.get(self.url, params=params, timeout=5)
                 items = response.json()['services']
                 vehicle_fleet_numbers = [item['fn'] for item in items]
-                self.vehicles_cache = {
-                    vehicle.code: vehicle for vehicle in self.vehicles.filter(
+                self.vehicles_cache.update(
+                    (vehicle.code, vehicle) for vehicle in self.vehicles.filter(
                         operator__in=self.operators,
                         code__in=vehicle_fleet_numbers
                     )
-                }
-                i = 0
-                for item in items:
-                    yield item
-                    i += 1
-                    if i == 100:
-                        self.save()
-                        i = 0
-                self.save()
+                )
+                yield from items
                 sleep(1)
             except (RequestException, KeyError) as e:
                 print(e)
@@ -4,20 +4,27 @@ import requests
 import logging
 import redis
 import json
+from itertools import islice
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from ciso8601 import parse_datetime
 from datetime import timedelta
 from time import sleep
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
 from django.contrib.gis.geos import Point
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.db.models import Exists, OuterRef, Q
 from django.db.models.functions import Now
 from django.utils import timezone
+from buses.utils import varnish_ban
 from bustimes.models import Route
-from busstops.models import DataSource
-from ..models import Vehicle, VehicleJourney
+from busstops.models import DataSource, Service
+from ..models import Vehicle, VehicleJourney, VehicleLocation
+from .arrival_predictions import remove_stale_predictions
+from ..utils import BUCKET_SUBSCRIPTIONS, VEHICLE_LOCATION_TTL, VEHICLE_UPDATES, get_bucket, get_milliseconds
 
 
 logger = logging.getLogger(__name__)
@@ -87,6 +94,8 @@ class ImportLiveVehiclesCommand(BaseCommand):
     url = ''
     vehicles = Vehicle.objects.select_related('latest_location__journey', 'latest_journey')
     wait = 60
+    schedule_adherence = None  # a ScheduleAdherence, for long-running processes
+    arrival_predictions = None  # an ArrivalPredictions, likewise
 
     @staticmethod
     def add_arguments(parser):
@@ -97,6 +106,9 @@ class ImportLiveVehiclesCommand(BaseCommand):
         self.session = requests.Session()
         self.redis = redis.from_url(settings.REDIS_URL)
         self.to_save = []
+        self.finished_journeys = set()  # ids of journeys whose vehicles have started new journeys
+        self.services = {}  # service id: {'line_name': ..., 'url': ...}
+        self.services_cleared_at = None
 
     @staticmethod
     def get_datetime(self):
@@ -130,37 +142,74 @@ class ImportLiveVehiclesCommand(BaseCommand):
                 continue
 
     def handle_item(self, item, now=None):
-        datetime = self.get_datetime(item)
-        if now and datetime and now < datetime:
-            datetime = None  # datetime was in the future (probably The Green Bus)
+        self.handle_items([item], now)
 
-        location = None
-        try:
-            vehicle, vehicle_created = self.get_vehicle(item)
-        except Vehicle.MultipleObjectsReturned as e:
-            logger.error(e, exc_info=True)
-            return
-        if not vehicle:
-            return
+    def handle_items(self, items, now=None):
+        """Handles a batch of items - gets their vehicles, and the vehicles' latest locations (in one Redis MGET),
+        works out what's changed, and then saves the changes in bulk
+        """
+        batch = {}  # vehicle id: (item, datetime, vehicle)
+
+        for item in items:
+            datetime = self.get_datetime(item)
+            if now and datetime and now < datetime:
+                datetime = None  # datetime was in the future (probably The Green Bus)
 
-        latest = None
+            try:
+                vehicle, vehicle_created = self.get_vehicle(item)
+            except Vehicle.MultipleObjectsReturned as e:
+                logger.error(e, exc_info=True)
+                continue
+            if not vehicle:
+                continue
+
+            if vehicle.id in batch:
+                # same vehicle twice - deal with the earlier item first
+                self.handle_batch(batch.values(), now)
+                batch = {}
+            batch[vehicle.id] = (item, datetime, vehicle)
+
+        self.handle_batch(batch.values(), now)
+
+    def handle_batch(self, batch, now):
+        vehicle_ids = [vehicle.id for _, _, vehicle in batch if vehicle.latest_location_id]
+        latest_locations = {}
+        if vehicle_ids:
+            for vehicle_id, latest in zip(
+                vehicle_ids, self.redis.mget([f'vehicle{vehicle_id}' for vehicle_id in vehicle_ids])
+            ):
+                if latest:
+                    latest_locations[vehicle_id] = json.loads(latest)
+
+        changes = []
+        for item, datetime, vehicle in batch:
+            change = self.get_change(item, now, datetime, vehicle, latest_locations.get(vehicle.id))
+            if change:
+                changes.append(change)
+
+        if changes:
+            self.save_changes(changes)
+
+    def get_change(self, item, now, datetime, vehicle, latest):
+        """Given an item, its vehicle and the vehicle's latest location from Redis (if any),
+        decides what needs to be saved - without saving anything (that's save_changes's job).
+        Returns a dictionary, or None if nothing needs to be saved
+        """
+        location = None
         latest_datetime = None
-        if vehicle.latest_location_id:
-            latest = self.redis.get(f'vehicle{vehicle.id}')
-            if latest:
-                latest = json.loads(latest)
-                latest_datetime = parse_datetime(latest['datetime'])
-                latest_latlong = Point(*latest['coordinates'])
-
-                if datetime:
-                    if latest_datetime >= datetime:
-                        # timestamp hasn't changed/is older
-                        return
-                else:
-                    location = self.create_vehicle_location(item)
-                    if location.latlong.equals_exact(latest_latlong, 0.001):
-                        # position haven't changed
-                        return
+        if latest:
+            latest_datetime = parse_datetime(latest['datetime'])
+            latest_latlong = Point(*latest['coordinates'])
+
+            if datetime:
+                if latest_datetime >= datetime:
+                    # timestamp hasn't changed/is older
+                    return
+            else:
+                location = self.create_vehicle_location(item)
+                if location.latlong.equals_exact(latest_latlong, 0.001):
+                    # position haven't changed
+                    return
 
         latest_journey = vehicle.latest_journey
         if latest_journey:
@@ -189,26 +238,32 @@ class ImportLiveVehiclesCommand(BaseCommand):
         if not location.latlong or not (location.latlong.x or location.latlong.y):  # (0, 0) - null island
             return
 
-        if location.heading == -1:
-            location.heading = None
+        if location.heading is not None:
+            location.heading = round(float(location.heading))  # (some feeds' headings are strings, like "143")
+            if location.heading == -1:
+                location.heading = None
 
         location.datetime = datetime
         if not location.datetime:
             location.datetime = now
 
+        change = {
+            'vehicle': vehicle,
+            'location': location,
+            'journey_fields': [],  # changed fields of an existing journey
+            'save_journey': False,  # whether to save the whole journey
+        }
+
         if same_journey(latest_journey, journey, latest_datetime, location.datetime):
-            changed = []
             if latest_journey.source_id != self.source.id:
                 latest_journey.source = self.source
-                changed.append('source')
+                change['journey_fields'].append('source')
             if journey.service_id and not original_service_id:
                 latest_journey.service_id = journey.service_id
-                changed.append('service')
+                change['journey_fields'].append('service')
             if journey.destination and not original_destination:
                 latest_journey.destination = journey.destination
-                changed.append('destination')
-            if changed:
-                latest_journey.save(update_fields=changed)
+                change['journey_fields'].append('destination')
 
             journey = latest_journey
 
@@ -220,52 +275,159 @@ class ImportLiveVehiclesCommand(BaseCommand):
             journey.source = self.source
             if not journey.datetime:
                 journey.datetime = location.datetime
-            try:
-                journey.save()
-            except IntegrityError:
-                journey = vehicle.vehiclejourney_set.using('default').get(datetime=journey.datetime)
-
-            if journey.service_id and VehicleJourney.service.is_cached(journey):
-                if not journey.service.tracking:
-                    journey.service.tracking = True
-                    journey.service.save(update_fields=['tracking'])
+            change['save_journey'] = True
 
         if vehicle.latest_location_id:
             location.id = vehicle.latest_location_id
 
-        location.journey = journey
         location.current = True
 
-        if not location.id:
-            location.save()
-
-        if vehicle.latest_journey_id != journey.id:
-            vehicle.latest_journey = journey
-            update_fields = ['latest_journey']
+        change['journey'] = journey
+        change['vehicle_fields'] = []
+        if not journey.id or vehicle.latest_journey_id != journey.id:
+            change['vehicle_fields'].append('latest_journey')
+            if not location.id:
+                change['vehicle_fields'].append('latest_location')
+            if vehicle.withdrawn:
+                change['vehicle_fields'].append('withdrawn')
 
-            if vehicle.latest_location_id != location.id:
-                vehicle.latest_location = location
-                update_fields.append('latest_location')
+        return change
 
-            if vehicle.withdrawn:
+    def save_journey(self, change):
+        journey = change['journey']
+        try:
+            journey.save()
+        except IntegrityError:
+            change['journey'] = journey.vehicle.vehiclejourney_set.using('default').get(datetime=journey.datetime)
+
+    def save_changes(self, changes):
+        """Saves the changes worked out by get_change, in as few queries as possible"""
+        changed_journeys = [change['journey'] for change in changes if change['journey_fields']]
+        if changed_journeys:
+            fields = {field for change in changes for field in change['journey_fields']}
+            VehicleJourney.objects.bulk_update(changed_journeys, fields)
+
+        new_journeys = []
+        for change in changes:
+            if change['save_journey']:
+                if change['journey'].id:
+                    self.save_journey(change)
+                else:
+                    new_journeys.append(change)
+        if len(new_journeys) > 1:
+            try:
+                with transaction.atomic():
+                    VehicleJourney.objects.bulk_create([change['journey'] for change in new_journeys])
+                new_journeys = []
+            except IntegrityError:
+                pass  # some of them already exist - save them one at a time
+        for change in new_journeys:
+            self.save_journey(change)
+
+        services = {}
+        for change in changes:
+            journey = change['journey']
+            if change['save_journey'] and journey.service_id and VehicleJourney.service.is_cached(journey):
+                if not journey.service.tracking:
+                    services[journey.service_id] = journey.service
+        if services:
+            Service.objects.filter(id__in=services).update(tracking=True)
+            for service in services.values():
+                service.tracking = True
+
+        for change in changes:
+            change['location'].journey = change['journey']
+        if self.schedule_adherence:
+            self.schedule_adherence.set_earlinesses([change['location'] for change in changes])
+        VehicleLocation.objects.bulk_create([change['location'] for change in changes if not change['location'].id])
+
+        vehicles = []
+        fields = set()
+        for change in changes:
+            vehicle = change['vehicle']
+            if change['vehicle_fields']:
+                if vehicle.latest_journey_id and vehicle.latest_journey_id != change['journey'].id:
+                    self.finished_journeys.add(vehicle.latest_journey_id)
+                vehicle.latest_journey = change['journey']
+                if 'latest_location' in change['vehicle_fields']:
+                    vehicle.latest_location = change['location']
                 vehicle.withdrawn = False
-                update_fields.append('withdrawn')
+                vehicles.append(vehicle)
+                fields.update(change['vehicle_fields'])
+            self.to_save.append((change['location'], vehicle))
+        if vehicles:
+            Vehicle.objects.bulk_update(vehicles, fields)
+            for vehicle in vehicles:
+                varnish_ban(f'/vehicles/{vehicle.id}')  # (bulk_update doesn't send the pre_save signal)
+
+    def get_services(self):
+        """Returns the line names and URLs of the services of the journeys about to be saved to Redis,
+        so vehicles_json can send the saved JSON as it is, without looking them up itself
+        """
+        now = timezone.now()
+        if not self.services_cleared_at or now - self.services_cleared_at > timedelta(hours=1):
+            self.services = {}  # in case any have changed
+            self.services_cleared_at = now
+
+        service_ids = set()
+        for location, _ in self.to_save:
+            journey = location.journey
+            if journey.service_id and journey.service_id not in self.services:
+                if VehicleJourney.service.is_cached(journey) and journey.service:
+                    service = journey.service
+                    self.services[service.id] = {'line_name': service.line_name, 'url': service.get_absolute_url()}
+                else:
+                    service_ids.add(journey.service_id)
 
-            vehicle.save(update_fields=update_fields)
+        if service_ids:
+            for service in Service.objects.only('line_name', 'slug').in_bulk(service_ids).values():
+                self.services[service.id] = {'line_name': service.line_name, 'url': service.get_absolute_url()}
 
-        self.to_save.append((location, vehicle))
+        return self.services
 
     def save(self):
         if not self.to_save:
             return
 
+        services = self.get_services()
+
+        try:
+            buckets = self.get_subscribed_buckets()
+            if buckets:
+                # where the vehicles were, so websockets can be told about vehicles leaving their viewports
+                previous_positions = self.redis.geopos(
+                    'vehicle_location_locations', *(vehicle.id for _, vehicle in self.to_save)
+                )
+        except redis.exceptions.ConnectionError:
+            buckets = None
+        messages = {}
+
         pipeline = self.redis.pipeline(transaction=False)
 
-        for location, vehicle in self.to_save:
+        for i, (location, vehicle) in enumerate(self.to_save):
             pipeline.geoadd('vehicle_location_locations', location.latlong.x, location.latlong.y, vehicle.id)
             redis_json = location.get_redis_json(vehicle)
+            if redis_json.get('service_id') in services:
+                redis_json['service'] = services[redis_json.pop('service_id')]
             redis_json = json.dumps(redis_json, cls=DjangoJSONEncoder)
-            pipeline.set(f'vehicle{vehicle.id}', redis_json, ex=900)
+            pipeline.set(f'vehicle{vehicle.id}', redis_json, ex=VEHICLE_LOCATION_TTL)
+
+            if buckets:
+                groups = {get_bucket(*location.latlong.coords)}
+                if previous_positions[i]:
+                    groups.add(get_bucket(*previous_positions[i]))
+                for group in groups & buckets:
+                    if group not in messages:
+                        messages[group] = {'type': 'vehicle_locations', 'items': [], 'expired': []}
+                    messages[group]['items'].append((location.id, location.latlong.coords, redis_json))
+
+        now = get_milliseconds()
+        pipeline.zadd(VEHICLE_UPDATES, {
+            f'{vehicle.id}:{location.id}': now for location, vehicle in self.to_save
+        })
+
+        if self.arrival_predictions:
+            self.arrival_predictions.add_to_pipeline(pipeline, [location for location, _ in self.to_save])
 
         with beeline.tracer(name="pipeline"):
             try:
@@ -273,10 +435,16 @@ class ImportLiveVehiclesCommand(BaseCommand):
             except redis.exceptions.ConnectionError:
                 pass
 
+        if messages:
+            self.send_to_groups(messages)
+
         pipeline = self.redis.pipeline(transaction=False)
 
         for location, vehicle in self.to_save:
             pipeline.rpush(*location.get_appendage())
+        if settings.JOURNEY_HISTORY_TTL:
+            for journey_id in self.finished_journeys:
+                pipeline.expire(f'journey{journey_id}', settings.JOURNEY_HISTORY_TTL)
 
         with beeline.tracer(name="pipeline"):
             try:
@@ -285,6 +453,92 @@ class ImportLiveVehiclesCommand(BaseCommand):
                 pass
 
         self.to_save = []
+        self.finished_journeys = set()
+
+        try:
+            self.sweep()
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def get_subscribed_buckets(self):
+        """Returns the set of buckets whose subscriptions haven't expired"""
+        buckets = self.redis.zrangebyscore(BUCKET_SUBSCRIPTIONS, get_milliseconds(), '+inf')
+        return {bucket.decode() for bucket in buckets}
+
+    @async_to_sync
+    async def send_to_groups(self, messages):
+        """Sends messages to the channel groups of buckets that vehicles.consumers.VehicleMapConsumers
+        have subscribed to - one message per bucket, however many websockets there are
+        """
+        channel_layer = get_channel_layer()
+        for group, message in messages.items():
+            await channel_layer.group_send(group, message)
+
+    def sweep(self):
+        """Removes vehicles whose vehicle{id} keys have expired from the vehicle_location_locations geo set,
+        and (once they're too old for vehicles_json to need) from vehicle_location_updates.
+        Also removes expired bucket subscriptions and stale arrival predictions.
+
+        Only runs once a minute, whichever process it's in. Records some stats for the status page
+        """
+        if not self.redis.set('vehicle_location_sweep', 1, nx=True, ex=60):
+            return  # already swept recently
+
+        now = get_milliseconds()
+        expired_before = now - VEHICLE_LOCATION_TTL * 1000
+
+        location_ids = {}
+        swept_until = self.redis.get('vehicle_location_swept_until')
+        if swept_until:
+            # vehicles last updated between the last sweep and VEHICLE_LOCATION_TTL ago
+            members = self.redis.zrangebyscore(VEHICLE_UPDATES, f'({int(swept_until)}', expired_before)
+            for member in members:
+                vehicle_id, location_id = member.split(b':')
+                location_ids[vehicle_id] = int(location_id)
+            vehicle_ids = list(location_ids)
+        else:
+            # first time - check all of them
+            vehicle_ids = self.redis.zrange('vehicle_location_locations', 0, -1)
+
+        # (a vehicle might have been updated since, with a different location id)
+        pipeline = self.redis.pipeline(transaction=False)
+        for vehicle_id in vehicle_ids:
+            pipeline.exists(f'vehicle{int(vehicle_id)}')
+        expired = [vehicle_id for vehicle_id, exists in zip(vehicle_ids, pipeline.execute()) if not exists]
+
+        buckets = self.get_subscribed_buckets()
+        if buckets and location_ids and expired:
+            # tell websockets about vehicles that have disappeared from their viewports
+            messages = {}
+            for vehicle_id, position in zip(expired, self.redis.geopos('vehicle_location_locations', *expired)):
+                if position and vehicle_id in location_ids:
+                    group = get_bucket(*position)
+                    if group in buckets:
+                        if group not in messages:
+                            messages[group] = {'type': 'vehicle_locations', 'items': [], 'expired': []}
+                        messages[group]['expired'].append(location_ids[vehicle_id])
+            if messages:
+                self.send_to_groups(messages)
+
+        pipeline = self.redis.pipeline(transaction=False)
+        if expired:
+            pipeline.zrem('vehicle_location_locations', *expired)
+        # keep updates for long enough to tell vehicles_json clients about vehicles that have expired
+        pipeline.zremrangebyscore(VEHICLE_UPDATES, '-inf', expired_before - VEHICLE_LOCATION_TTL * 1000)
+        pipeline.zremrangebyscore(BUCKET_SUBSCRIPTIONS, '-inf', now)
+        pipeline.set('vehicle_location_swept_until', expired_before)
+        pipeline.zcard('vehicle_location_locations')
+        pipeline.zcount(VEHICLE_UPDATES, f'({expired_before}', '+inf')
+        results = pipeline.execute()
+
+        remove_stale_predictions(self.redis, now // 1000)
+
+        cache.set('vehicle_locations_status', {
+            'datetime': timezone.now(),
+            'removed': len(expired),
+            'locations': results[-2],
+            'live': results[-1]
+        }, None)
 
     def do_source(self):
         if self.url:
@@ -303,19 +557,26 @@ class ImportLiveVehiclesCommand(BaseCommand):
 
         try:
             items = self.get_items()
-            if items:
-                i = 0
-                for item in items:
+            count = 0
+            if items:  # (might be a generator)
+                items = iter(items)
+                chunk = list(islice(items, 50))
+                while chunk:
+                    to_save_count = len(self.to_save)
                     try:
-                        self.handle_item(item, now)
-                    except IntegrityError as e:
-                        logger.error(e, exc_info=True)
-                    i += 1
-                    if i == 50:
-                        self.save()
-                        i = 0
-                self.save()
-            else:
+                        self.handle_items(chunk, now)
+                    except IntegrityError:
+                        # try again one item at a time, so only the bad item is lost
+                        del self.to_save[to_save_count:]
+                        for item in chunk:
+                            try:
+                                self.handle_items([item], now)
+                            except IntegrityError as e:
+                                logger.error(e, exc_info=True)
+                    self.save()
+                    count += len(chunk)
+                    chunk = list(islice(items, 50))
+            if not count:
                 return 300  # no items - wait five minutes
         except requests.exceptions.RequestException as e:
             logger.error(e, exc_info=True)
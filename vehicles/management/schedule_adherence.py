@@ -0,0 +1,164 @@
+import math
+from datetime import timedelta
+from django.utils import timezone
+from bustimes.models import JourneyPatternStop, StopTime, Trip
+
+
+twelve_hours = timedelta(hours=12).total_seconds()
+one_day = timedelta(days=1).total_seconds()
+
+
+class Shape:
+    """A trip's stops' positions and scheduled times (in seconds after the trip's start),
+    with each segment's vector precomputed, so positions can be projected onto it quickly.
+
+    Longitudes are scaled by the cosine of the first stop's latitude, so distances are roughly isotropic
+    """
+    __slots__ = ('scale', 'segments', 'stops')
+
+    def __init__(self, points):
+        """points is a list of (stop id, (longitude, latitude), seconds) tuples, in order"""
+        self.scale = math.cos(math.radians(points[0][1][1]))
+        self.segments = []  # (x, y, dx, dy, squared length, seconds, duration)
+        self.stops = [(stop_id, seconds) for stop_id, _, seconds in points]
+        points = [(lon * self.scale, lat, seconds) for _, (lon, lat), seconds in points]
+        for (x, y, seconds), (next_x, next_y, next_seconds) in zip(points, points[1:]):
+            dx = next_x - x
+            dy = next_y - y
+            self.segments.append((x, y, dx, dy, dx * dx + dy * dy, seconds, next_seconds - seconds))
+
+    def get_seconds(self, lon, lat, actual, tolerance):
+        """Returns the scheduled time (seconds after the trip's start) at the point on the route nearest to a position,
+        or None if the position is more than tolerance (in degrees of latitude) from the route.
+
+        If the route passes near the position more than once (a loop, or an out-and-back route),
+        the pass whose scheduled time is nearest to actual (also seconds after the trip's start) is used
+        """
+        px = lon * self.scale
+        py = lat
+        tolerance *= tolerance
+        best = None
+        best_difference = None
+        for x, y, dx, dy, length, seconds, duration in self.segments:
+            wx = px - x
+            wy = py - y
+            if length:
+                fraction = (wx * dx + wy * dy) / length
+                if fraction < 0:
+                    fraction = 0
+                elif fraction > 1:
+                    fraction = 1
+                wx -= fraction * dx
+                wy -= fraction * dy
+            else:
+                fraction = 0
+            if wx * wx + wy * wy <= tolerance:
+                scheduled = seconds + fraction * duration
+                difference = abs(scheduled - actual)
+                if best is None or difference < best_difference:
+                    best = scheduled
+                    best_difference = difference
+        return best
+
+
+class ScheduleAdherence:
+    """Works out how early or late vehicles are (VehicleLocation.early, in minutes - negative if late)
+    by projecting their positions onto their journeys' trips' routes and interpolating the scheduled times.
+
+    Trips' shapes are loaded in bulk (at most three queries for a whole batch of locations) the first time they're
+    needed, and kept in memory until they're all thrown away every hour
+    """
+    reload_interval = timedelta(hours=1)
+    tolerance = 0.005  # about 500 metres
+
+    def __init__(self):
+        self.loaded_at = None
+
+    def refresh(self):
+        now = timezone.now()
+        if not self.loaded_at or now - self.loaded_at > self.reload_interval:
+            self.shapes = {}  # trip id: (trip start, Shape or None)
+            self.patterns = {}  # pattern id: Shape or None
+            self.loaded_at = now
+
+    @staticmethod
+    def get_shape(points):
+        if len(points) > 1:
+            return Shape(points)
+
+    def load(self, trip_ids):
+        trips = Trip.objects.filter(id__in=trip_ids).values_list('id', 'start', 'pattern')
+
+        points = {}  # trip id: (start, [(stop id, (longitude, latitude), seconds)...])
+        pattern_trips = {}  # pattern id: [(trip id, start)...]
+        for trip_id, start, pattern_id in trips:
+            if pattern_id is None:
+                points[trip_id] = (start, [])
+            elif pattern_id in self.patterns:
+                self.shapes[trip_id] = (start, self.patterns[pattern_id])
+            else:
+                pattern_trips.setdefault(pattern_id, []).append((trip_id, start))
+
+        if points:
+            stop_times = StopTime.objects.filter(
+                trip__in=points, stop__latlong__isnull=False
+            ).values_list('trip', 'stop', 'stop__latlong', 'arrival', 'departure').order_by('trip', 'sequence')
+            for trip_id, stop_id, latlong, arrival, departure in stop_times:
+                start, trip_points = points[trip_id]
+                time = arrival if departure is None else departure
+                if time is not None:
+                    trip_points.append((stop_id, latlong.coords, (time - start).total_seconds()))
+            for trip_id, (start, trip_points) in points.items():
+                self.shapes[trip_id] = (start, self.get_shape(trip_points))
+
+        if pattern_trips:
+            points = {pattern_id: [] for pattern_id in pattern_trips}
+            stops = JourneyPatternStop.objects.filter(
+                pattern__in=pattern_trips, stop__latlong__isnull=False
+            ).values_list('pattern', 'stop', 'stop__latlong', 'arrival', 'departure').order_by('pattern', 'sequence')
+            for pattern_id, stop_id, latlong, arrival, departure in stops:
+                time = arrival if departure is None else departure
+                if time is not None:
+                    points[pattern_id].append((stop_id, latlong.coords, time.total_seconds()))
+            for pattern_id, trips in pattern_trips.items():
+                shape = self.patterns[pattern_id] = self.get_shape(points[pattern_id])
+                for trip_id, start in trips:
+                    self.shapes[trip_id] = (start, shape)
+
+        for trip_id in trip_ids:
+            if trip_id not in self.shapes:
+                self.shapes[trip_id] = (None, None)  # trip doesn't exist (any more)
+
+    def set_earlinesses(self, locations):
+        """Sets the early attribute of each of a batch of VehicleLocations whose journeys have trips,
+        and a progress attribute - (Shape, trip's scheduled start datetime, scheduled seconds, actual seconds) -
+        for ArrivalPredictions
+        """
+        self.refresh()
+
+        locations = [location for location in locations if location.journey.trip_id]
+        missing = {location.journey.trip_id for location in locations} - self.shapes.keys()
+        if missing:
+            self.load(missing)
+
+        for location in locations:
+            journey = location.journey
+            start, shape = self.shapes[journey.trip_id]
+            if not shape:
+                continue
+
+            # the trip's scheduled start, on the day of the journey - journey.datetime is normally close to it
+            journey_datetime = timezone.localtime(journey.datetime)
+            time_of_day = timedelta(
+                hours=journey_datetime.hour, minutes=journey_datetime.minute, seconds=journey_datetime.second
+            ).total_seconds()
+            offset = (start.total_seconds() - time_of_day) % one_day
+            if offset > twelve_hours:
+                offset -= one_day
+            start_datetime = journey_datetime.replace(microsecond=0) + timedelta(seconds=offset)
+
+            actual = (location.datetime - start_datetime).total_seconds()
+            scheduled = shape.get_seconds(*location.latlong.coords, actual, self.tolerance)
+            if scheduled is not None:
+                location.early = round((scheduled - actual) / 60)
+                location.progress = (shape, start_datetime, scheduled, actual)
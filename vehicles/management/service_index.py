@@ -0,0 +1,137 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db.models.functions import Substr
+from django.utils import timezone
+from busstops.models import Operator, Service, ServiceCode
+
+
+class ServiceIndex:
+    """Current services, indexed by line name and SIRI ServiceCode, with their operators and the first three
+    characters of their stops' ATCO codes - so most of import_bod_avl.Command.get_service's lookups can be answered
+    without any queries.
+
+    Refreshes itself (when used) every five minutes, by adding services that have become current and removing ones
+    that aren't any more, and reloads everything every hour.
+    """
+    refresh_interval = timedelta(minutes=5)
+    reload_interval = timedelta(hours=1)
+
+    def __init__(self):
+        self.loaded_at = None
+        self.refreshed_at = None
+
+    def clear(self):
+        self.services = {}  # id: Service
+        self.line_names = {}  # lower case line name: {ids}
+        self.codes = {}  # SIRI ServiceCode code: {ids}
+        self.operators = {}  # id: {operator ids}
+        self.parents = {}  # id: {operator parents}
+        self.prefixes = {}  # id: {stop ATCO code prefixes}
+
+    def load(self, service_ids=None):
+        services = Service.objects.using(settings.READ_DATABASE).filter(current=True)
+        if service_ids is not None:
+            services = services.filter(id__in=service_ids)
+        services = services.defer('geometry', 'search_vector')
+
+        for service in services:
+            self.services[service.id] = service
+            self.line_names.setdefault(service.line_name.lower(), set()).add(service.id)
+            self.operators[service.id] = set()
+            self.parents[service.id] = set()
+            self.prefixes[service.id] = set()
+
+        codes = ServiceCode.objects.filter(service__current=True, scheme__endswith='SIRI')
+        operators = Service.operator.through.objects.filter(service__current=True)
+        stops = Service.stops.through.objects.filter(service__current=True)
+        if service_ids is not None:
+            codes = codes.filter(service__in=service_ids)
+            operators = operators.filter(service__in=service_ids)
+            stops = stops.filter(service__in=service_ids)
+
+        for service_id, code in codes.using(settings.READ_DATABASE).values_list('service', 'code'):
+            if service_id in self.services:
+                self.codes.setdefault(code, set()).add(service_id)
+
+        operators = operators.using(settings.READ_DATABASE).values_list('service', 'operator', 'operator__parent')
+        for service_id, operator_id, parent in operators:
+            if service_id in self.services:
+                self.operators[service_id].add(operator_id)
+                if parent:
+                    self.parents[service_id].add(parent)
+
+        stops = stops.using(settings.READ_DATABASE).annotate(prefix=Substr('stop_id', 1, 3))
+        for service_id, prefix in stops.values_list('service', 'prefix').distinct():
+            if service_id in self.services:
+                self.prefixes[service_id].add(prefix)
+
+    def remove(self, service_id):
+        service = self.services.pop(service_id)
+        self.line_names[service.line_name.lower()].discard(service_id)
+        for service_ids in self.codes.values():
+            service_ids.discard(service_id)
+        del self.operators[service_id]
+        del self.parents[service_id]
+        del self.prefixes[service_id]
+
+    def refresh(self):
+        now = timezone.now()
+
+        if not self.loaded_at or now - self.loaded_at > self.reload_interval:
+            self.clear()
+            self.load()
+            self.loaded_at = self.refreshed_at = now
+
+        elif now - self.refreshed_at > self.refresh_interval:
+            current = set(
+                Service.objects.using(settings.READ_DATABASE).filter(current=True).values_list('id', flat=True)
+            )
+            for service_id in set(self.services) - current:
+                self.remove(service_id)
+            added = current - set(self.services)
+            if added:
+                self.load(added)
+            self.refreshed_at = now
+
+    def get_service(self, operator, line_refs, destination_ref, vehicle_operator_id):
+        """Does what Command.get_service's queries would do, as far as possible.
+
+        Returns a tuple - (True, a Service or None) if it's sure, or (False, None) if the queries should be used
+        """
+        self.refresh()
+
+        service_ids = set()
+        for line_ref in line_refs:
+            service_ids |= self.line_names.get(line_ref.lower(), set())
+            service_ids |= self.codes.get(line_ref, set())
+
+        if type(operator) is Operator and operator.parent and destination_ref:
+            service_ids = {
+                service_id for service_id in service_ids
+                if operator.parent in self.parents[service_id] or vehicle_operator_id in self.operators[service_id]
+            }
+
+        elif operator:
+            if type(operator) is Operator:
+                operator_ids = {operator.id, vehicle_operator_id}
+            else:
+                operator_ids = set(operator)
+            service_ids = {service_id for service_id in service_ids if self.operators[service_id] & operator_ids}
+
+            if type(operator) is Operator or not destination_ref:
+                if len(service_ids) == 1:
+                    return True, self.services[service_ids.pop()]
+                if not service_ids:
+                    return True, None
+
+        if destination_ref:
+            prefix = destination_ref[:3]
+            if len(prefix) < 3:
+                return False, None
+            service_ids = {service_id for service_id in service_ids if prefix in self.prefixes[service_id]}
+            if len(service_ids) == 1:
+                return True, self.services[service_ids.pop()]
+            if not service_ids:
+                return True, None
+
+        return False, None
@@ -0,0 +1,82 @@
+import redis
+import time_machine
+from io import StringIO
+from tempfile import TemporaryDirectory
+from ciso8601 import parse_datetime
+from mock import patch
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from busstops.models import DataSource
+from ... import archive
+from ...models import Vehicle, VehicleJourney, VehicleLocation
+
+
+@time_machine.travel('2020-11-28T15:00:00Z')
+class ArchiveJourneyLocationsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        source = DataSource.objects.create(name='Bus Open Data')
+        vehicle = Vehicle.objects.create(code='BB62_BUS')
+        other_vehicle = Vehicle.objects.create(code='BB63_BUS')
+
+        # finished - its vehicle has moved on to another journey
+        cls.finished = VehicleJourney.objects.create(vehicle=vehicle, source=source,
+                                                     datetime=parse_datetime('2020-11-28T12:00:00Z'))
+        # its vehicle's latest journey, but still going
+        cls.current = VehicleJourney.objects.create(vehicle=vehicle, source=source,
+                                                    datetime=parse_datetime('2020-11-28T14:00:00Z'))
+        # its vehicle's latest journey, but started more than --hours ago
+        cls.old = VehicleJourney.objects.create(vehicle=other_vehicle, source=source,
+                                                datetime=parse_datetime('2020-11-27T14:00:00Z'))
+        vehicle.latest_journey = cls.current
+        vehicle.save(update_fields=['latest_journey'])
+        other_vehicle.latest_journey = cls.old
+        other_vehicle.save(update_fields=['latest_journey'])
+
+    def get_appendage(self, journey, when, heading):
+        return VehicleLocation(
+            journey=journey, datetime=parse_datetime(when), latlong=Point(1.296443, 52.62269), heading=heading
+        ).get_appendage()[1]
+
+    def test_archive_journey_locations(self):
+        r = redis.from_url(settings.REDIS_URL)
+        r.flushall()
+
+        r.rpush(
+            f'journey{self.finished.id}',
+            self.get_appendage(self.finished, '2020-11-28T12:00:00Z', 142),
+            b'["2020-11-28T12:01:00Z", [1.296443, 52.62269], "288", null]'  # the old JSON format, string heading
+        )
+        r.rpush(f'journey{self.current.id}', self.get_appendage(self.current, '2020-11-28T14:00:00Z', 90))
+        r.rpush(f'journey{self.old.id}', self.get_appendage(self.old, '2020-11-27T14:00:00Z', None))
+
+        pushed = self.get_appendage(self.finished, '2020-11-28T12:02:00Z', 10)
+        write_day = archive.write_day
+
+        def push_and_write_day(date, tracks):
+            # a location pushed while the journey is being archived
+            if self.finished.id in tracks:
+                r.rpush(f'journey{self.finished.id}', pushed)
+            write_day(date, tracks)
+
+        with TemporaryDirectory() as directory, override_settings(JOURNEY_ARCHIVE_DIR=directory):
+            with patch('vehicles.archive.write_day', side_effect=push_and_write_day):
+                stdout = StringIO()
+                call_command('archive_journey_locations', stdout=stdout)
+            self.assertEqual(stdout.getvalue(), '2 journeys archived\n')
+
+            self.assertEqual(archive.read_track(self.finished.datetime, self.finished.id), [
+                (parse_datetime('2020-11-28T12:00:00Z'), (1.296443, 52.62269), 142, None),
+                (parse_datetime('2020-11-28T12:01:00Z'), (1.296443, 52.62269), 288, None),
+            ])
+            self.assertEqual(archive.read_track(self.old.datetime, self.old.id), [
+                (parse_datetime('2020-11-27T14:00:00Z'), (1.296443, 52.62269), None, None),
+            ])
+            self.assertIsNone(archive.read_track(self.current.datetime, self.current.id))
+
+        # the archived locations have gone from Redis, but not the one pushed since, or the current journey's
+        self.assertEqual(r.lrange(f'journey{self.finished.id}', 0, -1), [pushed])
+        self.assertFalse(r.exists(f'journey{self.old.id}'))
+        self.assertEqual(r.llen(f'journey{self.current.id}'), 1)
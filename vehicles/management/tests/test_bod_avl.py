@@ -1,14 +1,22 @@
+import io
 import os
 import redis
+import zipfile
+from datetime import timedelta
 import time_machine
 from mock import patch
 from vcr import use_cassette
 from django.conf import settings
+from django.db import IntegrityError
 from django.test import TestCase, override_settings
-from busstops.models import Region, DataSource, Operator, OperatorCode, StopPoint, Locality, AdminArea
+from busstops.models import (
+    Region, DataSource, Operator, OperatorCode, StopPoint, Locality, AdminArea, Service, ServiceCode, StopUsage
+)
 from ...models import VehicleLocation, VehicleJourney
 from ...tasks import bod_avl
+from ...utils import VEHICLE_UPDATES, get_milliseconds
 from ..commands import import_bod_avl, import_bod_avl_celery, import_bod_avl_channels
+from ..service_index import ServiceIndex
 
 DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -32,6 +40,25 @@ class BusOpenDataVehicleLocationsTest(TestCase):
         southwold = Locality.objects.create(admin_area=suffolk, name='Southwold')
         StopPoint.objects.create(atco_code='390071066', locality=southwold, active=True, common_name='Kings Head')
 
+    def test_update_integrity_error(self):
+        command = import_bod_avl.Command()
+        command.source = self.source
+
+        def handle_items(items, now):
+            if 'bad' in items:
+                raise IntegrityError
+
+        with patch.object(command, 'get_items', return_value=['good', 'bad', 'also good']), \
+                patch.object(command, 'handle_items', side_effect=handle_items) as mocked_handle_items, \
+                patch.object(command, 'save'):
+            with self.assertLogs(level='ERROR'):
+                command.update()
+
+        # the chunk is tried again one item at a time
+        self.assertEqual([call.args[0] for call in mocked_handle_items.call_args_list], [
+            ['good', 'bad', 'also good'], ['good'], ['bad'], ['also good']
+        ])
+
     @time_machine.travel('2020-05-01')
     @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
     def test_channels_update(self):
@@ -60,6 +87,81 @@ class BusOpenDataVehicleLocationsTest(TestCase):
                 <td>0</td>
             </tr>""")
 
+    def test_iter_siri_vm(self):
+        xml = """<Siri xmlns="http://www.siri.org.uk/siri" version="2.0">
+            <ServiceDelivery>
+                <ResponseTimestamp>2021-01-05T17:40:28+00:00</ResponseTimestamp>
+                <VehicleMonitoringDelivery>
+                    <ResponseTimestamp>2021-01-05T17:40:29+00:00</ResponseTimestamp>
+                    <VehicleActivity>
+                        <RecordedAtTime>2021-01-05T17:40:01+00:00</RecordedAtTime>
+                        <MonitoredVehicleJourney>
+                            <LineRef>7</LineRef>
+                            <VehicleLocation>
+                                <Longitude>-2.2</Longitude>
+                                <Latitude>53.4</Latitude>
+                            </VehicleLocation>
+                            <Occupancy/>
+                        </MonitoredVehicleJourney>
+                    </VehicleActivity>
+                    <VehicleActivity>
+                        <RecordedAtTime>2021-01-05T17:40:02+00:00</RecordedAtTime>
+                    </VehicleActivity>
+                </VehicleMonitoringDelivery>
+            </ServiceDelivery>
+        </Siri>"""
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as open_archive:
+            open_archive.writestr('siri.xml', xml)
+        archive.seek(0)
+
+        with import_bod_avl.ZipMemberStream(archive) as open_file:
+            self.assertEqual('siri.xml', open_file.name)
+            self.assertEqual(list(import_bod_avl.iter_siri_vm(open_file)), [
+                ('ResponseTimestamp', '2021-01-05T17:40:28+00:00'),
+                ('VehicleActivity', {
+                    'RecordedAtTime': '2021-01-05T17:40:01+00:00',
+                    'MonitoredVehicleJourney': {
+                        'LineRef': '7',
+                        'VehicleLocation': {
+                            'Longitude': '-2.2',
+                            'Latitude': '53.4'
+                        },
+                        'Occupancy': None
+                    }
+                }),
+                ('VehicleActivity', {
+                    'RecordedAtTime': '2021-01-05T17:40:02+00:00'
+                })
+            ])
+
+    def test_service_index(self):
+        service = Service.objects.create(line_name='146', date='2020-01-01')
+        service.operator.add('HAMS')
+        ServiceCode.objects.create(service=service, scheme='Hampshire SIRI', code='HA146')
+        StopUsage.objects.create(service=service, stop_id='390071066', order=0)
+        other_service = Service.objects.create(line_name='146', date='2020-01-01')
+        other_service.operator.add('TGTC')
+        operator = Operator.objects.get(id='HAMS')
+
+        index = ServiceIndex()
+        with self.assertNumQueries(4):
+            index.refresh()
+
+        with self.assertNumQueries(0):
+            self.assertEqual((True, service), index.get_service(operator, ['146'], None, 'HAMS'))
+            self.assertEqual((True, service), index.get_service(operator, ['HA146'], None, 'HAMS'))
+            self.assertEqual((True, None), index.get_service(operator, ['147'], None, 'HAMS'))
+            self.assertEqual((True, service), index.get_service(None, ['146'], '3900000', None))
+            self.assertEqual((True, None), index.get_service(None, ['146'], '2400103099', None))
+            # ambiguous - leave it to the database queries
+            self.assertEqual((False, None), index.get_service(['HAMS', 'TGTC'], ['146'], None, 'HAMS'))
+
+        Service.objects.filter(id=other_service.id).update(current=False)
+        index.refreshed_at -= timedelta(minutes=6)
+        with self.assertNumQueries(1):
+            self.assertEqual((True, service), index.get_service(['HAMS', 'TGTC'], ['146'], None, 'HAMS'))
+
     def test_celery_update(self):
         command = import_bod_avl_celery.Command()
         with patch('vehicles.management.commands.import_bod_avl.Command.get_items', return_value=[]):
@@ -130,7 +232,7 @@ class BusOpenDataVehicleLocationsTest(TestCase):
             }
         }]
 
-        with self.assertNumQueries(31):
+        with self.assertNumQueries(27):
             bod_avl(items)
         with self.assertNumQueries(2):
             bod_avl(items)
@@ -161,6 +263,31 @@ class BusOpenDataVehicleLocationsTest(TestCase):
             "service": {"line_name": "C"}
         }])
 
+    def test_sweep(self):
+        r = redis.from_url(settings.REDIS_URL)
+        r.flushall()
+
+        r.geoadd('vehicle_location_locations', 1.29, 52.62, 1)
+        r.geoadd('vehicle_location_locations', 1.29, 52.62, 2)
+        r.set('vehicle2', '{}')
+
+        command = import_bod_avl.Command()
+        command.sweep()  # the first sweep checks every vehicle
+        self.assertEqual(r.zrange('vehicle_location_locations', 0, -1), [b'2'])
+
+        now = get_milliseconds()
+        r.delete('vehicle2')
+        r.zadd(VEHICLE_UPDATES, {'2:5': now - 901000})
+        r.set('vehicle_location_swept_until', now - 902000)
+
+        command.sweep()  # too soon
+        self.assertEqual(r.zcard('vehicle_location_locations'), 1)
+
+        r.delete('vehicle_location_sweep')
+        command.sweep()
+        self.assertEqual(r.zcard('vehicle_location_locations'), 0)
+        self.assertEqual(r.zcard(VEHICLE_UPDATES), 1)  # still needed by vehicles_json
+
     def test_handle_item(self):
         command = import_bod_avl.Command()
         command.source = self.source
@@ -249,6 +376,28 @@ class BusOpenDataVehicleLocationsTest(TestCase):
              'service': {'line_name': '146'}}
         ])
 
+        # changes since a token
+        with self.assertNumQueries(0):
+            response = self.client.get('/vehicles.json?since=0')
+        since = response.json()['since']
+        self.assertTrue(response.json()['full'])
+        self.assertEqual(response.json()['vehicles'][0]['id'], location.id)
+
+        response = self.client.get(f'/vehicles.json?since={since}')
+        self.assertFalse(response.json()['full'])
+        self.assertEqual(response.json()['vehicles'][0]['id'], location.id)
+
+        response = self.client.get(f'/vehicles.json?since={since + 1}&ymax=52.4&xmax=1.7&ymin=52.3&xmin=1.6')
+        self.assertEqual(response.json(), {'since': since + 1, 'full': False, 'vehicles': [], 'expired': []})
+
+        # moved out of the bounding box
+        response = self.client.get(f'/vehicles.json?since={since}&ymax=52.3&xmax=1.7&ymin=52.3&xmin=1.6')
+        self.assertEqual(response.json(), {'since': since, 'full': False, 'vehicles': [], 'expired': [location.id]})
+
+        # nothing has changed
+        response = self.client.get(f'/vehicles.json?since={since}', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
     @time_machine.travel('2021-03-05T14:20:40+00:00')
     def test_handle_extensions(self):
         command = import_bod_avl.Command()
@@ -63,6 +63,7 @@ class BusHubTest(TestCase):
         with self.assertNumQueries(11):
             with patch('builtins.print') as mocked_print:
                 command.handle_item(item)
+                self.assertEqual(command.to_save[0][0].heading, 143)  # not "143"
                 command.save()
 
         mocked_print.assert_called()
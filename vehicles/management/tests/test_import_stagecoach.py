@@ -28,8 +28,9 @@ class StagecoachTest(TestCase):
                                    geometry='MULTILINESTRING((-0.1475818977 51.4928233539,-0.1460401487 51.496737716))')
         s.operator.add(o)
 
-    @patch('vehicles.management.import_live_vehicles.sleep')
-    @patch('vehicles.management.commands.import_stagecoach.sleep', side_effect=MockException)
+    # (the first sleep is before the first update, the second is after it)
+    @patch('vehicles.management.import_live_vehicles.sleep', side_effect=[None, MockException])
+    @patch('vehicles.management.commands.import_stagecoach.sleep')
     def test_handle(self, sleep_1, sleep_2):
         command = Command()
         command.source = self.source
@@ -0,0 +1,107 @@
+from datetime import timedelta
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from bustimes.models import get_calendars, to_date, Trip
+
+
+# the fields of the trips in the index, in the order Trip.from_db needs them
+FIELDS = [field.attname for field in Trip._meta.concrete_fields
+          if field.attname in {'id', 'ticket_machine_code', 'destination_id', 'calendar_id', 'start', 'end'}]
+
+
+class TripIndex:
+    """A service's trips that run on a day, indexed by start time and ticket machine code,
+    so most of VehicleJourney.get_trip's queries can be answered with a dictionary lookup.
+
+    A service's trips for a day are loaded (in one query) the first time they're needed,
+    and everything is reloaded every hour, in case any timetables have been imported since
+    """
+    reload_interval = timedelta(hours=1)
+    status_interval = timedelta(minutes=5)
+
+    def __init__(self):
+        self.loaded_at = None
+        self.status_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.services = {}  # (date, service id): (trips by start time, trips by ticket machine code)
+
+    def refresh(self):
+        now = timezone.now()
+
+        if not self.loaded_at or now - self.loaded_at > self.reload_interval:
+            self.clear()
+            self.loaded_at = now
+
+        if not self.status_at or now - self.status_at > self.status_interval:
+            cache.set('trip_index_status', {
+                'datetime': now,
+                'hits': self.hits,
+                'misses': self.misses,
+                'services': len(self.services)
+            }, None)
+            self.status_at = now
+
+    def load(self, date, service_id):
+        trips = Trip.objects.filter(
+            Q(route__start_date__lte=date) | Q(route__start_date=None),
+            Q(route__end_date__gte=date) | Q(route__end_date=None),
+            route__service=service_id
+        ).annotate(
+            running=Exists(get_calendars(date).filter(id=OuterRef('calendar')))
+        ).order_by('id').values_list(*FIELDS, 'running')
+
+        by_start = {}
+        by_code = {}
+        for values in trips:
+            trip = Trip.from_db('default', FIELDS, values[:-1])
+            trip.running = values[-1]
+            by_start.setdefault(trip.start, []).append(trip)
+            by_code.setdefault(trip.ticket_machine_code, []).append(trip)
+
+        self.services[(date, service_id)] = by_start, by_code
+
+    @staticmethod
+    def get_distinct(trips, destination_ref):
+        """Returns a tuple - (the number of distinct trips, one of them) - like get_trip's DISTINCT ON"""
+        if destination_ref and ' ' not in destination_ref and destination_ref[:3].isdigit():
+            trips = [trip for trip in trips if trip.destination_id == destination_ref]
+            keys = {(trip.start, trip.end) for trip in trips}
+        else:
+            keys = {trip.destination_id for trip in trips}
+        return len(keys), trips and trips[0]
+
+    def get_trip(self, journey, datetime=None, destination_ref=None):
+        """Does what journey.get_trip(datetime, destination_ref) would do"""
+        if not datetime:
+            datetime = journey.datetime
+
+        self.refresh()
+
+        key = (to_date(datetime), journey.service_id)
+        if key in self.services:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.load(*key)
+        by_start, by_code = self.services[key]
+
+        code = journey.code
+        if len(code) == 4 and code.isdigit() and int(code) < 2400:
+            start = timedelta(hours=int(code[:-2]), minutes=int(code[-2:]))
+            count, trip = self.get_distinct(by_start.get(start, ()), destination_ref)
+            if count == 1:
+                return trip
+            return
+
+        trips = by_code.get(code, ())
+        count, trip = self.get_distinct(trips, destination_ref)
+        if count == 1:
+            return trip
+        if count > 1:
+            count, trip = self.get_distinct([trip for trip in trips if trip.running], destination_ref)
+            if count == 1:
+                return trip
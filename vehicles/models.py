@@ -1,11 +1,12 @@
 import re
+import struct
 from math import ceil
 from urllib.parse import quote
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
+from ciso8601 import parse_datetime
 from webcolors import html5_parse_simple_color
 from django.conf import settings
 from django.contrib.gis.db import models
-from django.core.serializers.json import DjangoJSONEncoder
 from django.core.exceptions import ValidationError
 from django.db.models import Q
 from django.urls import reverse
@@ -15,6 +16,12 @@ from bustimes.models import get_calendars, Trip
 import json
 
 
+# a location in a journey's history in Redis: seconds since the epoch, latitude and longitude in millionths of a degree,
+# heading and early (-32768 meaning None)
+LOCATION_STRUCT = struct.Struct('<Iiihh')
+NONE_SHORT = -32768
+
+
 def format_reg(reg):
     if reg[-3:].isalpha():
         return reg[:-3] + '\u00A0' + reg[-3:]
@@ -595,8 +602,34 @@ class VehicleLocation(models.Model):
         ordering = ('id',)
 
     def get_appendage(self):
-        appendage = [self.datetime, self.latlong.coords, self.heading, self.early]
-        return (f'journey{self.journey_id}', json.dumps(appendage, cls=DjangoJSONEncoder))
+        x, y = self.latlong.coords
+        appendage = LOCATION_STRUCT.pack(
+            int(self.datetime.timestamp()),
+            round(y * 1000000),
+            round(x * 1000000),
+            NONE_SHORT if self.heading is None else round(self.heading),
+            NONE_SHORT if self.early is None else self.early
+        )
+        return (f'journey{self.journey_id}', appendage)
+
+    @staticmethod
+    def decode_appendage(appendage):
+        """Returns a datetime, (longitude, latitude) tuple, heading and early from get_appendage's binary format
+        (or the JSON format it used before)
+        """
+        if len(appendage) != LOCATION_STRUCT.size:  # JSON is always longer
+            when, coordinates, heading, early = json.loads(appendage)
+            if heading is not None:
+                heading = int(float(heading))  # (some feeds' headings used to be stored as strings, like "143")
+            return parse_datetime(when), tuple(coordinates), heading, early
+
+        when, latitude, longitude, heading, early = LOCATION_STRUCT.unpack(appendage)
+        return (
+            datetime.fromtimestamp(when, timezone.utc),
+            (longitude / 1000000, latitude / 1000000),
+            None if heading == NONE_SHORT else heading,
+            None if early == NONE_SHORT else early
+        )
 
     def get_redis_json(self, vehicle):
         journey = self.journey
@@ -613,6 +646,9 @@ class VehicleLocation(models.Model):
             'destination': journey.destination,
         }
 
+        if self.early is not None:
+            json['early'] = self.early
+
         if journey.service_id:
             json['service_id'] = journey.service_id
         elif journey.route_name:
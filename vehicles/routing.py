@@ -1,11 +1,17 @@
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, ChannelNameRouter
-from . import workers
+from django.urls import path
+from channels.routing import ProtocolTypeRouter, ChannelNameRouter, URLRouter
+from channels.security.websocket import AllowedHostsOriginValidator
+from . import consumers, workers
 
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),  # this prevents weird problems with parallel requests with the development server
 
+    "websocket": AllowedHostsOriginValidator(URLRouter([
+        path('ws/vehicle_positions', consumers.VehicleMapConsumer.as_asgi()),
+    ])),
+
     "channel": ChannelNameRouter({
         "sirivm": workers.SiriConsumer()
     })
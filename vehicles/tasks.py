@@ -4,8 +4,6 @@ from io import StringIO
 from ciso8601 import parse_datetime
 from celery import shared_task
 from django.db.models import Q
-from django.db.utils import OperationalError
-from django.core.cache import cache
 from busstops.models import DataSource, ServiceCode, Operator
 from disruptions.management.commands.import_siri_sx import handle_item as siri_sx
 from .management.commands import import_bod_avl
@@ -15,28 +13,9 @@ from .models import JourneyCode, Vehicle, VehicleJourney
 @shared_task
 def bod_avl(items):
     command = import_bod_avl.Command().do_source()
-
-    try:
-        vehicle_cache_keys = [command.get_vehicle_cache_key(item) for item in items]
-        vehicle_ids = cache.get_many(vehicle_cache_keys)  # code: id
-        vehicles = command.vehicles.in_bulk(vehicle_ids.values())  # id: vehicle
-        command.vehicle_cache = {  # code: vehicle
-            key: vehicles[vehicle_id] for key, vehicle_id in vehicle_ids.items() if vehicle_id in vehicles
-        }
-    except OperationalError:
-        vehicles = None
-
-    for item in items:
-        command.handle_item(item)
-
+    command.handle_items(items)
     command.save()
 
-    cache.set_many({
-        key: value
-        for key, value in command.vehicle_id_cache.items()
-        if key not in vehicle_ids or value != vehicle_ids
-    })
-
 
 @shared_task
 def handle_siri_vm(request_body):
@@ -51,8 +30,8 @@ def handle_siri_vm(request_body):
     )
     response_timestamp = parse_datetime(data['Siri']['ServiceDelivery']['ResponseTimestamp'])
 
-    for item in data['Siri']['ServiceDelivery']['VehicleMonitoringDelivery']['VehicleActivity']:
-        command.handle_item(item, response_timestamp)
+    command.handle_items(data['Siri']['ServiceDelivery']['VehicleMonitoringDelivery']['VehicleActivity'],
+                         response_timestamp)
 
     command.save()
 
@@ -0,0 +1,75 @@
+import redis
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from .consumers import VehicleMapConsumer
+from .utils import BUCKET_SUBSCRIPTIONS, get_bucket
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class VehicleMapConsumerTest(SimpleTestCase):
+    def setUp(self):
+        r = redis.from_url(settings.REDIS_URL)
+        r.flushall()
+        r.geoadd('vehicle_location_locations', 1.29, 52.62, 1)
+        r.set('vehicle1', '{"id": 11}')
+        r.geoadd('vehicle_location_locations', 0.5, 51.5, 2)  # outside the map
+        r.set('vehicle2', '{"id": 12}')
+        self.redis = r
+
+    async def test_vehicle_map(self):
+        communicator = WebsocketCommunicator(VehicleMapConsumer.as_asgi(), '/ws/vehicle_positions')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_to(text_data='[1.25, 52.6, 1.35, 52.7]')
+        self.assertEqual(await communicator.receive_json_from(), {
+            'full': True, 'vehicles': [{'id': 11}], 'expired': []
+        })
+        bucket = get_bucket(1.29, 52.62)
+        self.assertEqual(self.redis.zrange(BUCKET_SUBSCRIPTIONS, 0, -1), [bucket.encode()])
+
+        # the same bounds again - just renewing the subscriptions
+        await communicator.send_to(text_data='[1.25, 52.6, 1.35, 52.7]')
+        self.assertTrue(await communicator.receive_nothing())
+
+        await get_channel_layer().group_send(bucket, {
+            'type': 'vehicle_locations',
+            'items': [
+                (13, (1.3, 52.65), '{"id": 13}'),  # new
+                (11, (1.5, 52.65), '{"id": 11}'),  # moved out of the viewport
+                (14, (1.5, 52.65), '{"id": 14}'),  # outside the viewport, and the map never knew about it
+            ],
+            'expired': [15]  # the map never knew about it
+        })
+        self.assertEqual(await communicator.receive_json_from(), {
+            'full': False, 'vehicles': [{'id': 13}], 'expired': [11]
+        })
+
+        await get_channel_layer().group_send(bucket, {
+            'type': 'vehicle_locations', 'items': [], 'expired': [13]
+        })
+        self.assertEqual(await communicator.receive_json_from(), {
+            'full': False, 'vehicles': [], 'expired': [13]
+        })
+
+        # nothing the map needs to know about
+        await get_channel_layer().group_send(bucket, {
+            'type': 'vehicle_locations', 'items': [(14, (1.5, 52.65), '{"id": 14}')], 'expired': [15]
+        })
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.send_to(text_data='[NaN, 52.6, 1.35, 52.7]')
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 4000})
+
+        await communicator.disconnect()
+
+    async def test_too_big(self):
+        communicator = WebsocketCommunicator(VehicleMapConsumer.as_asgi(), '/ws/vehicle_positions')
+        await communicator.connect()
+
+        await communicator.send_to(text_data='[-3, 50, 3, 54]')
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 4000})
+
+        await communicator.disconnect()
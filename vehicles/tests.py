@@ -1,4 +1,7 @@
 import time_machine
+from datetime import timedelta
+from tempfile import TemporaryDirectory
+from ciso8601 import parse_datetime
 from django.test import TestCase, override_settings
 from django.contrib.gis.geos import Point
 from django.core.exceptions import ValidationError
@@ -6,6 +9,9 @@ from accounts.models import User
 from busstops.models import DataSource, Region, Operator, Service
 from .models import (Vehicle, VehicleType, VehicleFeature, Livery,
                      VehicleJourney, VehicleLocation, VehicleEdit, VehicleRevision)
+from . import archive
+from .management.schedule_adherence import ScheduleAdherence, Shape
+from .utils import get_bucket, get_buckets
 
 
 class VehiclesTests(TestCase):
@@ -424,6 +430,84 @@ class VehiclesTests(TestCase):
             response = self.client.get(f'/journeys/{self.journey.id}/debug')
         self.assertEqual({}, response.json())
 
+    def test_location_appendage(self):
+        location = VehicleLocation(datetime=parse_datetime('2020-11-28T12:58:25Z'), latlong=Point(1.296443, 52.62269),
+                                   journey=self.journey, heading=142, early=-3)
+        key, appendage = location.get_appendage()
+        self.assertEqual(key, f'journey{self.journey.id}')
+        self.assertEqual(len(appendage), 16)
+        self.assertEqual(VehicleLocation.decode_appendage(appendage), (
+            location.datetime, (1.296443, 52.62269), 142, -3
+        ))
+
+        location.heading = location.early = None
+        self.assertEqual(VehicleLocation.decode_appendage(location.get_appendage()[1])[2:], (None, None))
+
+        # the old JSON format
+        self.assertEqual(VehicleLocation.decode_appendage(b'["2020-11-28T12:58:25Z", [1.296443, 52.62269], 142, -3]'), (
+            location.datetime, (1.296443, 52.62269), 142, -3
+        ))
+
+    def test_buckets(self):
+        self.assertEqual(get_bucket(1.296, 52.623), 'vehicles_3_210')
+        self.assertEqual(get_bucket(-0.1, 51.5), 'vehicles_-1_206')
+        self.assertEqual(get_buckets(-0.1, 51.5, 0.1, 51.6), {
+            'vehicles_-1_206', 'vehicles_0_206'
+        })
+        self.assertEqual(len(get_buckets(-2, 50, 2, 54)), 11 * 17)
+        self.assertIsNone(get_buckets(-3, 50, 3, 54))  # too many
+        self.assertIsNone(get_buckets(-180, -90, 180, 90))
+        self.assertIsNone(get_buckets(0, 50, float('inf'), 54))
+        self.assertIsNone(get_buckets(float('nan'), 50, 1, 54))
+        self.assertIsNone(get_buckets(0, 50, -1, 54))
+
+    def test_schedule_adherence(self):
+        # an out-and-back route
+        shape = Shape([('a', (1.29, 52.62), 0), ('b', (1.29, 52.63), 600), ('a', (1.29, 52.62), 1200)])
+        self.assertEqual(shape.get_seconds(1.29, 52.625, 200, 0.005), 300)
+        self.assertEqual(shape.get_seconds(1.29, 52.625, 1000, 0.005), 900)
+        self.assertIsNone(shape.get_seconds(1.4, 52.625, 200, 0.005))
+
+        schedule_adherence = ScheduleAdherence()
+        schedule_adherence.refresh()
+        schedule_adherence.shapes[1] = (timedelta(hours=23, minutes=50), shape)
+        journey = VehicleJourney(trip_id=1, datetime=parse_datetime('2020-10-19T23:49:00+01:00'))
+        location = VehicleLocation(
+            journey=journey, latlong=Point(1.29, 52.625), datetime=parse_datetime('2020-10-19T23:57:00+01:00')
+        )
+        with self.assertNumQueries(0):
+            schedule_adherence.set_earlinesses([location])
+        self.assertEqual(location.early, -2)
+
+    def test_archive(self):
+        first = (parse_datetime('2020-10-19T23:47:00Z'), (1.296443, 52.62269), 142, -3)
+        second = (parse_datetime('2020-10-19T23:48:10Z'), (1.296, 52.623), None, None)
+
+        self.journey.refresh_from_db()
+        other_id = self.journey.id + 1
+
+        with TemporaryDirectory() as directory, override_settings(JOURNEY_ARCHIVE_DIR=directory):
+            date = archive.get_date(self.journey.datetime)
+            self.assertEqual(archive.get_journey_ids(date), set())
+            self.assertIsNone(archive.read_track(self.journey.datetime, self.journey.id))
+
+            archive.write_day(date, {self.journey.id: [second], other_id: [first]})
+            archive.write_day(date, {self.journey.id: [first, second]})
+            self.assertEqual(archive.get_journey_ids(date), {self.journey.id, other_id})
+            self.assertEqual(archive.read_track(self.journey.datetime, self.journey.id), [first, second])
+            self.assertEqual(archive.read_track(self.journey.datetime, other_id), [first])
+            self.assertIsNone(archive.read_track(self.journey.datetime, other_id + 1))
+
+            with override_settings(REDIS_URL='redis://localhose:69'):
+                with self.assertNumQueries(1):
+                    response = self.client.get(f'/journeys/{self.journey.id}.json')
+            self.assertEqual(response.json()['locations'][1], {
+                'coordinates': [1.296, 52.623],
+                'delta': None,
+                'direction': None,
+                'datetime': '2020-10-19T23:48:10Z'
+            })
+
     def test_service_vehicle_history(self):
         with self.assertNumQueries(5):
             response = self.client.get('/services/spixworth-hunworth-happisburgh/vehicles?date=poop')
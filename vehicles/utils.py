@@ -1,6 +1,59 @@
+from math import floor
+from time import time
 from .models import Vehicle, VehicleEdit, VehicleRevision, VehicleType, Livery
 
 
+# how long (in seconds) a vehicle{id} key in Redis lasts after the vehicle's latest update
+VEHICLE_LOCATION_TTL = 900
+# Redis sorted set of '{vehicle id}:{location id}' members, scored by when (in milliseconds) they were last updated -
+# so vehicles_json can work out which vehicles have changed (or expired) since a client's last request
+VEHICLE_UPDATES = 'vehicle_location_updates'
+
+# the live vehicle map's websockets get updates about vehicles in "buckets" of this many degrees of longitude/latitude
+BUCKET_WIDTH = 0.4
+BUCKET_HEIGHT = 0.25
+MAX_BUCKETS = 200
+# Redis sorted set of the names of buckets' channel groups, scored by when (in milliseconds) their subscriptions expire.
+# Maps' websockets keep renewing their buckets' subscriptions, so ones whose consumers have died without disconnecting
+# are forgotten after BUCKET_SUBSCRIPTION_TTL seconds
+BUCKET_SUBSCRIPTIONS = 'vehicle_map_buckets'
+BUCKET_SUBSCRIPTION_TTL = 300
+
+# how long (in seconds) a stop's predictions{stop id} hash lasts after it was last written to
+PREDICTIONS_TTL = 7200
+# predictions not updated for this many seconds (because the vehicle has stopped being tracked) are ignored
+PREDICTIONS_MAX_AGE = 600
+# Redis sorted set of '{stop id}:{journey id}' members, scored by when (in seconds) the journey's prediction for the
+# stop was last written - so predictions that have stopped being updated can be removed from predictions{stop id} hashes
+PREDICTION_UPDATES = 'prediction_updates'
+
+
+def get_milliseconds():
+    return int(time() * 1000)
+
+
+def get_bucket(x, y):
+    return f'vehicles_{floor(x / BUCKET_WIDTH)}_{floor(y / BUCKET_HEIGHT)}'
+
+
+def get_buckets(xmin, ymin, xmax, ymax):
+    """Returns the set of buckets covering some bounds - or None if the bounds aren't (finite) longitudes and
+    latitudes, or would need more than MAX_BUCKETS buckets
+    """
+    if not (-180 <= xmin <= xmax <= 180 and -90 <= ymin <= ymax <= 90):  # (also false if any are nan)
+        return
+    xs = range(floor(xmin / BUCKET_WIDTH), floor(xmax / BUCKET_WIDTH) + 1)
+    ys = range(floor(ymin / BUCKET_HEIGHT), floor(ymax / BUCKET_HEIGHT) + 1)
+    if len(xs) * len(ys) > MAX_BUCKETS:
+        return
+    return {f'vehicles_{x}_{y}' for x in xs for y in ys}
+
+
+def get_predictions_key(stop_id):
+    """Returns the name of a Redis hash of journey ids to JSON predictions of when they'll reach a stop"""
+    return f'predictions{stop_id}'
+
+
 def get_vehicle_edit(vehicle, fields, now, request):
     edit = VehicleEdit(vehicle=vehicle, datetime=now)
 
@@ -3,7 +3,7 @@ import json
 import xml.etree.cElementTree as ET
 import datetime
 from haversine import haversine
-from django.db.models import Exists, OuterRef
+from django.db.models import Exists, OuterRef, prefetch_related_objects
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.core.paginator import Paginator
@@ -12,16 +12,19 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.gis.db.models import Extent
 from django.contrib.postgres.aggregates import StringAgg
-from django.http import HttpResponse, JsonResponse, Http404, HttpResponseNotAllowed
+from django.http import HttpResponse, JsonResponse, Http404, HttpResponseNotAllowed, HttpResponseNotModified
 from django.views.generic.detail import DetailView
 from django.urls import reverse
 from django.utils import timezone
 from busstops.utils import get_bounding_box
 from busstops.models import Operator, Service
-from bustimes.models import Garage, Trip
-from .models import Vehicle, VehicleJourney, VehicleEdit, VehicleEditFeature, VehicleRevision, Livery
+from bustimes.models import prefetch_stop_times, Garage, Trip
+from .models import (
+    Vehicle, VehicleJourney, VehicleEdit, VehicleEditFeature, VehicleRevision, Livery, VehicleLocation
+)
+from . import archive
 from .forms import EditVehiclesForm, EditVehicleForm
-from .utils import get_vehicle_edit, do_revision, do_revisions
+from .utils import get_vehicle_edit, do_revision, do_revisions, get_milliseconds, VEHICLE_LOCATION_TTL, VEHICLE_UPDATES
 from .tasks import handle_siri_vm, handle_siri_sx
 
 
@@ -207,59 +210,63 @@ def operator_map(request, slug):
     })
 
 
-def vehicles_json(request):
-    r = redis.from_url(settings.REDIS_URL)
+def get_vehicle_ids_in_box(r, xmin, ymin, xmax, ymax):
+    # convert to kilometres (only for redis to convert back to degrees)
+    width = haversine((ymin, xmax), (ymin, xmin))
+    height = haversine((ymin, xmax), (ymax, xmax))
 
-    try:
-        bounds = get_bounding_box(request)
-    except KeyError:
-        bounds = None
+    return r.execute_command(
+        'GEOSEARCH',
+        'vehicle_location_locations',
+        'FROMLONLAT', (xmax + xmin) / 2, (ymax + ymin) / 2,
+        'BYBOX', width, height, 'km'
+    )
+
+
+def get_vehicle_ids(request, r, bounds):
+    """Returns the ids of vehicles that match the request, or None for all of them"""
 
     if bounds is not None:
         # ids of vehicles within box
-        xmin, ymin, xmax, ymax = bounds.extent
+        return get_vehicle_ids_in_box(r, *bounds.extent)
 
-        # convert to kilometres (only for redis to convert back to degrees)
-        width = haversine((ymin, xmax), (ymin, xmin))
-        height = haversine((ymin, xmax), (ymax, xmax))
+    if 'service' in request.GET:
+        return Vehicle.objects.filter(
+            latest_journey__service__in=request.GET['service'].split(',')
+        ).values_list('id', flat=True)
 
-        vehicle_ids = r.execute_command(
-            'GEOSEARCH',
-            'vehicle_location_locations',
-            'FROMLONLAT', (xmax + xmin) / 2, (ymax + ymin) / 2,
-            'BYBOX', width, height, 'km'
-        )
+    if 'operator' in request.GET:
+        return Vehicle.objects.filter(
+            operator__in=request.GET['operator'].split(',')
+        ).values_list('id', flat=True)
 
-    else:
-        if 'service' in request.GET:
-            vehicle_ids = Vehicle.objects.filter(
-                latest_journey__service__in=request.GET['service'].split(',')
-            ).values_list('id', flat=True)
-        elif 'operator' in request.GET:
-            vehicle_ids = Vehicle.objects.filter(
-                operator__in=request.GET['operator'].split(',')
-            ).values_list('id', flat=True)
-        else:
-            # ids of all vehicles
-            vehicle_ids = r.zrange('vehicle_location_locations', 0, -1)
 
+def get_vehicles_json(r, vehicle_ids):
+    """Returns a JSON array (as bytes) of the vehicles' locations, mostly stitched together from the JSON
+    that ImportLiveVehiclesCommand.save saved in Redis - only vehicles saved without their services' details
+    (with a 'service_id') need decoding and an extra query
+    """
     pipeline = r.pipeline(transaction=False)
     for vehicle_id in vehicle_ids:
         pipeline.get(f'vehicle{int(vehicle_id)}')
     vehicle_locations = pipeline.execute()
 
     locations = []
+    undetailed = []
     service_ids = set()
     for item in vehicle_locations:
         if item:
-            item = json.loads(item)
-            locations.append(item)
-            if 'service_id' in item and item['service_id']:
-                service_ids.add(item['service_id'])
-
-    services = Service.objects.only('line_name', 'line_brand', 'slug').in_bulk(service_ids)
-    for item in locations:
-        if 'service_id' in item:
+            if b'"service_id"' in item:
+                item = json.loads(item)
+                undetailed.append(item)
+                if item['service_id']:
+                    service_ids.add(item['service_id'])
+            else:
+                locations.append(item)
+
+    if undetailed:
+        services = Service.objects.only('line_name', 'line_brand', 'slug').in_bulk(service_ids)
+        for item in undetailed:
             if item['service_id']:
                 service = services[item['service_id']]
                 item['service'] = {
@@ -267,8 +274,84 @@ def vehicles_json(request):
                     'url': service.get_absolute_url()
                 }
             del item['service_id']
+            locations.append(json.dumps(item).encode())
+
+    return b'[' + b','.join(locations) + b']'
+
 
-    return JsonResponse(locations, safe=False)
+def vehicles_json(request):
+    """Without a 'since' parameter, returns a list of all the matching vehicles.
+
+    With one (a token from a previous response, or 0), returns
+    {'since': a token for next time, 'full': whether vehicles is the full list, 'vehicles': [], 'expired': []}
+    where vehicles contains only vehicles that have changed since the token,
+    and expired the ids of vehicles that have expired (or left the bounding box) since
+    """
+    r = redis.from_url(settings.REDIS_URL)
+
+    try:
+        bounds = get_bounding_box(request)
+    except KeyError:
+        bounds = None
+
+    now = get_milliseconds()
+    expired_before = now - VEHICLE_LOCATION_TTL * 1000
+
+    pipeline = r.pipeline(transaction=False)
+    pipeline.zrevrange(VEHICLE_UPDATES, 0, 0, withscores=True)
+    pipeline.zrevrangebyscore(VEHICLE_UPDATES, expired_before, '-inf', start=0, num=1, withscores=True)
+    latest, expired = pipeline.execute()
+    latest = int(latest[0][1]) if latest else 0
+    expired = int(expired[0][1]) if expired else 0
+
+    etag = f'"{latest}-{expired}"'
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        return HttpResponseNotModified()
+
+    vehicle_ids = get_vehicle_ids(request, r, bounds)
+
+    since = request.GET.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            since = 0
+
+    # too long ago to work out which vehicles have expired since
+    if since is None or since < expired_before:
+        if vehicle_ids is None:
+            # ids of all vehicles
+            vehicle_ids = r.zrange('vehicle_location_locations', 0, -1)
+        content = get_vehicles_json(r, vehicle_ids)
+
+        if since is not None:
+            content = b'{"since": %d, "full": true, "vehicles": %s, "expired": []}' % (latest, content)
+
+    else:
+        pipeline = r.pipeline(transaction=False)
+        pipeline.zrangebyscore(VEHICLE_UPDATES, since, '+inf')
+        pipeline.zrangebyscore(VEHICLE_UPDATES, f'({since - VEHICLE_LOCATION_TTL * 1000}', expired_before)
+        changed, expired = pipeline.execute()
+
+        if vehicle_ids is not None:
+            vehicle_ids = {int(vehicle_id) for vehicle_id in vehicle_ids}
+
+        changed_ids = []
+        expired_ids = [int(member.split(b':')[1]) for member in expired]
+        for member in changed:
+            vehicle_id, location_id = member.split(b':')
+            if vehicle_ids is None or int(vehicle_id) in vehicle_ids:
+                changed_ids.append(vehicle_id)
+            else:
+                expired_ids.append(int(location_id))
+
+        content = b'{"since": %d, "full": false, "vehicles": %s, "expired": %s}' % (
+            max(since, latest), get_vehicles_json(r, changed_ids), json.dumps(expired_ids).encode()
+        )
+
+    response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    return response
 
 
 def get_dates(journeys, vehicle=None, service=None):
@@ -321,16 +404,17 @@ def journeys_list(request, journeys, service=None, vehicle=None):
             for journey in journeys:
                 pipe.exists(f'journey{journey.id}')
             locations = pipe.execute()
-            previous = None
-            for i, journey in enumerate(journeys):
-                journey.locations = locations[i]
-                if journey.locations:
-                    if previous:
-                        previous.next = journey
-                        journey.previous = previous
-                    previous = journey
         except redis.exceptions.ConnectionError:
-            pass
+            locations = [False for journey in journeys]
+        archived = archive.get_journey_ids(date)
+        previous = None
+        for i, journey in enumerate(journeys):
+            journey.locations = locations[i] or journey.id in archived
+            if journey.locations:
+                if previous:
+                    previous.next = journey
+                    journey.previous = previous
+                previous = journey
 
         context['journeys'] = journeys
 
@@ -509,28 +593,31 @@ def journey_json(request, pk):
         trip = journey.get_trip()
 
     if trip:
+        prefetch_related_objects([trip], *prefetch_stop_times(('stop__locality',)))
         data['stops'] = [{
             'name': stop_time.stop.get_name_for_timetable() if stop_time.stop else stop_time.stop_code,
             'aimed_arrival_time': stop_time.arrival_time(),
             'aimed_departure_time': stop_time.departure_time(),
             'minor': stop_time.is_minor(),
             'coordinates': stop_time.stop and stop_time.stop.latlong and stop_time.stop.latlong.coords
-        } for stop_time in trip.stoptime_set.select_related('stop__locality')]
+        } for stop_time in trip.get_stop_times()]
 
     try:
         r = redis.from_url(settings.REDIS_URL)
         locations = r.lrange(f'journey{pk}', 0, -1)
-        if locations:
-            locations = (json.loads(location) for location in locations)
-            data['locations'] = [{
-                'coordinates': location[1],
-                'delta': location[3],
-                'direction': location[2],
-                'datetime': location[0]
-            } for location in locations if location[1][0] and location[1][1]]
-            data['locations'].sort(key=lambda location: location['datetime'])
+        locations = [VehicleLocation.decode_appendage(location) for location in locations]
     except redis.exceptions.ConnectionError:
-        pass
+        locations = None
+    if not locations:
+        locations = archive.read_track(journey.datetime, journey.id)
+    if locations:
+        data['locations'] = [{
+            'coordinates': location[1],
+            'delta': location[3],
+            'direction': location[2],
+            'datetime': location[0]
+        } for location in locations if location[1][0] and location[1][1]]
+        data['locations'].sort(key=lambda location: location['datetime'])
 
     return JsonResponse(data)
 